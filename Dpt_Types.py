@@ -1,5 +1,28 @@
 import struct
+import liblogging
 import time
+
+## NumPy is optional, only needed by the batch decoding (decode_batch)
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+## DPT9 decode table, value of each of the 65536 raw 2 byte floats (built on first use)
+_DPT9_TABLE = None
+
+def dpt9_table():
+    global _DPT9_TABLE
+    if _DPT9_TABLE is None:
+        table = []
+        for val in xrange(0x10000):
+            mant = val & 0x07ff
+            if val & 0x8000:
+                ## 12 bit two's complement mantissa
+                mant -= 0x0800
+            table.append((1 << ((val & 0x7800) >> 11)) * 0.01 * mant)
+        _DPT9_TABLE = tuple(table)
+    return _DPT9_TABLE
   
 
 class dpt_type:
@@ -19,7 +42,7 @@ class dpt_type:
             6:self.decodeDPT6,       # EIS 14.000    / 1 byte -128 ... 127
             7:self.decodeDPT7,       # EIS 10.000    / 2 byte 0....65535
             8:self.decodeDPT8,       # EIS 10.001    / 2 byte -32768 .... 32767
-            9:self.decodeDPT9,       # EIS 5         / 2 byte Float
+            9:self.decodeDPT9Table,  # EIS 5         / 2 byte Float
             10:self.decodeDPT10,     # EIS 3         / 3 byte WoTag/Stunde/Minute/Sekunde
             11:self.decodeDPT11,     # EIS 4         / 3 byte Tag/Monat/Jahr
             12:self.decodeDPT12,     # EIS 11.000    / 4 byte unsigned [0...4.294.967.295]
@@ -39,7 +62,7 @@ class dpt_type:
             6:self.encodeDPT6,       # EIS 14.000    / 1 byte -128 ... 127
             7:self.encodeDPT7,       # EIS 10.000    / 2 byte 0....65535
             8:self.encodeDPT8,       # EIS 10.001    / 2 byte -32768 .... 32767
-            9:self.encodeDPT9,       # EIS 5         / 2 byte Float
+            9:self.encodeDPT9Round,  # EIS 5         / 2 byte Float
             10:self.encodeDPT10,     # EIS 3         / 3 byte WoTag/Stunde/Minute/Sekunde
             11:self.encodeDPT11,     # EIS 4         / 3 byte Tag/Monat/Jahr
             12:self.encodeDPT12,     # EIS 11.000    / 4 byte unsigned [0...4.294.967.295]
@@ -47,6 +70,20 @@ class dpt_type:
             14:self.encodeDPT14,     # EIS 9         / 4 byte float 
             16:self.encodeDPT16      # EIS 15        / 14 byte Text
         }
+        ## vectorized decoders of decode_batch, payloads as a NumPy uint8 array (one row per telegram)
+        self.BATCH_DECODER = {
+            1:self.batchDecodeDPT1,
+            2:self.batchDecodeDPT2,
+            3:self.batchDecodeDPT3,
+            5:self.batchDecodeDPT5,
+            5.001:self.batchDecodeDPT501,
+            5.005:self.batchDecodeDPT5,
+            5.010:self.batchDecodeDPT5,
+            6:self.batchDecodeDPT6,
+            7:self.batchDecodeDPT7,
+            9:self.batchDecodeDPT9,
+            14:self.batchDecodeDPT14
+        }
   
   
     def decode(self,raw,dptid=0,dsobj=False):
@@ -62,7 +99,7 @@ class dpt_type:
             dpt = self.guessType(raw)
             if dsobj:
                 dsobj.dptid = dpt
-            self.debug("Guessed: %f" % dpt)
+            self.debug("Guessed: %f", dpt)
         if dpt == 0:
             return raw
         return self._decode(raw,dpt)
@@ -108,12 +145,34 @@ class dpt_type:
             self.errormsg()
             return msg
   
+    def decode_batch(self,raws,dptid):
+        ## Decode many payloads of the same DPT at once
+        ## raws: NumPy uint8 array, one row per telegram (or a list of payloads of the same length)
+        ## returns a NumPy array of the values, or a list when the DPT (or NumPy) doesn't allow a vectorized decoding
+        ## the subtypes without their own decoder (9.001, ...) use the one of their main type, as _decode does
+        decoder = self.BATCH_DECODER.get(dptid) or self.BATCH_DECODER.get(int(dptid))
+        if decoder is None or numpy is None:
+            return [self._decode(raw,dptid) for raw in raws]
+        raws = numpy.asarray(raws,dtype=numpy.uint8)
+        if raws.ndim == 1:
+            raws = raws.reshape(-1,1)
+        if len(raws) == 0:
+            return numpy.zeros(0)
+        return decoder(raws)
+  
+    def decode_groups(self,groups):
+        ## Decode payloads grouped by DPT: {dptid: payloads} => {dptid: values}
+        return dict((dpt,self.decode_batch(raws,dpt)) for dpt,raws in groups.iteritems())
+  
     def errormsg(self,msg=False):
         if self.WG:
             self.WG.errorlog(msg)
   
-    def debug(self,msg):
-        self.log(msg,'debug')
+    def debug(self,msg,*args):
+        ## the arguments are merged only if the debug messages are logged (or printed, without parent)
+        if self._parent and not liblogging.enabled(liblogging.DEBUG):
+            return
+        self.log(msg % args if args else msg,'debug')
   
     def log(self,msg,severity='info',instance=False):
         if not instance:
@@ -196,7 +255,7 @@ class dpt_type:
   
     def decodeDPT501(self,raw):
         ## 1 Byte unsigned percent
-        self.debug("DPT5.001 Scaling: value: %d" % raw[0])
+        self.debug("DPT5.001 Scaling: value: %d", raw[0])
         return (int(raw[0]) & 0xff) * 100 / 255
   
     def encodeDPT501(self,val):
@@ -243,7 +302,7 @@ class dpt_type:
         mant = val & 0x07ff
         if sign <> 0:
             mant = -(~(mant - 1) & 0x07ff) 
-        self.debug("DPT9: value: %d sign: %d exp: %d mant: %f" % (val, sign,exp,mant))
+        self.debug("DPT9: value: %d sign: %d exp: %d mant: %f", val, sign, exp, mant)
         return (1 << exp) * 0.01 * mant
   
     def encodeDPT9(self,val):
@@ -256,10 +315,40 @@ class dpt_type:
             mant = mant >> 1
             exp +=1
         data = sign | (exp << 11) | (int(mant) & 0x07ff)
-        self.debug("DPT9: value: %d sign: %d exp: %d mant: %r" % (val, sign,exp,mant))
+        self.debug("DPT9: value: %d sign: %d exp: %d mant: %r", val, sign, exp, mant)
         ## change to 2Byte bytearray 
         return self.toByteArray(data,2)
   
+    def decodeDPT9Table(self,raw):
+        ## 2 Byte Float, looked up in the precomputed table of the 65536 values
+        return dpt9_table()[((raw[-2] & 0xff) << 8) | (raw[-1] & 0xff)]
+  
+    def encodeDPT9Round(self,val):
+        ## 2 Byte Float, value * 100 = mant << exp with the smallest exponent keeping the mantissa in 12 bits
+        ## the mantissa is rounded to the nearest from the value itself (no rounding at each shift)
+        val = float(val)
+        if val != val:
+            ## invalid data
+            return [0x7f, 0xff]
+        val *= 100
+        exp = 0
+        mant = int(round(val))
+        while mant > 2047 or mant < -2048:
+            exp += 1
+            if exp > 15:
+                ## out of range, saturate
+                if val > 0:
+                    return [0x7f, 0xfe]
+                return [0xf8, 0x00]
+            mant = int(round(val / (1 << exp)))
+        data = (exp << 11) | (mant & 0x07ff)
+        if mant < 0:
+            data |= 0x8000
+        elif data == 0x7fff:
+            ## 7FFFh denotes invalid data, keep the greatest valid value
+            data = 0x7ffe
+        return [data >> 8, data & 0xff]
+  
   
     def decodeDPT10(self,raw):
         ## 3 Byte Time
@@ -415,7 +504,7 @@ class dpt_type:
         return res.decode('iso-8859-15')
   
     def encodeDPT16(self,val):
-        self.debug("DPT16encode: %r (%s)" % (val,type(val)))
+        self.debug("DPT16encode: %r (%s)", val, type(val))
         if type(val) == unicode:
             val = val.encode('iso-8859-15')
         ## max 14
@@ -429,6 +518,47 @@ class dpt_type:
             data.append(char)
         return data
   
+    ## batch decoders (NumPy), same results as the scalar decoders, one row of raws per telegram
+  
+    def _batchBigInt(self,raws,length):
+        ## big endian integer of the last length bytes of each row
+        res = numpy.zeros(len(raws),dtype=numpy.int64)
+        for col in range(max(0,raws.shape[1] - length),raws.shape[1]):
+            res = (res << 8) | raws[:,col]
+        return res
+  
+    def batchDecodeDPT1(self,raws):
+        return raws[:,0] & 0x1
+  
+    def batchDecodeDPT2(self,raws):
+        return raws[:,0] & 0x3
+  
+    def batchDecodeDPT3(self,raws):
+        return raws[:,0] & 0xf
+  
+    def batchDecodeDPT5(self,raws):
+        return raws[:,0].astype(numpy.int64)
+  
+    def batchDecodeDPT501(self,raws):
+        return raws[:,0].astype(numpy.int64) * 100 // 255
+  
+    def batchDecodeDPT6(self,raws):
+        return raws[:,0].view(numpy.int8).astype(numpy.int64)
+  
+    def batchDecodeDPT7(self,raws):
+        return self._batchBigInt(raws,2)
+  
+    def batchDecodeDPT9(self,raws):
+        ## SEEEEMMM MMMMMMMM, the mantissa is a 12 bit two's complement (sign + 11 bits)
+        val = self._batchBigInt(raws,2)
+        exp = (val & 0x7800) >> 11
+        mant = val & 0x07ff
+        mant = numpy.where(val & 0x8000,mant - 0x0800,mant)
+        return (numpy.left_shift(1,exp) * 0.01) * mant
+  
+    def batchDecodeDPT14(self,raws):
+        return numpy.ascontiguousarray(raws[:,-4:]).view('>f4').reshape(-1).astype(numpy.float64)
+  
     def validTypes(self,datalen):
         ##TODO:
         ret = []
@@ -479,4 +609,9 @@ if __name__ == "__main__":
     #print dpttypes.decode([35,76,58],dptid=16)
     print dpttypes.encode(15.5,dptid=14)
     print dpttypes.decode([0, 0, 6, 14],dptid=14)
-    print dpttypes.decode([65, 120, 0, 0],dptid=14)
\ No newline at end of file
+    print dpttypes.decode([65, 120, 0, 0],dptid=14)
+    ## the batch decoding of a subtype gives the values of the single decoding (a NumPy array when available)
+    temperatures = dpttypes.decode_batch([[0x0c, 0x1a], [0x8a, 0x24], [0x00, 0x00]],9.001)
+    assert list(temperatures) == [dpttypes.decode(raw,dptid=9.001) for raw in [[0x0c, 0x1a], [0x8a, 0x24], [0x00, 0x00]]]
+    assert numpy is None or isinstance(temperatures,numpy.ndarray)
+    print temperatures
\ No newline at end of file
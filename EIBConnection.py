@@ -25,8 +25,20 @@
 #   Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 # 
 
+import collections
 import errno
 import socket
+import struct
+
+
+# size of the receive buffer, large enough to hold at least one frame of the maximal size (0xffff + 2)
+EIB_RECV_BUFFER_SIZE = 0x20000
+
+EIB_GROUP_PACKET = 39
+EIB_BUSMONITOR_PACKET = 20
+EIB_GROUP_HEADER = struct.Struct('>HHH')     # message type, source address, destination address
+EIB_LENGTH_PREFIX = struct.Struct('>H')      # length of the frame
+EIB_SEND_GROUP_HEADER = struct.Struct('>HHH')   # length of the frame, message type, destination address
 
 
 class EIBBuffer:
@@ -62,6 +74,18 @@ class EIBConnection:
         self.fd = None
         self.errno = 0
         self.__complete = None
+        self.__blocking = None
+        self.__rbuf = bytearray(EIB_RECV_BUFFER_SIZE)   # receive buffer, reused for the connection lifetime
+        self.__rview = memoryview(self.__rbuf)          # view on the receive buffer to slice frames without copy
+        self.__rhead = 0                                # start of the data not parsed yet
+        self.__rtail = 0                                # end of the data received
+        self.__frames = collections.deque()             # complete frames (views on the receive buffer)
+
+    def __EIB_ResetReceive(self):
+        self.__blocking = None
+        self.__rhead = 0
+        self.__rtail = 0
+        self.__frames.clear()
 
     def EIBSocketLocal(self, path):
         if self.fd != None:
@@ -71,6 +95,7 @@ class EIBConnection:
         fd.connect(path)
         self.data = []
         self.readlen = 0
+        self.__EIB_ResetReceive()
         self.fd = fd
         return 0
 
@@ -82,6 +107,7 @@ class EIBConnection:
         fd.connect((host, port))
         self.data = []
         self.readlen = 0
+        self.__EIB_ResetReceive()
         self.fd = fd
         return 0
 
@@ -108,6 +134,7 @@ class EIBConnection:
             return -1
         self.fd.close()
         self.fd = None
+        self.__EIB_ResetReceive()
 
     def EIBClose_sync(self):
         self.EIBReset()
@@ -120,11 +147,10 @@ class EIBConnection:
         if len(data) < 2 or len(data) > 0xffff:
             self.errno = errno.EINVAL
             return -1
-        data = [(len(data) >> 8) & 0xff, (len(data)) & 0xff] + data
-        result = ''
-        for i in data:
-            result += chr(i)
-        self.fd.send(result)
+        frame = bytearray(EIB_LENGTH_PREFIX.size + len(data))
+        EIB_LENGTH_PREFIX.pack_into(frame, 0, len(data))
+        frame[EIB_LENGTH_PREFIX.size:] = data
+        self.fd.sendall(frame)
         return 0
 
     def EIB_Poll_FD(self):
@@ -134,44 +160,109 @@ class EIBConnection:
         return self.fd
 
     def EIB_Poll_Complete(self):
-        if self.__EIB_CheckRequest(False) == -1:
+        if not self.__frames and self.__EIB_CheckRequest(False) == -1:
             return -1
-        if self.readlen < 2 or (self.readlen >= 2 and self.readlen < self.datalen + 2):
+        if not self.__frames:
             return 0
         return 1
 
     def __EIB_GetRequest(self):
-        while True:
+        while not self.__frames:
             if self.__EIB_CheckRequest(True) == -1:
                 return -1
-            if self.readlen >= 2 and self.readlen >= self.datalen + 2:
-                self.readlen = 0
-                return 0
+        # the request methods index the frame, keep one compact copy of it (bytearray items are int)
+        self.data = bytearray(self.__frames.popleft())
+        self.datalen = len(self.data)
+        return 0
 
     def __EIB_CheckRequest(self, block):
+        """
+        Receive what is available on the socket into the receive buffer and parse all the complete frames it contains.
+        The parsed frames are views on the receive buffer, they stay valid until the next receive.
+        """
         if self.fd == None:
             self.errno = errno.ECONNRESET
             return -1
-        if self.readlen == 0:
-            self.head = []
-            self.data = []
-        if self.readlen < 2:
+        if self.__blocking != block:
             self.fd.setblocking(block)
-            result = self.fd.recv(2 - self.readlen)
-            for a in result:
-                self.head.append(ord(a))
-            self.readlen += len(result)
-        if self.readlen < 2:
+            self.__blocking = block
+
+        head = self.__rhead
+        tail = self.__rtail
+        if not self.__frames:
+            # every frame has been consumed, the beginning of the buffer can be reused
+            if head == tail:
+                head = tail = 0
+            elif tail > EIB_RECV_BUFFER_SIZE >> 1:
+                self.__rbuf[0:tail - head] = self.__rbuf[head:tail]
+                tail -= head
+                head = 0
+        if tail == EIB_RECV_BUFFER_SIZE:
+            # no room left until the pending frames are consumed
             return 0
-        self.datalen = (self.head[0] << 8) | self.head[1]
-        if self.readlen < self.datalen + 2:
-            self.fd.setblocking(block)
-            result = self.fd.recv(self.datalen + 2 - self.readlen)
-            for a in result:
-                self.data.append(ord(a))
-            self.readlen += len(result)
+
+        try:
+            received = self.fd.recv_into(self.__rview[tail:])
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return 0
+            raise
+        if received == 0:
+            self.errno = errno.ECONNRESET
+            return -1
+        tail += received
+
+        buf = self.__rbuf
+        while tail - head >= 2:
+            end = head + 2 + ((buf[head] << 8) | buf[head + 1])
+            if end > tail:
+                break
+            self.__frames.append(self.__rview[head + 2:end])
+            head = end
+
+        self.__rhead = head
+        self.__rtail = tail
+        self.readlen = tail - head
         return 0
 
+    def EIB_Get_Frames(self, block=True):
+        """
+        Receive and return all the complete frames available with as few system calls as possible.
+
+        :param block: wait for at least one frame
+        :return: list of frames (message type and payload, without the length prefix) as memoryview on the receive
+                 buffer, valid until the next receive on the connection. -1 on error.
+        """
+        while not self.__frames:
+            if self.__EIB_CheckRequest(block) == -1:
+                return -1
+            if not block:
+                break
+        frames = list(self.__frames)
+        self.__frames.clear()
+        return frames
+
+    def EIBGetGroup_Src_Frames(self, block=True):
+        """
+        Batched version of EIBGetGroup_Src on an opened group socket.
+
+        :param block: wait for at least one telegram
+        :return: list of (source, destination, apdu) where apdu is a memoryview valid until the next receive on the
+                 connection. -1 on error.
+        """
+        frames = self.EIB_Get_Frames(block)
+        if frames == -1:
+            return -1
+        telegrams = []
+        for frame in frames:
+            if len(frame) < 6:
+                continue
+            kind, src, dest = EIB_GROUP_HEADER.unpack_from(frame)
+            if kind != EIB_GROUP_PACKET:
+                continue
+            telegrams.append((src, dest, frame[6:]))
+        return telegrams
+
     def __EIBGetAPDU_Complete(self):
         self.__complete = None
         if self.__EIB_GetRequest() == -1:
@@ -358,7 +449,7 @@ class EIBConnection:
         self.__complete = None;
         if self.__EIB_GetRequest() == -1:
             return -1;
-        if (((self.data[0]) << 8) | (self.data[0 + 1])) != 1:
+        if (((self.data[0]) << 8) | (self.data[0 + 1])) == 1:
             self.errno = errno.EBUSY
             return -1
         if (((self.data[0]) << 8) | (self.data[0 + 1])) != 112 or len(self.data) < 2:
@@ -1315,7 +1406,7 @@ class EIBConnection:
         self.__complete = None;
         if self.__EIB_GetRequest() == -1:
             return -1;
-        if (((self.data[0]) << 8) | (self.data[0 + 1])) != 1:
+        if (((self.data[0]) << 8) | (self.data[0 + 1])) == 1:
             self.errno = errno.EBUSY
             return -1
         if (((self.data[0]) << 8) | (self.data[0 + 1])) != 16 or len(self.data) < 2:
@@ -1343,7 +1434,7 @@ class EIBConnection:
         self.__complete = None;
         if self.__EIB_GetRequest() == -1:
             return -1;
-        if (((self.data[0]) << 8) | (self.data[0 + 1])) != 1:
+        if (((self.data[0]) << 8) | (self.data[0 + 1])) == 1:
             self.errno = errno.EBUSY
             return -1
         if (((self.data[0]) << 8) | (self.data[0 + 1])) != 17 or len(self.data) < 2:
@@ -1545,7 +1636,7 @@ class EIBConnection:
         self.__complete = None;
         if self.__EIB_GetRequest() == -1:
             return -1;
-        if (((self.data[0]) << 8) | (self.data[0 + 1])) != 1:
+        if (((self.data[0]) << 8) | (self.data[0 + 1])) == 1:
             self.errno = errno.EBUSY
             return -1
         if (((self.data[0]) << 8) | (self.data[0 + 1])) != 18 or len(self.data) < 2:
@@ -1573,7 +1664,7 @@ class EIBConnection:
         self.__complete = None;
         if self.__EIB_GetRequest() == -1:
             return -1;
-        if (((self.data[0]) << 8) | (self.data[0 + 1])) != 1:
+        if (((self.data[0]) << 8) | (self.data[0 + 1])) == 1:
             self.errno = errno.EBUSY
             return -1
         if (((self.data[0]) << 8) | (self.data[0 + 1])) != 19 or len(self.data) < 2:
@@ -1666,6 +1757,27 @@ class EIBConnection:
             return -1;
         return self.sendlen
 
+    def EIBSendGroup_Batch(self, telegrams):
+        """
+        Send several group telegrams on an opened group socket with a single system call.
+
+        :param telegrams: list of (destination, apdu)
+        :return: number of telegrams sent, -1 on error
+        """
+        if self.fd == None:
+            self.errno = errno.ECONNRESET
+            return -1
+        frames = bytearray()
+        for dest, data in telegrams:
+            if len(data) < 2 or len(data) > 0xffff - 4:
+                self.errno = errno.EINVAL
+                return -1
+            frames += EIB_SEND_GROUP_HEADER.pack(len(data) + 4, EIB_GROUP_PACKET, dest & 0xffff)
+            frames.extend(data)
+        if frames:
+            self.fd.sendall(frames)
+        return len(telegrams)
+
 
 IMG_UNKNOWN_ERROR = 0
 IMG_UNRECOG_FORMAT = 1
@@ -2,6 +2,7 @@ __author__ = 'mehdi'
 
 import Dpt_Types
 import time
+from address import format_group_address, format_physical_address
 
 
 class groupsocket:
@@ -33,19 +34,19 @@ class groupsocket:
             except:
                 self.errormsg(tmp)
 
-        msg = {'raw': buf, 'src': src, 'dst': dst, 'srcaddr': self._decodePhysicalAddr(src)}
+        msg = {'raw': buf, 'src': src, 'dst': dst, 'srcaddr': format_physical_address(src)}
         try:
-            msg['dstaddr'] = self._decodeGrpAddr(dst)
+            msg['dstaddr'] = format_group_address(dst)
             id = "%s:%s" % (self._parent.instanceName, msg['dstaddr'])
             if buf[0] & 0x3 or (buf[1] & 0xC0) == 0xC0:
                 ##FIXME: unknown APDU
-                self.debug("unknown APDU from %r to %r raw: %r" % (msg['srcaddr'], msg['dstaddr'], buf))
+                self.debug("unknown APDU from %r to %r raw: %r", msg['srcaddr'], msg['dstaddr'], buf)
             else:
                 dsobj = self.WG.DATASTORE.get(id)
                 if buf[1] & 0xC0 == 0x00:
                     msg['type'] = "read"
                     if dsobj.config.get('readflag', False):
-                        self.debug("Read from %s" % id)
+                        self.debug("Read from %s", id)
                         self._parent.setValue(dsobj, flag=0x40)
 
                 #FIXME: Check (ds) if we should respond
@@ -73,19 +74,13 @@ class groupsocket:
         ## central error handling
         self.WG.errorlog(msg)
 
-    def _decodePhysicalAddr(self, raw):
-        return "%d.%d.%d" % ((raw >> 12) & 0x0f, (raw >> 8) & 0x0f, (raw) & 0xff)
-
-    def _decodeGrpAddr(self, raw):
-        return "%d/%d/%d" % ((raw >> 11) & 0x1f, (raw >> 8) & 0x07, (raw) & 0xff)
-
     def log(self, msg, severity='info', instance=False):
         if not instance:
             instance = 'KNX'
         self._parent.log(msg, severity, instance)
 
-    def debug(self, msg):
-        self.log("DEBUG: GROUPSOCKET: " + repr(msg), 'debug')
+    def debug(self, msg, *args):
+        self.log("DEBUG: GROUPSOCKET: " + repr(msg % args if args else msg), 'debug')
         pass
 
 
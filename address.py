@@ -0,0 +1,93 @@
+__author__ = 'mlefebvre'
+
+# Group addresses (1/2/3) and physical addresses (1.1.255) of the bus.
+#
+# Both address spaces are 16 bits : the text of every address is computed once, formatting an address is an index
+# in a table and reading the usual 3 levels form of a group address is a dict lookup.
+
+MAX_ADDRESS = 0xffff
+
+GROUP_ADDRESS_LEVELS = {                # number of parts => (bound, shift) of each part of a group address
+    1: ((0xffff, 0),),
+    2: ((0x1f, 11), (0x7ff, 0)),
+    3: ((0x1f, 11), (0x07, 8), (0xff, 0)),
+}
+PHYSICAL_ADDRESS_LEVELS = ((0x0f, 12), (0x0f, 8), (0xff, 0))    # area, line, device
+
+# raw address => text
+GROUP_ADDRESSES = ["%d/%d/%d" % (raw >> 11, (raw >> 8) & 0x07, raw & 0xff) for raw in xrange(MAX_ADDRESS + 1)]
+PHYSICAL_ADDRESSES = ["%d.%d.%d" % (raw >> 12, (raw >> 8) & 0x0f, raw & 0xff) for raw in xrange(MAX_ADDRESS + 1)]
+
+# text of the 3 levels form => raw address, the keys are the strings of the table
+GROUP_ADDRESS_VALUES = dict((text, raw) for raw, text in enumerate(GROUP_ADDRESSES))
+
+
+def format_group_address(raw):
+    """
+    :param raw: raw group address (0 - 0xffff)
+    :return: the group address in 3 levels (1/2/3)
+    """
+    return GROUP_ADDRESSES[raw]
+
+
+def format_physical_address(raw):
+    """
+    :param raw: raw physical address (0 - 0xffff)
+    :return: the physical address (1.1.255)
+    """
+    return PHYSICAL_ADDRESSES[raw]
+
+
+def read_parts(parts, levels):
+    raw = 0
+    for part, (bound, shift) in zip(parts, levels):
+        if len(part) > 5 or not part.isdigit():
+            return None
+        value = int(part)
+        if value > bound:
+            return None
+        raw |= value << shift
+    return raw
+
+
+def parse_group_address(text):
+    """
+    Read a group address written in 3 levels (1/2/3), 2 levels (1/515) or free (2563).
+
+    :param text: the group address
+    :return: the raw group address (int), None if the text is not a group address
+    """
+    raw = GROUP_ADDRESS_VALUES.get(text)
+    if raw is not None:
+        return raw
+    # other forms, or leading zeros (01/2/3)
+    parts = text.split('/', 3)
+    levels = GROUP_ADDRESS_LEVELS.get(len(parts))
+    if levels is None:
+        return None
+    return read_parts(parts, levels)
+
+
+def parse_physical_address(text):
+    """
+    :param text: the physical address (1.1.255)
+    :return: the raw physical address (int), None if the text is not a physical address
+    """
+    parts = text.split('.', 3)
+    if len(parts) != 3:
+        return None
+    return read_parts(parts, PHYSICAL_ADDRESS_LEVELS)
+
+
+if __name__ == '__main__':
+    # python address.py : check that the tables and the parsers agree on the whole address spaces
+    for raw in xrange(MAX_ADDRESS + 1):
+        assert parse_group_address(format_group_address(raw)) == raw
+        assert parse_physical_address(format_physical_address(raw)) == raw
+    assert parse_group_address('1/515') == parse_group_address('1/2/3') == parse_group_address('2563') == 0x0a03
+    assert parse_group_address('01/2/3') == 0x0a03
+    assert parse_group_address('32/0/0') is None
+    assert parse_group_address('1/8/0') is None
+    assert parse_group_address('1//3') is None
+    assert parse_physical_address('1.1.256') is None
+    print "Address tables OK"
@@ -0,0 +1,482 @@
+__author__ = 'mlefebvre'
+
+# Micro benchmarks of the hot paths of konext.
+#
+# usage : python benchmark.py [--json] [name ...]
+#
+# --json prints the results as a JSON document (one entry per measure) to compare runs and spot regressions.
+
+import json
+import optparse
+import platform
+import socket
+import sys
+import time
+import timeit
+import uuid
+import Dpt_Types
+import EIBConnection
+import libkonext
+import liblogging
+import logging
+import re
+from address import format_group_address, format_physical_address, parse_group_address
+from bus_queue import CoalescingSendQueue
+from cmd_parser import Parser
+from framing import LineFramer
+from provider import EibdWriter
+from session import ClientSession
+from tasker import Task
+from telegram import Telegram
+
+
+RESULTS = []        # every measure reported : dict(name, variant, size, value, unit)
+QUIET = False       # only collect the measures (JSON output)
+
+
+class QuietParent:
+    """
+    Parent of the dpt_type swallowing its log messages (the formatting cost is still paid).
+    """
+
+    def log(self, msg, severity='info', instance=False):
+        pass
+
+
+def measure(func, number, repeat=3):
+    """
+    :param func: callable to measure
+    :param number: number of calls per measure
+    :return: best time per call (in sec.)
+    """
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+
+def record(name, variant, value, unit, size=None):
+    RESULTS.append({'name': name, 'variant': variant, 'size': size, 'value': value, 'unit': unit})
+
+
+def report(name, variant, seconds, size=None):
+    record(name, variant, seconds * 1e6, 'us/op', size)
+    if not QUIET:
+        print "%-24s %-12s %10.3f us/op" % (name, variant if size is None else "%s %d" % (variant, size),
+                                            seconds * 1e6)
+
+
+def report_size(name, variant, size):
+    record(name, variant, size, 'bytes')
+    if not QUIET:
+        print "%-24s %-12s %10d bytes" % (name, variant, size)
+
+
+def bench_dpt9(number=100000):
+    dpt = Dpt_Types.dpt_type(QuietParent())
+    raw = [0x0c, 0x33]
+    value = 21          # the legacy encoder shifts the mantissa, it only works with integers
+    Dpt_Types.dpt9_table()      # the table is built once, outside of the measure
+    report('dpt9 decode', 'legacy', measure(lambda: dpt.decodeDPT9(raw), number))
+    report('dpt9 decode', 'table', measure(lambda: dpt.decodeDPT9Table(raw), number))
+    report('dpt9 decode', 'dpt_type', measure(lambda: dpt.decode(raw, dptid=9), number))
+    report('dpt9 encode', 'legacy', measure(lambda: dpt.encodeDPT9(value), number))
+    report('dpt9 encode', 'round', measure(lambda: dpt.encodeDPT9Round(value), number))
+    report('dpt9 encode', 'dpt_type', measure(lambda: dpt.encode(value, dptid=9), number))
+
+
+def deep_size(obj, shared=frozenset()):
+    """
+    :param shared: ids of the objects not to count (owned by someone else)
+    :return: size (in bytes) of the object and of the objects it holds (containers, instance attributes)
+    """
+    if id(obj) in shared:
+        return 0
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.iteritems():
+            size += deep_size(key, shared) + deep_size(value, shared)
+    elif isinstance(obj, (list, tuple)):
+        for item in obj:
+            size += deep_size(item, shared)
+    elif hasattr(obj, '__slots__'):
+        for name in obj.__slots__:
+            size += deep_size(getattr(obj, name), shared)
+    elif hasattr(obj, '__dict__'):
+        size += deep_size(obj.__dict__, shared)
+    return size
+
+
+def bench_telegram(number=100000):
+    src, dest = 0x1101, 0x0a03
+    apdu = memoryview(bytearray([0x00, 0x80, 0x0c, 0x1a]))
+
+    def legacy():
+        # copy of the apdu handed over by the reader, then the dict built by the decoders
+        raw = bytearray(apdu)
+        return {'raw': raw, 'src': src, 'dst': dest, 'srcaddr': "%d.%d.%d" % (src >> 12, (src >> 8) & 0xf, src & 0xff),
+                'dstaddr': "%d/%d/%d" % (dest >> 11, (dest >> 8) & 0x7, dest & 0xff), 'type': 'write',
+                'value': list(raw[2:])}
+
+    def slots():
+        return Telegram.from_apdu(src, dest, apdu, 0.0)
+
+    report('telegram build', 'legacy', measure(legacy, number))
+    report('telegram build', 'slots', measure(slots, number))
+    report_size('telegram memory', 'legacy', deep_size(legacy()))
+    report_size('telegram memory', 'slots', deep_size(slots()))
+
+
+def bench_address(number=100000):
+    """
+    Group / physical address conversions of every telegram and every command : the formatting and the regular
+    expression the parser used against the precomputed tables.
+    """
+    g_addr = re.compile("^(\d{1,3})(?:(?:\/(\d{1,3}))(?:\/(\d{1,3}))?)?$")
+    raw, text = 0x0a03, '1/2/3'
+
+    def legacy_parse():
+        match = g_addr.match(text)
+        return (int(match.group(1)) << 11) | (int(match.group(2)) << 8) | int(match.group(3))
+
+    report('group address format', 'legacy',
+           measure(lambda: "%d/%d/%d" % ((raw >> 11) & 0x1f, (raw >> 8) & 0x07, raw & 0xff), number))
+    report('group address format', 'table', measure(lambda: format_group_address(raw), number))
+    report('physical addr format', 'legacy',
+           measure(lambda: "%d.%d.%d" % ((raw >> 12) & 0x0f, (raw >> 8) & 0x0f, raw & 0xff), number))
+    report('physical addr format', 'table', measure(lambda: format_physical_address(raw), number))
+    report('group address parse', 'legacy', measure(legacy_parse, number))
+    report('group address parse', 'table', measure(lambda: parse_group_address(text), number))
+    report('group address parse', '2 levels', measure(lambda: parse_group_address('1/515'), number))
+
+
+class LegacyTask:
+    """
+    Task as it was before the batches : uuid1, wall clock and one clone per group address.
+    """
+
+    def __init__(self, raw_command, command, value, kind, group_address=None, response=None, dest=None):
+        self.uuid = uuid.uuid1()
+        self.created_at = time.time()
+        self.raw_command = raw_command
+        self.command = command
+        self.group_address = group_address
+        self.value = value
+        self.kind = kind
+        self.response = response
+        self.dest = dest
+
+    @staticmethod
+    def create_tasks_from_command(command):
+        kind = libkonext.get_command_kind(command.header)
+        values = command.values or [None] * len(command.addresses)
+        return [LegacyTask(command.raw, command.header, value, kind, group_address, None, dest)
+                for group_address, dest, value in zip(command.group_addresses, command.addresses, values)]
+
+
+TASK_SIZES = (1, 10, 100, 1000)         # number of group addresses per command
+
+
+def bench_task(sizes=TASK_SIZES):
+    """
+    Tasks of a command : created when the command is dispatched, then consumed one group address at a time by the
+    writer. The memory is the one held by the tasks (the command they come from excluded).
+    """
+    parser = Parser()
+    for size in sizes:
+        number = max(5, 10000 // size)
+        command = pipeline_commands(size)[1]
+        parsed = parser.parse_command(command)
+
+        def legacy():
+            for task in LegacyTask.create_tasks_from_command(parsed):
+                pass
+
+        def batch():
+            for task in Task.create_task_from_command(parsed).items():
+                pass
+
+        report('task create', 'legacy', measure(lambda: LegacyTask.create_tasks_from_command(parsed), number), size)
+        report('task create', 'batch', measure(lambda: Task.create_task_from_command(parsed), number), size)
+        report('task create+consume', 'legacy', measure(legacy, number), size)
+        report('task create+consume', 'batch', measure(batch, number), size)
+        # the strings, numbers and lists of the command are not counted
+        command_objects = [parsed.raw, parsed.header, parsed.group_addresses, parsed.addresses, parsed.values]
+        shared = set(id(o) for o in command_objects + parsed.group_addresses + parsed.addresses + parsed.values)
+        report_size('task memory %d' % size, 'legacy', deep_size(LegacyTask.create_tasks_from_command(parsed), shared))
+        report_size('task memory %d' % size, 'batch', deep_size(Task.create_task_from_command(parsed), shared))
+
+
+PIPELINE_SIZES = (1, 10, 100, 1000)     # number of group addresses per command
+
+
+def pipeline_commands(size):
+    """
+    :return: (read command, send command) on size distinct group addresses
+    """
+    addresses = [format_group_address(i) for i in xrange(1, size + 1)]
+    return ("%s %s" % (libkonext.READ, ','.join(addresses)),
+            "%s %s" % (libkonext.SEND, ','.join("%s=%02X" % (a, i & 0xff) for i, a in enumerate(addresses))))
+
+
+def bench_pipeline(sizes=PIPELINE_SIZES):
+    """
+    Each stage of a client command, from its validation to the eibd frames, for commands of growing size. The times
+    are per command.
+    """
+    parser = Parser()
+    writer = EibdWriter(None, parser=parser)
+    group_frame = EIBConnection.EIB_GROUP_HEADER.pack(EIBConnection.EIB_GROUP_PACKET, 0x1101, 0x0a03) + '\x00\x80\x0c'
+    group_frame = EIBConnection.EIB_LENGTH_PREFIX.pack(len(group_frame)) + group_frame
+
+    class NullSocket:
+        # eibd side of the connection, the frames are dropped
+        def sendall(self, data):
+            pass
+
+    connection = EIBConnection.EIBConnection()
+    connection.fd = NullSocket()
+
+    eibd, client = socket.socketpair()
+    receiver = EIBConnection.EIBConnection()
+    receiver.fd = client
+
+    for size in sizes:
+        number = max(5, 10000 // size)
+        for variant, command, validate in zip(('RE', 'SE'), pipeline_commands(size),
+                                              (parser.is_valid_read_command, parser.is_valid_send_command)):
+            task = Task.create_task_from_raw(command)
+            tasks = Task.extract_tasks(task)
+            telegrams = [writer.build_telegram(t) for t in tasks]
+            frames = group_frame * size
+
+            def queue():
+                # the session queues the task of the command, the writer takes its single address tasks
+                q = CoalescingSendQueue()
+                q.put(Task.create_task_from_command(parsed))
+                while q.qsize():
+                    q.get_nowait()
+
+            def send():
+                for i in xrange(0, len(telegrams), EibdWriter.BATCH_SIZE):
+                    connection.EIBSendGroup_Batch(telegrams[i:i + EibdWriter.BATCH_SIZE])
+
+            def receive():
+                eibd.sendall(frames)
+                count = 0
+                while count < size:
+                    count += len(receiver.EIBGetGroup_Src_Frames())
+
+            parsed = parser.parse_command(command)
+
+            report('parse_command', variant, measure(lambda: parser.parse_command(command), number), size)
+            report('create_task_from_command', variant,
+                   measure(lambda: Task.create_task_from_command(parsed), number), size)
+            report('is_valid_command', variant, measure(lambda: parser.is_valid_command(command), number), size)
+            report('is_valid_<kind>_command', variant, measure(lambda: validate(command), number), size)
+            report('get_header/get_body', variant,
+                   measure(lambda: libkonext.get_body(command) and libkonext.get_header(command), number), size)
+            report('create_task_from_raw', variant, measure(lambda: Task.create_task_from_raw(command), number), size)
+            report('extract_tasks', variant, measure(lambda: Task.extract_tasks(task), number), size)
+            report('queue put/get', variant, measure(queue, number), size)
+            report('build_telegram', variant, measure(lambda: [writer.build_telegram(t) for t in tasks], number),
+                   size)
+            report('eibd send framing', variant, measure(send, number), size)
+            if variant == 'RE':
+                # the answers : one group frame per address read
+                report('eibd receive framing', variant, measure(receive, number), size)
+
+    eibd.close()
+    client.close()
+
+
+PARSER_SIZES = (1000, 10000, 100000)       # length (in chars) of the worst case commands
+
+
+def worst_commands(size):
+    """
+    :return: list of (name, command) of about size chars built to be as slow as possible to reject or to accept
+    """
+    count = size // 6
+    return [
+        ('RE many', "%s %s" % (libkonext.READ, ','.join(['1/2/3'] * count))),
+        ('RE tail', "%s %s!" % (libkonext.READ, ','.join(['1/2/3'] * count))),
+        ('RE empty', "%s %s" % (libkonext.READ, ',' * size)),
+        ('RE digits', "%s %s" % (libkonext.READ, '1' * size)),
+        ('RE spaces', "%s %s" % (libkonext.READ, ' ' * size)),
+        ('SE value', "%s 1/2/3=%s!" % (libkonext.SEND, 'A' * size)),
+        ('HE since', "%s 1/2/3@%s" % (libkonext.HISTORY, '1' * size)),
+        ('CH name', "%s %s,EADP/0.2" % (libkonext.HELO_PREFIX, 'a' * size)),
+    ]
+
+
+def bench_parser(sizes=PARSER_SIZES):
+    """
+    Worst case commands : what the session did before handing the tasks over (regular expression, header / body
+    split, one task per comma) against the single pass parser. The times are per command.
+    """
+    parser = Parser()
+
+    def legacy(command):
+        if not parser.is_valid_command(command):
+            return None
+        header = libkonext.get_header(command)
+        if header == libkonext.HELO_PREFIX:
+            return parser.is_valid_helo_command(command)
+        try:
+            return Task.extract_tasks(Task.create_task_from_raw(command))
+        except Exception:
+            return None
+
+    def single_pass(command):
+        parsed = parser.parse_command(command)
+        if parsed is not None and parsed.valid and parsed.header in ClientSession.BUS_COMMANDS:
+            return Task.create_task_from_command(parsed)
+        return parsed
+
+    for size in sizes:
+        number = max(1, 100000 // size)
+        for name, command in worst_commands(size):
+            if libkonext.get_header(command) != libkonext.HISTORY:
+                # the history commands have no regular expression path
+                report(name, 'legacy', measure(lambda: legacy(command), number), size)
+            report(name, 'single pass', measure(lambda: single_pass(command), number), size)
+
+
+class BenchSession(ClientSession):
+    """
+    Logged in session without gateway : the answers are dropped and the tasks are not queued.
+    """
+
+    def __init__(self):
+        self.client_address = ('127.0.0.1', 50000)
+        self.parser = Parser()
+        self.name = 'bench'
+        self.logged_in = True
+
+    def send_back(self, message):
+        pass
+
+    def dispatch_command(self, command):
+        pass
+
+
+def bench_logging(number=20000):
+    """
+    Logging cost of a client command and of a telegram forwarded to a watcher : the logger drops the records, so the
+    difference between the levels is the cost of the debug messages (formatting, records) alone.
+    """
+    logger = logging.getLogger('konext.benchmark')
+    logger.propagate = False
+    logger.addHandler(logging.NullHandler())
+    session = BenchSession()
+    telegram = Telegram(0x1101, 0x0a03, 0x80, '\x0c\x1a', 0.0)
+    commands = (('RE', "%s 1/2/3" % libkonext.READ),
+                ('SE', "%s 1/2/3=0C1A" % libkonext.SEND),
+                ('WE', "%s 1/2/3" % libkonext.WATCH))
+
+    previous = liblogging.logger, liblogging.threshold
+    liblogging.logger = logger
+    try:
+        for level in (liblogging.DEBUG, liblogging.INFO):
+            logger.setLevel(level)
+            liblogging.threshold = level
+            variant = logging.getLevelName(level).lower()
+            report('log call', variant, measure(lambda: liblogging.log("Receive command [%s] from %s",
+                                                                       liblogging.DEBUG, "TE", ('127.0.0.1', 1)),
+                                                number * 10))
+            for name, command in commands:
+                report('handle_command ' + name, variant, measure(lambda: session.handle_command(command), number))
+            report('handle_telegram', variant, measure(lambda: session.handle_telegram(telegram, True), number))
+    finally:
+        liblogging.logger, liblogging.threshold = previous
+
+
+class ChunkSocket:
+    """
+    Client socket giving a stream back in chunks of a given size, as the receives would.
+    """
+
+    def __init__(self, stream, size):
+        self.chunks = [stream[i:i + size] for i in xrange(0, len(stream), size)]
+        self.index = 0
+        self.offset = 0                 # part of the current chunk already received (recv_into in a smaller view)
+
+    def rewind(self):
+        self.index = 0
+        self.offset = 0
+
+    def recv(self, size):
+        chunk = self.chunks[self.index]
+        self.index += 1
+        return chunk
+
+    def recv_into(self, view):
+        chunk = self.chunks[self.index]
+        count = min(len(view), len(chunk) - self.offset)
+        view[:count] = chunk[self.offset:self.offset + count]
+        self.offset += count
+        if self.offset == len(chunk):
+            self.index += 1
+            self.offset = 0
+        return count
+
+
+FRAMING_SIZES = (1, 10, 100, 1000)      # number of group addresses per command
+FRAMING_COMMANDS = 1000                 # pipelined commands of the stream
+FRAMING_CHUNK = 1024                    # bytes per receive
+
+
+def bench_framing(sizes=FRAMING_SIZES):
+    """
+    Commands pipelined by a client, received in chunks which don't follow the lines : string accumulation split on
+    each receive against the line framer. The times are per command.
+    """
+    for size in sizes:
+        read, send = pipeline_commands(size)
+        stream = ''.join("%s\n%s\n%s\n" % (read, send, libkonext.TEST) for i in xrange(FRAMING_COMMANDS // 3))
+        count = stream.count("\n")
+        sock = ChunkSocket(stream, FRAMING_CHUNK)
+        framer = LineFramer()
+
+        def string_split():
+            sock.rewind()
+            pending = ''
+            commands = 0
+            for i in xrange(len(sock.chunks)):
+                lines = (pending + sock.recv(FRAMING_CHUNK)).split("\n")
+                pending = lines.pop()
+                commands += len(lines)
+            assert commands == count
+
+        def line_framer():
+            sock.rewind()
+            commands = 0
+            while sock.index < len(sock.chunks):
+                commands += len(framer.receive(sock))
+            assert commands == count
+
+        report('framing', 'string split', measure(string_split, 1) / count, size)
+        report('framing', 'line framer', measure(line_framer, 1) / count, size)
+
+
+BENCHMARKS = {
+    'address': bench_address,
+    'dpt9': bench_dpt9,
+    'telegram': bench_telegram,
+    'pipeline': bench_pipeline,
+    'task': bench_task,
+    'parser': bench_parser,
+    'logging': bench_logging,
+    'framing': bench_framing,
+}
+
+
+if __name__ == '__main__':
+    option_parser = optparse.OptionParser(usage="%prog [--json] [name ...]")
+    option_parser.add_option('--json', action='store_true', default=False, help="print the results as JSON")
+    options, names = option_parser.parse_args()
+    QUIET = options.json
+    for name in names or sorted(BENCHMARKS):
+        BENCHMARKS[name]()
+    if options.json:
+        json.dump({'python': platform.python_version(), 'time': time.time(), 'results': RESULTS}, sys.stdout,
+                  indent=1, sort_keys=True)
+        print
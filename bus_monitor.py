@@ -1,5 +1,14 @@
 import Dpt_Types
+import EIBConnection
+import struct
+import sys
 import time
+from address import format_group_address, format_physical_address
+from clock import monotonic
+from telegram import Telegram
+
+MONITOR_TYPE = struct.Struct('>H')          # message type of the eibd frames
+MONITOR_HEADER = struct.Struct('>BHHBBB')   # ctrl, source, destination, address type / hops / length, tpci, apci
 
 
 class Busmonitor:
@@ -79,12 +88,12 @@ class Busmonitor:
         try:
             msg['ctrl1'] = self._decodeCtrlField1(buf[0])
             msg['ctrl2'] = self._decodeCtrlField2(buf[1])
-            msg['srcaddr'] = self._decodePhysicalAddr(buf[1:3])
+            msg['srcaddr'] = format_physical_address((buf[1] << 8) | buf[2])
             msg['AddressType'], msg['nctrl'], msg['datalen'] = self._decodeNPDU(buf[5])
             msg['apdu'], msg['data'] = self._decodeAPDU(buf[6:-1], msg['AddressType'], msg['datalen'])
 
             if msg['ctrl2']['DestAddrType'] == 0 and msg['apdu']['tpdu'] == "T_DATA_XXX_REQ":
-                msg['dstaddr'] = self._decodeGrpAddr(buf[3:5])
+                msg['dstaddr'] = format_group_address((buf[3] << 8) | buf[4])
 
                 id = "%s:%s" % (self._parent.instanceName, msg['dstaddr'])
 
@@ -99,7 +108,7 @@ class Busmonitor:
                 print "NONGROUP"
                 self.errormsg(msg)
                 ## non Group Communication
-                msg['dstaddr'] = self._decodePhysicalAddr(buf[3:5])
+                msg['dstaddr'] = format_physical_address((buf[3] << 8) | buf[4])
         except:
             self.errormsg(msg)
 
@@ -148,33 +157,6 @@ class Busmonitor:
         }
 
 
-    def _decodePhysicalAddr(self, raw):
-        ############################
-        ## Source Address (indiduell Address)
-        ## AAAALLLLDDDD
-        ## A Area
-        ## L Line
-        ## D Device
-        area = raw[0] >> 4
-        line = raw[0] & 0xf
-        device = raw[1]
-
-        return "%d.%d.%d" % (area, line, device)
-
-    def _decodeGrpAddr(self, raw):
-        ############################
-        ## Destination Address (group Address)
-        ## RHHHHMMM SSSSSSSS
-        ## R Reserved
-        ## H Maingroup
-        ## M Middlegroup
-        ## S Subgroup
-        main = (raw[0] >> 3) & 0xf
-        middle = raw[0] & 0x7
-        sub = raw[1]
-
-        return "%d/%d/%d" % (main, middle, sub)
-
     def _decodeNPDU(self, raw):
         ############################
         ## Data length
@@ -185,7 +167,7 @@ class Busmonitor:
         AddressType = (raw >> 7) & 0x1
         NetworkCtrl = (raw >> 4) & 0x7
         DataLength = raw & 0xf
-        self.debug("NPDU: %s " % self.tobinstr(raw))
+        self.debug("NPDU: %s ", self.tobinstr(raw))
 
         return AddressType, NetworkCtrl, DataLength
 
@@ -200,7 +182,7 @@ class Busmonitor:
         if tpdu == "T_DATA_XXX_REQ":
             if datalength == 1:
                 ## 6bit only
-                self.debug("DEBUG:6BIT %s" % self.tobinstr(raw[1]))
+                self.debug("DEBUG:6BIT %s", self.tobinstr(raw[1]))
                 apci = (raw[1] & 0x80)
                 data = [raw[1] & 0x3f]
             else:
@@ -208,7 +190,7 @@ class Busmonitor:
                 apci = (val & 0x3c0)
                 data = raw[2:]
         else:
-            self.debug("FIXME:#######################TPD: %r " % tpdu)
+            self.debug("FIXME:#######################TPD: %r ", tpdu)
             data = ""
             apci = 13
 
@@ -258,11 +240,84 @@ class Busmonitor:
         # self._parent.log(msg, severity, instance)
 
 
-    def debug(self, msg):
-        self.log("DEBUG: BUSMON: " + repr(msg), 'debug')
+    def debug(self, msg, *args):
+        self.log("DEBUG: BUSMON: " + repr(msg % args if args else msg), 'debug')
+
+
+######################################################################################
+## Streaming monitor pipeline:
+##   monitor_frames (eibd) -> decode_frames (telegrams) -> sink (any callable)
+## Each stage is a generator, nothing is buffered between the socket and the sink.
+######################################################################################
+
+def monitor_frames(eibd_addr, virtual=False):
+    ## Open a bus monitor on eibd and yield (timestamp, packet) for each busmonitor packet
+    ## All the frames already received are pulled with a single system call, packets are views on the receive
+    ## buffer of the connection: they are only valid until the next packet is pulled
+    conn = EIBConnection.EIBConnection()
+    if conn.EIBSocketURL(eibd_addr) == -1:
+        raise IOError(conn.errno, "Invalid eibd address [%s]" % eibd_addr)
+    try:
+        if virtual:
+            result = conn.EIBOpenVBusmonitor()
+        else:
+            result = conn.EIBOpenBusmonitor()
+        if result == -1:
+            raise IOError(conn.errno, "Unable to open the bus monitor on [%s]" % eibd_addr)
+        while True:
+            frames = conn.EIB_Get_Frames()
+            if frames == -1:
+                raise IOError(conn.errno, "Bus monitor connection lost on [%s]" % eibd_addr)
+            timestamp = monotonic()
+            for frame in frames:
+                if len(frame) > 2 and MONITOR_TYPE.unpack_from(frame)[0] == EIBConnection.EIB_BUSMONITOR_PACKET:
+                    yield timestamp, frame[2:]
+    finally:
+        conn.EIBClose()
+
+
+def decode_frame(timestamp, packet):
+    ## TP1 standard frame: CCCCCCCC SSSSSSSS SSSSSSSS DDDDDDDD DDDDDDDD ANNNLLLL TTTTTTAA AAMMMMMM [data] checksum
+    ## returns a Telegram, None for the frames which are not group data frames (acks, individual addressing,
+    ## truncated frames ...)
+    if len(packet) < MONITOR_HEADER.size:
+        return None
+    ctrl, src, dest, drl, tpci, apci = MONITOR_HEADER.unpack_from(packet)
+    if not drl & 0x80 or tpci & 0xfc:
+        return None
+    length = drl & 0x0f
+    payload = packet[MONITOR_HEADER.size:MONITOR_HEADER.size + length - 1].tobytes()
+    return Telegram(src, dest, (tpci & 0x03) << 8 | apci, payload, timestamp)
+
+
+def decode_frames(frames):
+    ## (timestamp, packet) => Telegram, lazily
+    for timestamp, packet in frames:
+        telegram = decode_frame(timestamp, memoryview(packet))
+        if telegram is not None:
+            yield telegram
+
+
+def run_monitor(eibd_addr, sink, virtual=False):
+    ## Feed the sink (callable taking a Telegram) with every group telegram seen on the bus
+    for telegram in decode_frames(monitor_frames(eibd_addr, virtual)):
+        sink(telegram)
+
+
+def format_telegram(telegram):
+    return "%.3f %s > %s %03X %s" % (telegram.timestamp, format_physical_address(telegram.src),
+                                     format_group_address(telegram.dest), telegram.kind, telegram.format_value())
+
+
+def print_sink(telegram, out=sys.stdout):
+    out.write(format_telegram(telegram) + "\n")
 
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        ## python bus_monitor.py ip:127.0.0.1 [virtual]
+        run_monitor(sys.argv[1], print_sink, virtual=len(sys.argv) > 2 and sys.argv[2] == 'virtual')
+        sys.exit(0)
     busmon = Busmonitor(False)
     #busmon.decode([176, 17, 253, 17, 104, 80, 222, 84])
     #busmon.decode("b01104116e5080f5")
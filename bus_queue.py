@@ -0,0 +1,203 @@
+__author__ = 'mlefebvre'
+
+import threading
+import time
+from collections import deque
+from Queue import Queue
+from tasker import Task
+from clock import monotonic
+import libkonext
+
+
+COALESCING_OFF = 'off'      # plain FIFO, every task reaches the bus
+COALESCING_MERGE = 'merge'  # the newest value replaces the pending write, in the queue slot of the pending one
+COALESCING_LWW = 'lww'      # last writer wins, the pending write is dropped and the newest one is queued at the end
+
+READ_KINDS = (Task.READ_TASK, libkonext.KNX_READ_FLAG, libkonext.WATCH, libkonext.KNX_RESPONSE_FLAG)
+
+_DROPPED = object()         # marker of a queue slot whose task has been superseded
+
+
+def is_read_task(task):
+    return task.kind in READ_KINDS
+
+
+class CoalescingSendQueue(Queue):
+    """
+    Outgoing bus queue collapsing the pending tasks addressed to the same group address.
+
+    A slider sending SE 1/2/3=.. 30 times a second must not queue 30 bus writes : while a write to a group address
+    is still waiting in the queue, a new write to the same address supersedes it so only the newest value reaches
+    the bus. Pending reads of the same address are collapsed too since they would all get the same answer.
+    The number of superseded tasks (stale intermediate values) is counted in coalesced.
+
+    Writes and reads wait in two lanes, the writes (interactive) are always served before the reads so bulk reads
+    can't starve them.
+
+    A batch task (several group addresses) takes a single slot and is not coalesced : its single address tasks are
+    created one at a time when they are taken out, the queue size counts them all.
+    """
+
+    def __init__(self, maxsize=0, mode=COALESCING_MERGE):
+        self.mode = mode
+        Queue.__init__(self, maxsize)
+
+    def _init(self, maxsize):
+        self.maxsize = maxsize
+        self.lanes = (deque(), deque())     # slots ([task]) in arrival order : writes, reads
+        self.lives = [0, 0]                 # number of slots still holding a task in each lane
+        self.pending = {}                   # (read, group address) => slot of the pending task
+        self.coalesced = 0                  # number of superseded tasks
+
+    def _qsize(self, len=len):
+        return self.lives[0] + self.lives[1]
+
+    def _lane(self, task):
+        if task is None:
+            return 0
+        return int(is_read_task(task))
+
+    def _key(self, task):
+        if task is None or self.mode == COALESCING_OFF or task.is_batch():
+            return None
+        return is_read_task(task), task.dest
+
+    def _put(self, task):
+        lane = self._lane(task)
+        key = self._key(task)
+        slot = self.pending.get(key) if key is not None else None
+        if slot is not None:
+            # the pending task is superseded, it will never be processed (nor marked as done)
+            self.coalesced += 1
+            self.unfinished_tasks -= 1
+            if self.mode == COALESCING_MERGE or key[0]:
+                slot[0] = task
+                return
+            slot[0] = _DROPPED
+            self.lives[lane] -= 1
+
+        if task is not None and task.is_batch():
+            # slot of a batch : [batch, its items, number of items left]
+            size = task.size()
+            self.lanes[lane].append([task, task.items(), size])
+            self.lives[lane] += size
+            self.unfinished_tasks += size - 1   # each item is marked as done
+            return
+
+        slot = [task]
+        self.lanes[lane].append(slot)
+        self.lives[lane] += 1
+        if key is not None:
+            self.pending[key] = slot
+
+    def _get(self):
+        lane = 0 if self.lives[0] else 1
+        queue = self.lanes[lane]
+        while True:
+            slot = queue[0]
+            task = slot[0]
+            if len(slot) > 1:
+                # batch : the slot leaves the lane with its last item
+                slot[2] -= 1
+                if not slot[2]:
+                    queue.popleft()
+                self.lives[lane] -= 1
+                return next(slot[1])
+            queue.popleft()
+            if task is not _DROPPED:
+                break
+        self.lives[lane] -= 1
+        key = self._key(task)
+        if key is not None and self.pending.get(key) is slot:
+            del self.pending[key]
+        return task
+
+
+class TokenBucket:
+    """
+    Telegram budget of a bus line : rate telegrams per second on average, with bursts up to burst telegrams.
+    A rate of 0 (or less) disables the limitation.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = max(1, int(burst))
+        self.tokens = float(self.burst)
+        self.stamp = monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self.stamp
+        if elapsed > 0:
+            self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+        self.stamp = now
+
+    def try_acquire(self, count=1):
+        """
+        :return: True if the telegrams can be sent right now (tokens consumed), False otherwise
+        """
+        if self.rate <= 0:
+            return True
+        self.lock.acquire()
+        try:
+            self._refill(monotonic())
+            if self.tokens >= count:
+                self.tokens -= count
+                return True
+            return False
+        finally:
+            self.lock.release()
+
+    def acquire(self, count=1):
+        """
+        Wait until the telegrams can be sent.
+
+        :return: the time waited (in sec.)
+        """
+        if self.rate <= 0:
+            return 0.0
+        start = monotonic()
+        while True:
+            self.lock.acquire()
+            try:
+                now = monotonic()
+                self._refill(now)
+                if self.tokens >= count:
+                    self.tokens -= count
+                    return now - start
+                delay = (count - self.tokens) / self.rate
+            finally:
+                self.lock.release()
+            time.sleep(delay)
+
+    def refund(self, count=1):
+        if self.rate <= 0:
+            return
+        self.lock.acquire()
+        self.tokens = min(self.burst, self.tokens + count)
+        self.lock.release()
+
+
+class WaitStats:
+    """
+    Time spent by the tasks between their creation and their emission on the bus.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, waited):
+        self.lock.acquire()
+        self.count += 1
+        self.total += waited
+        if waited > self.max:
+            self.max = waited
+        self.lock.release()
+
+    def average(self):
+        if not self.count:
+            return 0.0
+        return self.total / self.count
@@ -0,0 +1,179 @@
+__author__ = 'mlefebvre'
+
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+from telegram import Telegram
+from bus_monitor import format_telegram
+
+
+CAPTURE_MAGIC = 'KNXCAP'
+CAPTURE_VERSION = 1
+CAPTURE_HEADER = struct.Struct('>6sHH6x')          # magic, version, record size
+CAPTURE_RECORD = struct.Struct('>dHHHB14s3x')      # timestamp, source, destination, apci, payload length, payload
+CAPTURE_PAYLOAD_SIZE = 14                           # longest payload of a standard frame
+CAPTURE_SUFFIX = '.kcap'
+
+DEFAULT_CAPTURE_MAX_SIZE = 64 * 1024 * 1024         # size (in bytes) after which the capture file is rotated
+DEFAULT_FLUSH_DELAY = 1.0                           # delay (in sec.) after which the written records are flushed
+
+
+class CaptureWriter:
+    """
+    Append only capture of the group telegrams seen on the bus, as fixed width records.
+
+    The files are named <prefix>-<date>-<time>-<sequence>.kcap and a new one is started when the current one would
+    grow over max_size. Each file starts with a small header followed by the records in reception order, so a file
+    can be read (and searched by time) while it is still written.
+    """
+
+    def __init__(self, prefix, max_size=DEFAULT_CAPTURE_MAX_SIZE, flush_delay=DEFAULT_FLUSH_DELAY):
+        self.prefix = prefix                # path prefix of the capture files
+        self.max_size = max(max_size, CAPTURE_HEADER.size + CAPTURE_RECORD.size)
+        self.flush_delay = flush_delay      # delay (in sec.) after which the written records are flushed
+        self.file = None                    # current capture file
+        self.path = None                    # path of the current capture file
+        self.size = 0                       # size of the current capture file
+        self.sequence = 0                   # number of files started
+        self.flushed_at = 0                 # last flush time
+        self.lock = threading.Lock()        # serialize the writes and the closing
+
+    def _open(self, timestamp):
+        # never append to an existing capture (restart within the same second), its header would end up mid-file
+        while True:
+            self.sequence += 1
+            self.path = "%s-%s-%04d%s" % (self.prefix, time.strftime('%Y%m%d-%H%M%S', time.localtime(timestamp)),
+                                          self.sequence, CAPTURE_SUFFIX)
+            if not os.path.exists(self.path):
+                break
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.file = open(self.path, 'wb')
+        self.file.write(CAPTURE_HEADER.pack(CAPTURE_MAGIC, CAPTURE_VERSION, CAPTURE_RECORD.size))
+        self.size = CAPTURE_HEADER.size
+
+    def _close(self):
+        if self.file is not None:
+            self.file.close()
+        self.file = None
+
+    def record(self, telegram, timestamp):
+        """
+        :param telegram: the telegram (Telegram)
+        :param timestamp: time the telegram has been observed on the bus (seconds since the epoch)
+        """
+        payload = telegram.payload[:CAPTURE_PAYLOAD_SIZE]
+        data = CAPTURE_RECORD.pack(timestamp, telegram.src, telegram.dest, telegram.apci, len(payload), payload)
+        self.lock.acquire()
+        try:
+            if self.file is not None and self.size + CAPTURE_RECORD.size > self.max_size:
+                self._close()
+            if self.file is None:
+                self._open(timestamp)
+            self.file.write(data)
+            self.size += CAPTURE_RECORD.size
+            if timestamp - self.flushed_at >= self.flush_delay:
+                self.file.flush()
+                self.flushed_at = timestamp
+        finally:
+            self.lock.release()
+
+    def flush(self):
+        self.lock.acquire()
+        try:
+            if self.file is not None:
+                self.file.flush()
+        finally:
+            self.lock.release()
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            self._close()
+        finally:
+            self.lock.release()
+
+
+class CaptureReader:
+    """
+    Memory mapped capture file. The records are decoded on access only, the searches by time are binary searches
+    on the timestamps of the records (the records are written in reception order).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        if size < CAPTURE_HEADER.size:
+            self.file.close()
+            raise ValueError("%s is not a capture file" % path)
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, record_size = CAPTURE_HEADER.unpack_from(self.map)
+        if magic != CAPTURE_MAGIC or record_size != CAPTURE_RECORD.size:
+            self.close()
+            raise ValueError("%s is not a capture file (version %d)" % (path, version))
+        # a record being written may be incomplete, ignore it
+        self.count = (size - CAPTURE_HEADER.size) // CAPTURE_RECORD.size
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def __len__(self):
+        return self.count
+
+    def timestamp(self, index):
+        return struct.unpack_from('>d', self.map, CAPTURE_HEADER.size + index * CAPTURE_RECORD.size)[0]
+
+    def telegram(self, index):
+        """
+        :return: the telegram of the record, its timestamp is the time of the capture (seconds since the epoch)
+        """
+        timestamp, src, dest, apci, length, payload = CAPTURE_RECORD.unpack_from(
+            self.map, CAPTURE_HEADER.size + index * CAPTURE_RECORD.size)
+        return Telegram(src, dest, apci, payload[:length], timestamp)
+
+    def bisect(self, timestamp):
+        """
+        :return: index of the first record captured at or after the timestamp
+        """
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.timestamp(middle) < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def slice(self, start=None, end=None):
+        """
+        :param start: first time of the slice (included), beginning of the capture if None
+        :param end: last time of the slice (excluded), end of the capture if None
+        :return: (first index, last index + 1) of the records of the slice
+        """
+        first = 0 if start is None else self.bisect(start)
+        last = self.count if end is None else self.bisect(end)
+        return first, max(first, last)
+
+    def telegrams(self, start=None, end=None):
+        """
+        Iterate over the telegrams captured between start (included) and end (excluded), lazily.
+        """
+        first, last = self.slice(start, end)
+        for index in xrange(first, last):
+            yield self.telegram(index)
+
+
+if __name__ == '__main__':
+    # python capture.py file.kcap [start [end]] : print the telegrams captured in the time range
+    reader = CaptureReader(sys.argv[1])
+    start = float(sys.argv[2]) if len(sys.argv) > 2 else None
+    end = float(sys.argv[3]) if len(sys.argv) > 3 else None
+    for telegram in reader.telegrams(start, end):
+        print format_telegram(telegram)
+    reader.close()
@@ -0,0 +1,43 @@
+__author__ = 'mlefebvre'
+
+import time
+
+
+def _clock_gettime_monotonic():
+    """
+    :return: a function reading CLOCK_MONOTONIC through the C library, None if not available
+    """
+    try:
+        import ctypes
+        import ctypes.util
+    except ImportError:
+        return None
+
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    for name in ('rt', 'c'):
+        path = ctypes.util.find_library(name)
+        if path is None:
+            continue
+        try:
+            clock_gettime = ctypes.CDLL(path, use_errno=True).clock_gettime
+        except (OSError, AttributeError):
+            continue
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+
+        def monotonic():
+            spec = timespec()       # one per call, the clock is read from several threads
+            if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(spec)) != 0:
+                errno = ctypes.get_errno()
+                raise OSError(errno, "clock_gettime failed")
+            return spec.tv_sec + spec.tv_nsec * 1e-9
+        return monotonic
+    return None
+
+
+CLOCK_MONOTONIC = 1         # linux clock id
+
+# monotonic() : seconds elapsed since an arbitrary point, not affected by the system clock updates.
+# Falls back on the wall clock when no monotonic clock is available.
+monotonic = getattr(time, 'monotonic', None) or _clock_gettime_monotonic() or time.time
@@ -1,6 +1,10 @@
 __author__ = 'mehdi'
 import re
+import string
 from liblogging import log, DEBUG, INFO, CRITICAL, FATAL, WARNING
+from address import parse_group_address
+from libkonext import HISTORY_LAST, HISTORY_SINCE, HELO_PREFIX, HELO_PROTO, READ, SEND, WATCH, UNWATCH, TEST, \
+    HISTORY
 
 
 GENERAL_CMD_REGEX = "^[A-Z]{2}\s.+$"
@@ -10,10 +14,119 @@ SEND_CMD_REGEX = "^SE\s\d{1,3}(?:\/\d{1,3}){0,2}=[A-Za-z0-9]+(?:,\d{1,3}(?:\/\d{
 WATCH_CMD_REGEX = "^WE\s\d{1,3}(?:\/\d{1,3}){0,2}(?:,\d{1,3}(?:\/\d{1,3}){0,2})*$"
 UNWATCH_CMD_REGEX = "^UE\s\d{1,3}(?:\/\d{1,3}){0,2}(?:,\d{1,3}(?:\/\d{1,3}){0,2})*$"
 TEST_CMD_REGEX = "^TE$"
-G_ADDR_REGEX = "^(\d{1,3})(?:(?:\/(\d{1,3}))(?:\/(\d{1,3}))?)?$"
 
 CORS_REGEX = "^\<.*\>"
 
+WHITESPACES = string.whitespace                 # separators matched by \s in the regular expressions
+HEX_DIGITS = string.hexdigits
+WORD_CHARS = string.ascii_letters + string.digits + '_'
+MAX_DIGITS = 18                                 # longest number read (int() is not linear on long digit strings)
+MAX_PAYLOAD = 14                                # longest data (in bytes) written after the APCI of a standard frame
+
+
+def parse_number(text, fraction=False):
+    """
+    :param fraction: True to accept a decimal part (1420070400.5)
+    :return: the number (int or float), None if the text is not a number
+    """
+    if fraction:
+        integer, dot, decimals = text.partition('.')
+        if integer.isdigit() and (not dot or decimals.isdigit()):
+            return float(text)
+    elif len(text) <= MAX_DIGITS and text.isdigit():
+        return int(text)
+    return None
+
+
+def read_payload(value):
+    """
+    :param value: hexadecimal value of a write : 1 or 2 digits for a byte, an even number of digits for several bytes
+                  (0C1A)
+    :return: the bytes written after the APCI (list of int), None if the value can't be written
+    """
+    if not value or value.translate(None, HEX_DIGITS):
+        return None
+    if len(value) <= 2:
+        return [int(value, 16)]
+    if len(value) % 2 or len(value) > 2 * MAX_PAYLOAD:
+        return None
+    return [int(value[i:i + 2], 16) for i in xrange(0, len(value), 2)]
+
+
+class Command:
+    """
+    Client command read in a single pass by Parser.parse_command : the group addresses are converted and the values
+    split, nothing has to be parsed again down the pipeline.
+    """
+
+    def __init__(self, raw, header, body):
+        self.raw = raw                  # the line received, without its terminator
+        self.header = header            # RE, SE, WE, UE, HE, TE, CH ...
+        self.body = body                # what follows the header
+        self.valid = False              # False if the body doesn't match the syntax of the header
+        self.group_addresses = []       # group addresses as written by the client (echoed in the answers)
+        self.addresses = []             # raw group addresses, in the same order
+        self.values = []                # send : hexadecimal value written to each group address
+        self.lasts = []                 # history : number of values asked for each group address (None => all)
+        self.sinces = []                # history : time of the oldest value asked for each group address (None => all)
+        self.name = None                # helo : name of the client
+
+    def read_addresses(self, items):
+        for item in items:
+            address = parse_group_address(item)
+            if address is None:
+                return False
+            self.group_addresses.append(item)
+            self.addresses.append(address)
+        return True
+
+    def read_send(self, items):
+        for item in items:
+            group_address, equal, value = item.partition('=')
+            address = parse_group_address(group_address)
+            if address is None or read_payload(value) is None:
+                return False
+            self.group_addresses.append(group_address)
+            self.addresses.append(address)
+            self.values.append(value)
+        return True
+
+    def read_history(self, items):
+        for item in items:
+            last = since = None
+            if HISTORY_SINCE in item:
+                group_address, since = item.split(HISTORY_SINCE, 1)
+                since = parse_number(since, fraction=True)
+                if since is None:
+                    return False
+            elif HISTORY_LAST in item:
+                group_address, last = item.split(HISTORY_LAST, 1)
+                last = parse_number(last)
+                if last is None:
+                    return False
+            else:
+                group_address = item
+            address = parse_group_address(group_address)
+            if address is None:
+                return False
+            self.group_addresses.append(group_address)
+            self.addresses.append(address)
+            self.lasts.append(last)
+            self.sinces.append(since)
+        return True
+
+    def read_helo(self):
+        # CH name, EADP/0.1 (one optional space after the comma)
+        name, comma, proto = self.body.partition(',')
+        if not comma or not name or name.translate(None, WORD_CHARS):
+            return False
+        if proto and proto[0] in WHITESPACES:
+            proto = proto[1:]
+        if proto != HELO_PROTO:
+            return False
+        self.name = name
+        return True
+
 
 class Parser:
 
@@ -29,7 +142,6 @@ class Parser:
         self.watch_cmd = re.compile(WATCH_CMD_REGEX)
         self.unwatch_cmd = re.compile(UNWATCH_CMD_REGEX)
         self.test_cmd = re.compile(TEST_CMD_REGEX)
-        self.g_addr = re.compile(G_ADDR_REGEX)
         self.cors_regex = re.compile(CORS_REGEX)
 
     def call(self, func, cmd):
@@ -58,121 +170,110 @@ class Parser:
         return False
 
 
+    def parse_command(self, command):
+        """
+        Read a command in a single pass, in linear time whatever the input (no regular expression, every part of the
+        line is looked at once).
+
+        :param command: the command, without the line terminator
+        :return: the command (Command), its valid flag tells if the body matches the syntax of the header. None if
+        the line is not a command at all (two upper case letters, a separator and a body, or TE alone)
+        """
+        header = command[:2]
+        if len(header) != 2 or not header.isalpha() or not header.isupper():
+            return None
+        if len(command) == 2:
+            if header != TEST:
+                return None
+            body = ''
+        elif len(command) == 3 or command[2] not in WHITESPACES:
+            return None
+        else:
+            body = command[3:]
+
+        parsed = Command(command, header, body)
+        if header == READ or header == WATCH or header == UNWATCH:
+            parsed.valid = parsed.read_addresses(body.split(','))
+        elif header == SEND:
+            parsed.valid = parsed.read_send(body.split(','))
+        elif header == HISTORY:
+            parsed.valid = parsed.read_history(body.split(','))
+        elif header == HELO_PREFIX:
+            parsed.valid = parsed.read_helo()
+        elif header == TEST:
+            parsed.valid = True
+        log("Command [%s] read, valid : %s", DEBUG, command, parsed.valid)
+        return parsed
+
     def is_valid_command(self, command):
-        log("Validating generic format for command [%s]" % command, DEBUG)
+        log("Validating generic format for command [%s]", DEBUG, command)
         match = self.general_cmd.match(command)
         if match:
-            log("Match detected for command [%s]" % command, DEBUG)
+            log("Match detected for command [%s]", DEBUG, command)
             return True
-        log("Validating error for command [%s]" % command, DEBUG)
+        log("Validating error for command [%s]", DEBUG, command)
         return False
 
     def is_valid_test_command(self, command):
-        log("Validating format for test command [%s]" % command, DEBUG)
+        log("Validating format for test command [%s]", DEBUG, command)
         match = self.test_cmd.match(command)
         if match:
-            log("Match detected for test command [%s]" % command, DEBUG)
+            log("Match detected for test command [%s]", DEBUG, command)
             return True
-        log("Validating error for test command [%s]" % command, DEBUG)
+        log("Validating error for test command [%s]", DEBUG, command)
         return False
 
     def is_valid_helo_command(self, command):
-        log("Validating format for helo with command [%s]" % command, DEBUG)
+        log("Validating format for helo with command [%s]", DEBUG, command)
         match = self.helo_cmd.match(command)
         if match:
-            log("Command [%s] is a valid helo command" % command, DEBUG)
+            log("Command [%s] is a valid helo command", DEBUG, command)
             return True
-        log("Command [%s] is not a valid helo command" % command, DEBUG)
+        log("Command [%s] is not a valid helo command", DEBUG, command)
         return False
 
     def is_valid_read_command(self, command):
-        log("Validating format for read with command [%s]" % command, DEBUG)
+        log("Validating format for read with command [%s]", DEBUG, command)
         match = self.read_cmd.match(command)
         if match:
-            log("Command [%s] is a valid read command" % command, DEBUG)
+            log("Command [%s] is a valid read command", DEBUG, command)
             return True
-        log("Command [%s] is not a valid read command" % command, DEBUG)
+        log("Command [%s] is not a valid read command", DEBUG, command)
         return False
 
     def is_valid_send_command(self, command):
-        log("Validating format for send with command [%s]" % command, DEBUG)
+        log("Validating format for send with command [%s]", DEBUG, command)
         match = self.send_cmd.match(command)
         if match:
-            log("Command [%s] is a valid send command" % command, DEBUG)
+            log("Command [%s] is a valid send command", DEBUG, command)
             return True
-        log("Command [%s] is not a valid send command" % command, DEBUG)
+        log("Command [%s] is not a valid send command", DEBUG, command)
         return False
 
     def is_valid_watch_command(self, command):
-        log("Validating format for watch with command [%s]" % command, DEBUG)
+        log("Validating format for watch with command [%s]", DEBUG, command)
         match = self.watch_cmd.match(command)
         if match:
-            log("Command [%s] is a valid watch command" % command, DEBUG)
+            log("Command [%s] is a valid watch command", DEBUG, command)
             return True
-        log("Command [%s] is not a valid watch command" % command, DEBUG)
+        log("Command [%s] is not a valid watch command", DEBUG, command)
         return False
 
     def is_valid_unwatch_command(self, command):
-        log("Validating format for unwatch with command [%s]" % command, DEBUG)
+        log("Validating format for unwatch with command [%s]", DEBUG, command)
         match = self.unwatch_cmd.match(command)
         if match:
-            log("Command [%s] is a valid unwatch command" % command, DEBUG)
+            log("Command [%s] is a valid unwatch command", DEBUG, command)
             return True
-        log("Command [%s] is not a valid unwatch command" % command, DEBUG)
+        log("Command [%s] is not a valid unwatch command", DEBUG, command)
         return False
 
-    def read_g_addr(self, addr):
-        match = self.g_addr.match(addr)
-        if not match:
-            return None
-
-        if len(match.groups()) == 3:
-            g1 = int(match.group(1))
-            g2 = int(match.group(2))
-            g3 = int(match.group(3))
-            #r = ((g1 & 0x01F) << 11) | ((g2 & 0x07) << 8) | ((g3 & 0xF))
-            r = (g1 << 11) | (g2 << 8) | g3
-        else:
-            if len(match.groups()) == 2:
-                g1 = int(match.group(1))
-                g2 = int(match.group(2))
-                #r = ((g1 & 0x01F) << 11) | ((g2 & 0x7FF))
-                r = (g1 << 11) | g2
-            else:
-                if len(match.groups()) == 1:
-                    g1 = int(match.group(1), 16)
-                    #r = (g1 & 0xFFFF)
-                    r = g1
-                else:
-                    raise Exception("Unable to read the given address [%s]" % addr)
-        return r
-
-    def read_group_address(self, addr):
-        return self.read_g_addr(addr)
-
     def read_hex(self, val):
         try:
             return int(val, 16)
         except:
             return None
 
-    def _decode_physical_addr(self, raw):
-        return "%d.%d.%d" % ((raw >> 12) & 0x0f, (raw >> 8) & 0x0f, (raw) & 0xff)
-
-    def _decode_group_addr(self, raw):
-        return "%d/%d/%d" % ((raw >> 11) & 0x1f, (raw >> 8) & 0x07, (raw) & 0xff)
-
-    def read_addr(self, val):
-        # read address like %d.%d.%d and transform it to hex value
-        parts = val.split('.')
-        a = int(parts[0])
-        b = int(parts[1])
-        c = int(parts[2])
-        return ((a & 0x0f) << 12) | ((b & 0x0f) << 8) | ((c & 0xff))
-
-    def read_physical_address(self, val):
-        return self.read_addr(val)
-
     def format_result(self, raw_data):
         result = ''
         if len(raw_data) == 2:
@@ -190,17 +291,19 @@ if __name__ == '__main__':
         'read': ['RE 15/0/1', 'RE 15/0/1,15/0/2,15/0/3'],
         'send': ['SE 15/0/1=FF', 'SE 15/0/1=FF,15/0/2=11,15/0/3=44'],
         'watch': ['WE 15/0/1', 'WE 15/0/1,15/0/2'],
-        'unwatch': ['UE 15/0/3', 'UE 15/0/1,15/0/2']
+        'unwatch': ['UE 15/0/3', 'UE 15/0/1,15/0/2'],
+        'history': ['HE 15/0/1', 'HE 15/0/1:50', 'HE 15/0/1@1420070400.5,15/0/2:10']
     }
 
     def functions(k):
+        # the history commands are only read in a single pass
         return {
             'helo': 'is_valid_helo_command',
             'read': 'is_valid_read_command',
             'send': 'is_valid_send_command',
             'watch': 'is_valid_watch_command',
             'unwatch': 'is_valid_unwatch_command',
-        }[k]
+        }.get(k)
 
     for k, val in right_commands.items():
         func = functions(k)
@@ -208,14 +311,18 @@ if __name__ == '__main__':
             print "Testing if the command [%s] is a valid command" % cmd
             assert True == parser.is_valid_command(cmd)
             print "OK"
-            print "testing if command [%s] is valid accros function [%s] ..." % (cmd, func)
-            assert True == parser.call(func, cmd)
+            if func is not None:
+                print "testing if command [%s] is valid accros function [%s] ..." % (cmd, func)
+                assert True == parser.call(func, cmd)
+                print "OK"
+            print "testing if command [%s] is read in a single pass ..." % cmd
+            assert True == parser.parse_command(cmd).valid
             print "OK"
 
     print "Test for reading address"
     address = '15/0/1'
     try:
-        result = parser.read_g_addr(address)
+        result = parse_group_address(address)
         print "Result for %s is %d" % (address, result)
         print "OK"
     except Exception, e:
@@ -229,4 +336,10 @@ if __name__ == '__main__':
         print "Failed [%s]" %e
     print "OK"
 
+    print "Test for reading payloads"
+    assert read_payload('FF') == [0xFF] and read_payload('0C1A') == [0x0C, 0x1A]
+    assert read_payload('1FF') is None and read_payload('G1') is None and read_payload('00' * 15) is None
+    assert parser.parse_command('SE 1/2/3=1FF,1/2/4=02').valid is False
+    print "OK"
+
     print "Tests successfully passed"
\ No newline at end of file
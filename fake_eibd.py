@@ -0,0 +1,376 @@
+__author__ = 'mlefebvre'
+
+import collections
+import socket
+import struct
+import sys
+import threading
+import time
+import liblogging
+from address import parse_group_address
+from telegram import Telegram, GROUP_READ, GROUP_RESPONSE, GROUP_WRITE
+
+
+EIB_INVALID_REQUEST = 6
+EIB_CONNECTION_INUSE = 1
+EIB_RESET_CONNECTION = 4
+EIB_OPEN_BUSMONITOR = 16
+EIB_OPEN_VBUSMONITOR = 18
+EIB_BUSMONITOR_PACKET = 20
+EIB_OPEN_GROUPCON = 38
+EIB_GROUP_PACKET = 39
+EIB_CACHE_ENABLE = 112
+EIB_CACHE_DISABLE = 113
+EIB_CACHE_CLEAR = 114
+EIB_CACHE_REMOVE = 115
+EIB_CACHE_READ = 116                                # wait for the bus when the value is missing or too old
+EIB_CACHE_READ_NOWAIT = 117
+EIB_CACHE_LAST_UPDATES = 118
+
+EIB_LENGTH_PREFIX = struct.Struct('>H')             # length of the frame
+EIB_TYPE = struct.Struct('>H')                      # message type
+EIB_ADDRESS = struct.Struct('>H')                   # individual or group address
+EIB_GROUP_FRAME = struct.Struct('>HHHH')            # length of the frame, message type, source, destination
+EIB_MONITOR_FRAME = struct.Struct('>HHBHHBBB')      # length of the frame, message type, TP1 ctrl, source,
+                                                    # destination, address type / hops / length, tpci, apci
+
+DEFAULT_PORT = 6720
+DEFAULT_INDIVIDUAL_ADDRESS = 0x11ff                 # 1.1.255, source of the telegrams sent by the clients
+DEFAULT_RESPONDER_ADDRESS = 0x11fe                  # 1.1.254, source of the responses to the group reads
+DEFAULT_CACHE_READ_TIMEOUT = 1.0                    # delay (in sec.) a cache read waits for the bus
+UPDATES_LOG_SIZE = 0x8000                           # group addresses kept for the last updates requests
+TP1_CTRL = 0xbc                                     # standard frame, low priority, not repeated
+TP1_GROUP_HOPS = 0xe0                               # group destination, routing counter 6
+
+
+class EibdClient:
+    """
+    Connection of a client on the stand-in.
+    """
+
+    def __init__(self, client_socket, client_address):
+        self.client_socket = client_socket
+        self.client_address = client_address
+        self.group = False                          # group socket opened
+        self.write_only = False                     # group socket opened to send only
+        self.monitor = None                         # EIB_OPEN_BUSMONITOR / EIB_OPEN_VBUSMONITOR once opened
+        self.lock = threading.Lock()                # serialize the writes (client thread and bus deliveries)
+
+    def send(self, data):
+        self.lock.acquire()
+        try:
+            self.client_socket.sendall(data)
+        finally:
+            self.lock.release()
+
+    def reply(self, kind, payload=''):
+        self.send(EIB_LENGTH_PREFIX.pack(EIB_TYPE.size + len(payload)) + EIB_TYPE.pack(kind) + payload)
+
+
+class FakeEibd(threading.Thread):
+    """
+    Local stand-in of eibd speaking its TCP protocol (length prefixed frames), to run konext and its tools without
+    a KNX bus.
+
+    Every telegram put on the emulated bus, sent by a client (EIBSendGroup) or injected, is delivered to the group
+    sockets (except the sender one) with its source and destination, to the bus monitors as TP1 frames, and feeds the
+    group cache. The group reads of the addresses set in values are answered on the bus by the responder address.
+    """
+
+    def __init__(self, address='127.0.0.1', port=DEFAULT_PORT, individual_address=DEFAULT_INDIVIDUAL_ADDRESS,
+                 responder_address=DEFAULT_RESPONDER_ADDRESS):
+        threading.Thread.__init__(self)
+        self.individual_address = individual_address
+        self.responder_address = responder_address
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server_socket.bind((address, port))
+        self.server_socket.listen(50)
+        self.address, self.port = self.server_socket.getsockname()
+        self.clients = ()                           # connected clients (copy on write)
+        self.clients_lock = threading.Lock()
+        self.values = {}                            # raw group address => data (following the APCI) answered to reads
+        self.cache_enabled = False
+        self.cache = {}                             # raw group address => (source, apdu, time)
+        self.updates = collections.deque(maxlen=UPDATES_LOG_SIZE)   # updated group addresses, oldest first
+        self.updates_end = 0                        # position (16 bits) following the last update
+        self.cache_condition = threading.Condition()    # protect the cache, notified on each update
+        self.received = 0                           # number of group telegrams sent by the clients
+        self.is_running = False
+
+    def log(self, message, level=liblogging.INFO, *args):
+        liblogging.log(message, level, *args)
+
+    def url(self):
+        """
+        :return: the eibd address of the stand-in, as expected by EIBConnection.EIBSocketURL
+        """
+        return "ip:%s:%d" % (self.address, self.port)
+
+    # --------------------------------------------------------- #
+
+                        #### bus side ####
+
+    # --------------------------------------------------------- #
+
+    def group_frames(self, telegrams):
+        return ''.join(EIB_GROUP_FRAME.pack(len(t.payload) + 8, EIB_GROUP_PACKET, t.src, t.dest) +
+                       chr(t.apci >> 8) + chr(t.apci & 0xff) + t.payload for t in telegrams)
+
+    def monitor_frames(self, telegrams):
+        frames = []
+        for t in telegrams:
+            frame = EIB_MONITOR_FRAME.pack(len(t.payload) + 11, EIB_BUSMONITOR_PACKET, TP1_CTRL, t.src, t.dest,
+                                           TP1_GROUP_HOPS | (len(t.payload) + 1), t.apci >> 8, t.apci & 0xff)
+            frame += t.payload
+            checksum = 0xff
+            for c in frame[4:]:
+                checksum ^= ord(c)
+            frames.append(frame + chr(checksum))
+        return ''.join(frames)
+
+    def update_cache(self, telegrams):
+        self.cache_condition.acquire()
+        try:
+            if not self.cache_enabled:
+                return
+            now = time.time()
+            for t in telegrams:
+                if t.kind == GROUP_WRITE or t.kind == GROUP_RESPONSE:
+                    self.cache[t.dest] = (t.src, t.apdu(), now)
+                    self.updates.append(t.dest)
+                    self.updates_end = (self.updates_end + 1) & 0xffff
+            self.cache_condition.notifyAll()
+        finally:
+            self.cache_condition.release()
+
+    def deliver(self, telegrams, sender=None):
+        group_data = monitor_data = None
+        for client in self.clients:
+            if client is sender:
+                continue
+            if client.group and not client.write_only:
+                if group_data is None:
+                    group_data = self.group_frames(telegrams)
+                data = group_data
+            elif client.monitor is not None:
+                if monitor_data is None:
+                    monitor_data = self.monitor_frames(telegrams)
+                data = monitor_data
+            else:
+                continue
+            try:
+                client.send(data)
+            except socket.error:
+                pass
+
+    def bus(self, telegrams, sender=None):
+        """
+        Put telegrams on the emulated bus.
+
+        :param telegrams: list of Telegram
+        :param sender: client which sent the telegrams, it doesn't receive them back
+        """
+        self.update_cache(telegrams)
+        self.deliver(telegrams, sender)
+        responses = [Telegram(self.responder_address, t.dest, GROUP_RESPONSE, self.values[t.dest])
+                     for t in telegrams if t.kind == GROUP_READ and t.dest in self.values]
+        if responses:
+            self.bus(responses)
+
+    def inject(self, telegrams):
+        """
+        Put telegrams on the bus as if they were sent by other devices.
+
+        :param telegrams: list of Telegram
+        """
+        self.bus(telegrams)
+
+    # --------------------------------------------------------- #
+
+                        #### group cache ####
+
+    # --------------------------------------------------------- #
+
+    def cache_entry(self, dest, age=None):
+        # (source, apdu) of the cached value, None when missing or older than age (in sec.)
+        entry = self.cache.get(dest)
+        if entry is None or (age and time.time() - entry[2] > age):
+            return None
+        return entry[:2]
+
+    def read_cache(self, dest, age=None, timeout=0):
+        """
+        :param age: maximum age (in sec.) of the value, any age if None / 0
+        :param timeout: delay (in sec.) to wait for the value, a group read is sent on the bus when it is missing
+        :return: (source, apdu) of the value, None if not available
+        """
+        self.cache_condition.acquire()
+        try:
+            entry = self.cache_entry(dest, age) if self.cache_enabled else None
+        finally:
+            self.cache_condition.release()
+        if entry is not None or not timeout or not self.cache_enabled:
+            return entry
+        self.bus([Telegram(self.individual_address, dest, GROUP_READ)])
+        deadline = time.time() + timeout
+        self.cache_condition.acquire()
+        try:
+            entry = self.cache_entry(dest, age)
+            while entry is None and time.time() < deadline:
+                self.cache_condition.wait(deadline - time.time())
+                entry = self.cache_entry(dest, age)
+            return entry
+        finally:
+            self.cache_condition.release()
+
+    def last_updates(self, start, timeout):
+        """
+        :param start: position (16 bits) of the first update requested
+        :param timeout: delay (in sec.) to wait for an update when there is none since start
+        :return: (position following the last update, list of the updated raw group addresses)
+        """
+        deadline = time.time() + timeout
+        self.cache_condition.acquire()
+        try:
+            while self.updates_end == start and time.time() < deadline:
+                self.cache_condition.wait(deadline - time.time())
+            count = min((self.updates_end - start) & 0xffff, len(self.updates))
+            updates = list(self.updates)[len(self.updates) - count:] if count else []
+            return self.updates_end, updates
+        finally:
+            self.cache_condition.release()
+
+    def handle_cache_request(self, client, kind, payload):
+        if kind == EIB_CACHE_ENABLE:
+            self.cache_condition.acquire()
+            self.cache_enabled = True
+            self.cache_condition.release()
+            client.reply(kind)
+        elif kind == EIB_CACHE_DISABLE:
+            self.cache_condition.acquire()
+            self.cache_enabled = False
+            self.cache.clear()
+            self.cache_condition.release()
+            client.reply(kind)
+        elif kind == EIB_CACHE_CLEAR:
+            self.cache_condition.acquire()
+            self.cache.clear()
+            self.cache_condition.release()
+            client.reply(kind)
+        elif kind == EIB_CACHE_REMOVE and len(payload) >= 2:
+            self.cache_condition.acquire()
+            self.cache.pop(EIB_ADDRESS.unpack_from(payload)[0], None)
+            self.cache_condition.release()
+            client.reply(kind)
+        elif kind in (EIB_CACHE_READ, EIB_CACHE_READ_NOWAIT) and len(payload) >= 2:
+            dest = EIB_ADDRESS.unpack_from(payload)[0]
+            if kind == EIB_CACHE_READ and len(payload) >= 4:
+                entry = self.read_cache(dest, EIB_ADDRESS.unpack_from(payload, 2)[0], DEFAULT_CACHE_READ_TIMEOUT)
+            else:
+                entry = self.read_cache(dest)
+            if entry is None:
+                # a null destination tells the client that there is no value
+                client.reply(kind, EIB_ADDRESS.pack(0) + EIB_ADDRESS.pack(0))
+            else:
+                client.reply(kind, EIB_ADDRESS.pack(entry[0]) + EIB_ADDRESS.pack(dest) + entry[1])
+        elif kind == EIB_CACHE_LAST_UPDATES and len(payload) >= 3:
+            end, updates = self.last_updates(EIB_ADDRESS.unpack_from(payload)[0], ord(payload[2]))
+            client.reply(kind, EIB_ADDRESS.pack(end) + ''.join(EIB_ADDRESS.pack(dest) for dest in updates))
+        else:
+            client.reply(EIB_INVALID_REQUEST)
+
+    # --------------------------------------------------------- #
+
+                        #### client side ####
+
+    # --------------------------------------------------------- #
+
+    def handle_request(self, client, kind, payload):
+        if kind == EIB_GROUP_PACKET and client.group and len(payload) >= 4:
+            self.received += 1
+            apdu = payload[2:]
+            self.bus([Telegram(self.individual_address, EIB_ADDRESS.unpack_from(payload)[0],
+                               ((ord(apdu[0]) & 0x03) << 8) | ord(apdu[1]), apdu[2:])], client)
+        elif kind == EIB_OPEN_GROUPCON and not client.group and client.monitor is None:
+            client.group = True
+            client.write_only = len(payload) >= 3 and ord(payload[2]) != 0
+            client.reply(kind)
+        elif kind in (EIB_OPEN_BUSMONITOR, EIB_OPEN_VBUSMONITOR) and not client.group and client.monitor is None:
+            # a single bus monitor at once, the virtual ones share the bus
+            if kind == EIB_OPEN_BUSMONITOR and any(c.monitor == EIB_OPEN_BUSMONITOR for c in self.clients):
+                client.reply(EIB_CONNECTION_INUSE)
+            else:
+                client.monitor = kind
+                client.reply(kind)
+        elif EIB_CACHE_ENABLE <= kind <= EIB_CACHE_LAST_UPDATES:
+            self.handle_cache_request(client, kind, payload)
+        elif kind == EIB_RESET_CONNECTION:
+            client.group = client.write_only = False
+            client.monitor = None
+            client.reply(kind)
+        else:
+            client.reply(EIB_INVALID_REQUEST)
+
+    def handle(self, client):
+        data = ''
+        try:
+            while self.is_running:
+                received = client.client_socket.recv(65536)
+                if not received:
+                    break
+                data += received
+                offset = 0
+                while len(data) - offset >= 2:
+                    end = offset + 2 + EIB_LENGTH_PREFIX.unpack_from(data, offset)[0]
+                    if end > len(data):
+                        break
+                    if end - offset >= 4:
+                        self.handle_request(client, EIB_TYPE.unpack_from(data, offset + 2)[0], data[offset + 4:end])
+                    offset = end
+                data = data[offset:]
+        except socket.error, e:
+            self.log("eibd stand-in : client (%s,%s) hang up : %s", liblogging.WARNING, *(client.client_address + (e,)))
+        finally:
+            self.clients_lock.acquire()
+            self.clients = tuple(c for c in self.clients if c is not client)
+            self.clients_lock.release()
+            client.client_socket.close()
+
+    def stop(self):
+        self.is_running = False
+        self.server_socket.close()
+
+    def run(self):
+        self.is_running = True
+        self.log("eibd stand-in listening on [%s]", liblogging.INFO, self.url())
+        while self.is_running:
+            try:
+                client_socket, client_address = self.server_socket.accept()
+            except socket.error:
+                break
+            client = EibdClient(client_socket, client_address)
+            self.clients_lock.acquire()
+            self.clients = self.clients + (client,)
+            self.clients_lock.release()
+            handler = threading.Thread(target=self.handle, args=(client,))
+            handler.setDaemon(True)
+            handler.start()
+
+
+if __name__ == '__main__':
+    # python fake_eibd.py [port [group_address=hex_apdu_data ...]] : the given values answer the group reads
+    usage = "usage : python fake_eibd.py [port [group_address=hex_apdu_data ...]]"
+    eibd = FakeEibd(port=int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_PORT)
+    eibd.cache_enabled = True
+    for arg in sys.argv[2:]:
+        group_address, _, value = arg.partition('=')
+        raw = parse_group_address(group_address)
+        try:
+            value = value.decode('hex')
+        except TypeError:
+            value = ''
+        if raw is None or not value:
+            sys.exit("%s\ninvalid group value : %s" % (usage, arg))
+        eibd.values[raw] = value
+    eibd.run()
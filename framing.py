@@ -0,0 +1,130 @@
+__author__ = 'mlefebvre'
+
+# Line framing of the client streams.
+#
+# TCP doesn't keep the boundaries of the writes : a receive may hold several commands (a client pipelining its
+# commands without waiting for their answers) or a part of one (long command split across segments). The framer
+# extracts every complete command of each receive and keeps the partial one until its end is received.
+
+DEFAULT_FRAMER_SIZE = 65536     # longest command (in bytes) accepted, the receive buffer never grows beyond
+INITIAL_FRAMER_SIZE = 2048      # size (in bytes) of the receive buffer of a new connection
+LINE_END = '\n'
+POLICY_END = '\0'               # the flash policy request (<policy-file-request/>) ends with a null byte instead
+
+
+class LineFramer:
+    """
+    Commands of a client connection. The data are received in a buffer reused between the receives, the complete
+    commands are copied out of it at once and the partial command is moved back to the beginning of the buffer.
+
+    The buffer of a new connection is small (the commands are a few dozen bytes), it is doubled when a partial
+    command fills it and shrunk back once the long command has been handed over. A command longer than max_size is
+    dropped up to its line end and reported as None, so the session can answer it without the framer buffering an
+    unbounded line.
+    """
+
+    def __init__(self, max_size=DEFAULT_FRAMER_SIZE, initial_size=INITIAL_FRAMER_SIZE):
+        self.max_size = max_size                # longest command accepted
+        self.initial_size = min(initial_size, max_size)
+        self.size = 0                           # size of the receive buffer
+        self.buffer = None                      # receive buffer
+        self.view = None                        # view on the receive buffer to receive / copy without slicing it
+        self.tail = 0                           # end of the data received (length of the partial command)
+        self.discarding = False                 # the current command is too long, drop it up to its line end
+        self.resize(self.initial_size)
+
+    def resize(self, size):
+        buf = bytearray(size)
+        if self.tail:
+            buf[0:self.tail] = self.buffer[0:self.tail]
+        self.size = size
+        self.buffer = buf
+        self.view = memoryview(buf)
+
+    def receive(self, sock):
+        """
+        Receive what is available on the socket (socket.error are left to the caller).
+
+        :param sock: the client socket
+        :return: the complete commands received, without their line end (None for a command too long), None when
+                 the client hung up
+        """
+        received = sock.recv_into(self.view[self.tail:])
+        if received == 0:
+            return None
+        return self.extract(received)
+
+    def feed(self, data):
+        """
+        Same as receive, for data read elsewhere.
+
+        :param data: the data read from the client stream
+        :return: the complete commands (see receive)
+        """
+        commands = []
+        while data:
+            count = min(len(data), self.size - self.tail)
+            self.buffer[self.tail:self.tail + count] = data[:count]
+            commands += self.extract(count)
+            data = data[count:]
+        return commands
+
+    def extract(self, received):
+        buf = self.buffer
+        head = 0
+        tail = self.tail + received
+        commands = []
+        # the data before the partial command end have already been scanned
+        end = buf.rfind(LINE_END, self.tail, tail)
+        if end >= 0:
+            # one copy and one split for all the complete commands
+            lines = self.view[0:end].tobytes().split(LINE_END)
+            if self.discarding:
+                del lines[0]
+                self.discarding = False
+            commands = [line.rstrip() for line in lines]
+            head = end + 1
+
+        if head < tail and buf[head] == ord('<') and not self.discarding:
+            end = buf.find(POLICY_END, head, tail)
+            if end >= 0:
+                commands.append(self.view[head:end].tobytes())
+                head = end + 1
+
+        if head == tail:
+            tail = 0
+        elif head:
+            # move the partial command to the beginning of the buffer
+            buf[0:tail - head] = buf[head:tail]
+            tail -= head
+        elif tail == self.size and (self.discarding or self.size == self.max_size):
+            # the whole buffer is a single partial command, too long
+            if not self.discarding:
+                commands.append(None)
+                self.discarding = True
+            tail = 0
+        self.tail = tail
+
+        if tail == self.size:
+            self.resize(min(self.size * 2, self.max_size))
+        elif not tail and self.size > self.initial_size:
+            self.resize(self.initial_size)
+        return commands
+
+
+if __name__ == '__main__':
+    # python framing.py : check the framing of pipelined, split, too long and flash policy commands
+    framer = LineFramer(16, 4)
+    assert framer.feed("TE\nRE 1/2/3\r\nRE 1") == ["TE", "RE 1/2/3"]
+    assert framer.feed("/2/4\n") == ["RE 1/2/4"]
+    assert framer.feed("RE 1/2/3,1/2/4,1/2/5\nTE\n") == [None, "TE"]
+    assert framer.feed("RE 1/2/3,1/2/4,1/2/5,1/2/6,1/2/7") == [None]
+    assert framer.feed("\nTE") == [] and framer.feed("\n") == ["TE"]
+    assert framer.feed("<policy-file-request/>\0") == [None]
+    framer = LineFramer()
+    assert framer.feed("<policy-file-request/>\0") == ["<policy-file-request/>"]
+    assert framer.feed("TE\n" * 10000) == ["TE"] * 10000
+    command = "RE " + ",".join(["1/2/3"] * 5000)
+    assert framer.feed(command[:20000]) == [] and framer.size > INITIAL_FRAMER_SIZE
+    assert framer.feed(command[20000:] + "\nTE\n") == [command, "TE"] and framer.size == INITIAL_FRAMER_SIZE
+    print "Framer OK"
@@ -0,0 +1,318 @@
+__author__ = 'mlefebvre'
+
+import threading
+import time
+import liblogging
+import metrics
+import EIBConnection
+from provider import EibdWriter
+from value_cache import GroupValueCache, DEFAULT_MAX_AGE
+from subscriptions import SubscriptionIndex, NO_SUBSCRIBER
+from capture import CaptureWriter, DEFAULT_CAPTURE_MAX_SIZE
+from history import GroupHistory, DEFAULT_HISTORY_SIZE
+from pending_reads import PendingReadTable, DEFAULT_READ_TIMEOUT
+from telegram import Telegram, GROUP_RESPONSE, GROUP_WRITE
+from clock import monotonic
+from bus_queue import CoalescingSendQueue, COALESCING_MERGE, TokenBucket, WaitStats
+
+
+DEFAULT_EIBD_ADDRESS = 'ip:127.0.0.1'
+DEFAULT_WRITERS = 1
+DEFAULT_RECONNECT_DELAY = 2
+DEFAULT_BUS_RATE = 20       # telegrams per second sent on the bus line (0 => unlimited)
+DEFAULT_BUS_BURST = 10      # telegrams which can be sent at once after an idle period
+DEFAULT_REAPER_PERIOD = 0.25    # delay (in sec.) between two checks of the pending reads deadlines
+
+BUS_PARSE_FAILURES = metrics.PARSE_FAILURES.child('bus')
+
+
+class BusReader(threading.Thread):
+    """
+    Owns the only listening connection on eibd. Every group telegram is read once from the bus and handed over to
+    the gateway which is responsible to fan it out to the connected clients.
+    """
+
+    def __init__(self, gateway, eibd_addr=DEFAULT_EIBD_ADDRESS, reconnect_delay=DEFAULT_RECONNECT_DELAY):
+        threading.Thread.__init__(self)
+        self.gateway = gateway                      # gateway to hand telegrams over
+        self.eibd_address = eibd_addr               # address of the eibd server
+        self.reconnect_delay = reconnect_delay      # delay (in sec.) between two connection attempts
+        self.eibd_connection = None                 # Eibd connection reference
+        self.connected = False                      # Flag to indicate EIBD connection status
+        self.connections = 0                        # number of connections opened
+        self.is_running = False                     # Flag to indicate if the thread is running or if it has to be stop
+
+    def log(self, message, level=liblogging.INFO, *args):
+        liblogging.log(message, level, *args)
+
+    def connect(self):
+        self.eibd_connection = EIBConnection.EIBConnection()
+        self.eibd_connection.EIBSocketURL(self.eibd_address)
+        self.eibd_connection.EIBOpen_GroupSocket(0)
+        self.connected = True
+        self.connections += 1
+        if self.connections > 1:
+            metrics.EIBD_RECONNECTS.child('reader').inc()
+
+    def disconnect(self):
+        if self.eibd_connection is not None:
+            try:
+                self.eibd_connection.EIBClose()
+            except Exception:
+                pass
+        self.eibd_connection = None
+        self.connected = False
+
+    def stop(self):
+        self.is_running = False
+
+    def run(self):
+        self.log("Bus reader starting on [%s]", liblogging.INFO, self.eibd_address)
+        self.is_running = True
+        while self.is_running:
+            if not self.connected:
+                try:
+                    self.connect()
+                    # telegrams may have been missed while disconnected, forget the values known so far
+                    self.gateway.value_cache.clear()
+                    self.log("Bus reader connected to [%s]", liblogging.INFO, self.eibd_address)
+                except Exception, e:
+                    self.log("Bus reader unable to connect to [%s] : %s", liblogging.ERROR, self.eibd_address, e)
+                    self.disconnect()
+                    time.sleep(self.reconnect_delay)
+                    continue
+
+            try:
+                # all the telegrams received by a single system call
+                telegrams = self.eibd_connection.EIBGetGroup_Src_Frames()
+            except Exception, e:
+                self.log("Bus reader lost the eibd connection : %s", liblogging.ERROR, e)
+                self.disconnect()
+                continue
+
+            if telegrams == -1:
+                self.log("Bus reader failed to read incoming data", liblogging.CRITICAL)
+                self.disconnect()
+                continue
+
+            timestamp = monotonic()
+            metrics.TELEGRAMS_RECEIVED.inc(len(telegrams))
+            for src, dest, apdu in telegrams:
+                if len(apdu) < 2:
+                    self.log("Bus reader dropped an invalid packet from %04X to %04X", liblogging.WARNING, src, dest)
+                    BUS_PARSE_FAILURES.inc()
+                    continue
+                # the apdu is a view on the receive buffer, the telegram gets its own copy
+                self.gateway.dispatch(Telegram.from_apdu(src, dest, apdu, timestamp))
+
+        self.disconnect()
+        self.log("Bus reader disconnected from the KNX Bus")
+
+
+class ReadReaper(threading.Thread):
+    """
+    Periodically expire the pending reads whose deadline is over, the gateway tells the sessions concerned. Also
+    flushes the capture of the telegrams so a quiet bus doesn't keep the last ones in the file buffer.
+    """
+
+    def __init__(self, gateway, period=DEFAULT_REAPER_PERIOD):
+        threading.Thread.__init__(self)
+        self.gateway = gateway                      # gateway owning the pending reads
+        self.period = period                        # delay (in sec.) between two checks
+        self.is_running = False
+
+    def stop(self):
+        self.is_running = False
+
+    def run(self):
+        self.is_running = True
+        while self.is_running:
+            time.sleep(self.period)
+            try:
+                self.gateway.expire_reads()
+                self.gateway.flush_capture()
+            except Exception, e:
+                liblogging.log("Unable to expire the pending reads : %s", liblogging.ERROR, e)
+
+
+class BusGateway:
+    """
+    Process wide bridge between the clients and eibd.
+
+    The gateway owns a fixed number of eibd connections whatever the number of connected clients:
+        - one connection used by the bus reader to listen group telegrams,
+        - a small pool of connections used by the writers to send telegrams coming from all the clients.
+
+    The transports of the clients (the listener of each threaded session, the reactor) register themselves and
+    the sessions submit their tasks in the shared write queue. The subscribers of a telegram are resolved by the
+    gateway from the subscription index, as well as the requesters of a response (the sessions waiting for it in
+    the pending reads table) : the telegram is handed over to the transport of each of them only (push_telegram),
+    whatever the number of connected clients. The sessions whose read is not answered in time are told the same
+    way through push_read_timeout.
+    """
+
+    def __init__(self, eibd_addr=DEFAULT_EIBD_ADDRESS, writers=DEFAULT_WRITERS, cache_max_age=DEFAULT_MAX_AGE,
+                 write_coalescing=COALESCING_MERGE, bus_rate=DEFAULT_BUS_RATE, bus_burst=DEFAULT_BUS_BURST,
+                 read_timeout=DEFAULT_READ_TIMEOUT, history_size=DEFAULT_HISTORY_SIZE, capture_path=None,
+                 capture_max_size=DEFAULT_CAPTURE_MAX_SIZE):
+        self.eibd_address = eibd_addr               # address of the eibd server
+        self.value_cache = GroupValueCache(cache_max_age)   # last known value of each group address
+        self.history = GroupHistory(history_size)   # last values of each group address
+        self.capture = None                         # capture of the telegrams, disabled without capture path
+        if capture_path:
+            self.capture = CaptureWriter(capture_path, capture_max_size)
+        self.subscriptions = SubscriptionIndex()    # sessions watching each group address
+        self.pending_reads = PendingReadTable(read_timeout)    # sessions waiting for the answer of a read
+        self.write_queue = CoalescingSendQueue(mode=write_coalescing)  # queue shared by all clients to write on the bus
+        self.sessions = ()                          # registered transports (copy on write, read without lock)
+        self.sessions_lock = threading.RLock()      # lock on the transports registration
+        self.bucket = TokenBucket(bus_rate, bus_burst)  # telegram budget of the bus line
+        self.wait_stats = WaitStats()               # time spent by the tasks before reaching the bus
+        self.echoes = metrics.EchoLatency(metrics.WRITE_ECHO_LATENCY)  # writes sent, waiting to be seen on the bus
+        self.reader = BusReader(self, eibd_addr)
+        self.reaper = ReadReaper(self)
+        self.writers = [EibdWriter(self.write_queue, eibd_addr=eibd_addr, bucket=self.bucket, wait_stats=self.wait_stats,
+                                   echoes=self.echoes)
+                        for i in range(max(1, writers))]
+        self.is_running = False
+        self.register_metrics()
+
+    def register_metrics(self):
+        # computed when the metrics are collected
+        metrics.REGISTRY.gauge('konext_queue_depth', "Items waiting in the queues", ('queue',), self.queue_depths)
+        metrics.REGISTRY.gauge('konext_pending_reads', "Group addresses read and waiting for their answer",
+                               callback=lambda: len(self.pending_reads))
+        metrics.REGISTRY.counter('konext_coalesced_tasks_total', "Tasks superseded in the write queue",
+                                 callback=lambda: self.write_queue.coalesced)
+        metrics.REGISTRY.gauge('konext_bus_wait_max_seconds', "Longest time spent by a task before reaching the bus",
+                               callback=lambda: self.wait_stats.max)
+
+    def queue_depths(self):
+        """
+        :return: dict (queue name,) => number of items waiting : the shared write queue, the queues of the threaded
+                 sessions and the inbox of the reactor (the reads waiting for their answer are konext_pending_reads)
+        """
+        depths = {('write',): self.write_queue.qsize(), ('watch',): 0, ('inbox',): 0}
+        for session in self.sessions:
+            if hasattr(session, 'watch_queue'):
+                depths[('watch',)] += session.watch_queue.qsize()
+            elif hasattr(session, 'inbox'):
+                depths[('inbox',)] += len(session.inbox)
+        return depths
+
+    def start(self):
+        self.reader.setDaemon(True)
+        self.reader.start()
+        self.reaper.setDaemon(True)
+        self.reaper.start()
+        for writer in self.writers:
+            writer.setDaemon(True)
+            writer.start()
+        self.is_running = True
+
+    def stop(self):
+        self.is_running = False
+        self.reader.stop()
+        self.reaper.stop()
+        if self.capture is not None:
+            self.capture.close()
+        for writer in self.writers:
+            writer.stop()
+            self.write_queue.put(None)      # wake up the writer so it can exit
+
+    def register(self, session):
+        self.sessions_lock.acquire()
+        if session not in self.sessions:
+            self.sessions = self.sessions + (session,)
+        self.sessions_lock.release()
+
+    def unregister(self, session):
+        self.sessions_lock.acquire()
+        self.sessions = tuple(s for s in self.sessions if s is not session)
+        self.sessions_lock.release()
+
+    def submit(self, task):
+        self.write_queue.put(task)
+
+    def dispatch(self, telegram):
+        """
+        Hand a telegram read on the bus over to the registered sessions, if some of them are concerned by it.
+
+        :param telegram: the telegram (Telegram)
+        """
+        dest = telegram.dest
+        kind = telegram.kind
+        now = time.time()
+        if self.capture is not None:
+            self.capture.record(telegram, now)
+        requesters = NO_SUBSCRIBER
+        if kind == GROUP_WRITE or kind == GROUP_RESPONSE:
+            self.value_cache.update(dest, telegram.format_value())
+            self.history.record(dest, telegram.data(), now)
+            self.echoes.observed(dest, telegram.timestamp)
+            if kind == GROUP_RESPONSE:
+                requesters = self.pending_reads.resolve(dest)
+
+        subscribers = self.subscriptions.subscribers(dest)
+        if requesters:
+            for session in subscribers | requesters:
+                session.transport.push_telegram(session, telegram, session in subscribers, session in requesters)
+        else:
+            for session in subscribers:
+                session.transport.push_telegram(session, telegram, True, False)
+
+    def flush_capture(self):
+        if self.capture is not None:
+            self.capture.flush()
+
+    def expire_reads(self):
+        """
+        Tell the sessions whose read has not been answered in time.
+        """
+        for dest, requesters in self.pending_reads.expire().iteritems():
+            for session in requesters:
+                session.transport.push_read_timeout(session, dest)
+
+
+################################################################################################
+#                                     Process wide gateway                                     #
+################################################################################################
+
+_gateway = None
+_gateway_lock = threading.Lock()
+
+
+def configure(config):
+    """
+    Create and start the process wide gateway from the application configuration.
+
+    :param config: Configuration read from file
+    :return: the gateway
+    """
+    global _gateway
+    _gateway_lock.acquire()
+    try:
+        if _gateway is None:
+            _gateway = BusGateway(config.get('eibd_address', DEFAULT_EIBD_ADDRESS),
+                                  int(config.get('eibd_writers', DEFAULT_WRITERS)),
+                                  float(config.get('cache_max_age', DEFAULT_MAX_AGE)),
+                                  config.get('write_coalescing', COALESCING_MERGE),
+                                  float(config.get('bus_rate', DEFAULT_BUS_RATE)),
+                                  int(config.get('bus_burst', DEFAULT_BUS_BURST)),
+                                  float(config.get('read_timeout', DEFAULT_READ_TIMEOUT)),
+                                  int(config.get('history_size', DEFAULT_HISTORY_SIZE)),
+                                  config.get('capture_path'),
+                                  int(config.get('capture_max_size', DEFAULT_CAPTURE_MAX_SIZE)))
+            _gateway.start()
+        return _gateway
+    finally:
+        _gateway_lock.release()
+
+
+def get_gateway():
+    """
+    :return: the process wide gateway, started with the default configuration if not configured yet
+    """
+    if _gateway is None:
+        return configure({})
+    return _gateway
@@ -0,0 +1,116 @@
+__author__ = 'mlefebvre'
+
+import threading
+from array import array
+
+
+DEFAULT_HISTORY_SIZE = 500  # number of values kept per group address, 0 disables the history
+
+
+class HistoryRing:
+    """
+    Last values of a group address in fixed size arrays used as a ring buffer.
+
+    Each slot holds the timestamp of the value, its length and its bytes (width bytes reserved per slot, the width
+    grows with the longest value seen, which is the size of the DPT of the group address).
+    """
+
+    def __init__(self, capacity, width=1):
+        self.capacity = capacity                    # number of slots
+        self.width = width                          # bytes reserved per value
+        self.stamps = array('d', [0.0]) * capacity  # timestamp of each value
+        self.lengths = array('B', [0]) * capacity   # length of each value
+        self.data = bytearray(capacity * width)     # bytes of the values, width bytes per slot
+        self.head = 0                               # slot of the next value
+        self.count = 0                              # number of slots used
+
+    def _widen(self, width):
+        data = bytearray(self.capacity * width)
+        for slot in xrange(self.capacity):
+            length = self.lengths[slot]
+            data[slot * width:slot * width + length] = self.data[slot * self.width:slot * self.width + length]
+        self.data = data
+        self.width = width
+
+    def append(self, timestamp, value):
+        """
+        :param timestamp: time of the value (seconds since the epoch)
+        :param value: raw value (str)
+        """
+        length = len(value)
+        if length > self.width:
+            self._widen(length)
+        slot = self.head
+        offset = slot * self.width
+        self.data[offset:offset + length] = value
+        self.lengths[slot] = length
+        self.stamps[slot] = timestamp
+        self.head = (slot + 1) % self.capacity
+        if self.count < self.capacity:
+            self.count += 1
+
+    def values(self, last=None, since=None):
+        """
+        :param last: only the last values
+        :param since: only the values seen since the timestamp (included)
+        :return: list of (timestamp, raw value), oldest first
+        """
+        count = self.count
+        if last is not None:
+            count = min(count, last)
+        start = self.head - count
+        result = []
+        for i in xrange(start, start + count):
+            slot = i % self.capacity
+            timestamp = self.stamps[slot]
+            if since is not None and timestamp < since:
+                continue
+            offset = slot * self.width
+            result.append((timestamp, str(self.data[offset:offset + self.lengths[slot]])))
+        return result
+
+
+class GroupHistory:
+    """
+    Process wide history of the values of each group address, fed by the bus reader with every write / response
+    telegram observed on the bus.
+    """
+
+    def __init__(self, size=DEFAULT_HISTORY_SIZE):
+        self.size = size                # number of values kept per group address
+        self.rings = {}                 # raw group address => HistoryRing
+        self.lock = threading.Lock()    # serialize the bus reader and the queries of the sessions
+
+    def record(self, group_address, value, timestamp):
+        """
+        :param group_address: raw group address
+        :param value: raw value (str)
+        :param timestamp: time the value has been observed on the bus (seconds since the epoch)
+        """
+        if self.size <= 0:
+            return
+        self.lock.acquire()
+        try:
+            ring = self.rings.get(group_address)
+            if ring is None:
+                ring = self.rings[group_address] = HistoryRing(self.size, max(1, len(value)))
+            ring.append(timestamp, value)
+        finally:
+            self.lock.release()
+
+    def values(self, group_address, last=None, since=None):
+        """
+        :param group_address: raw group address
+        :return: list of (timestamp, raw value), oldest first (see HistoryRing.values)
+        """
+        self.lock.acquire()
+        try:
+            ring = self.rings.get(group_address)
+            if ring is None:
+                return []
+            return ring.values(last, since)
+        finally:
+            self.lock.release()
+
+    def __len__(self):
+        return len(self.rings)
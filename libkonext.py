@@ -19,6 +19,7 @@ WATCH = "WE"
 UNWATCH = "UE"
 TEST = "TE"
 BYE = "QE"
+HISTORY = "HE"
 
 HELO_PREFIX = "CH"
 HELO_SUFFIX = ",EADP/0.1"
@@ -34,6 +35,10 @@ SEND_ACK = "sE"
 TEST_ACK = "cE"
 END_ACK = "aE"
 BYE_ACK = "qE"
+HISTORY_ACK = "hE"
+
+HISTORY_LAST = ":"      # HE 1/2/3:50 => last 50 values of 1/2/3
+HISTORY_SINCE = "@"     # HE 1/2/3@1420070400 => values of 1/2/3 since the timestamp
 
 READING_PROCESS = 'groupcacheread'
 SENDING_PROCESS = 'groupsocketsend'
@@ -71,6 +76,7 @@ def get_body(cmd):
         SEND: cmd.split(' ').pop(),
         WATCH: cmd.split(' ').pop(),
         UNWATCH: cmd.split(' ').pop(),
+        HISTORY: cmd.split(' ').pop(),
         BYE: ''
     }[header]
 
@@ -91,6 +97,7 @@ def get_command_kind(command_header):
         "WE": KNX_RESPONSE_FLAG,
         "UE": KNX_NONE,
         "TE": KNX_NONE,
+        "HE": KNX_NONE,
         "QE": KNX_NONE
     }[command_header]
 
@@ -102,6 +109,7 @@ def get_ack(statement):
         WATCH: WATCH_ACK,
         UNWATCH: UNWATCH_ACK,
         TEST: TEST_ACK,
+        HISTORY: HISTORY_ACK,
         BYE: BYE_ACK
     }[statement]
 
@@ -117,4 +125,5 @@ if __name__ == '__main__':
     assert get_ack(UNWATCH) == WATCH_ACK
     assert get_ack(TEST) == TEST_ACK
     assert get_ack(BYE) == BYE_ACK
+    assert get_ack(HISTORY) == HISTORY_ACK
     print "Done !\n"
\ No newline at end of file
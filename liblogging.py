@@ -14,8 +14,28 @@ ERROR = logging.ERROR
 CRITICAL = logging.CRITICAL
 FATAL = logging.FATAL
 
+threshold = logging.NOTSET      # messages below this level are dropped by log() before any formatting
 
-def init_logger(server_log_format, server_logging_name, server_logging_file, max_logfile_size=1000000, nb_logfile=5):
+
+def get_level(name):
+    """
+    :param name: name (DEBUG, INFO ...) or number of a level
+    :return: the level (int)
+    """
+    if isinstance(name, int):
+        return name
+    name = str(name).strip().upper()
+    if name.isdigit():
+        return int(name)
+    level = logging.getLevelName(name)
+    if not isinstance(level, int):
+        raise ValueError("unknown log level %s" % name)
+    return level
+
+
+def init_logger(server_log_format, server_logging_name, server_logging_file, max_logfile_size=1000000, nb_logfile=5,
+                level=DEBUG):
+    global threshold
     # initialize logging ...
     # logging.basicConfig(format=server_log_format, stream=sys.stdout, level=logging.DEBUG)
     logging.basicConfig(format=server_log_format,  level=logging.DEBUG, filename=server_logging_file)
@@ -34,14 +54,28 @@ def init_logger(server_log_format, server_logging_name, server_logging_file, max
     ch.setFormatter(formatter)
     logger.addHandler(ch)
 
+    logger.setLevel(level)
+    threshold = level
     return logger
 
 
-def log(message, level=INFO):
+def enabled(level):
+    """
+    :param level: level of a message
+    :return: True if a message of this level would be logged, to skip the work only needed by the message
+    """
+    return logger is not None and level >= threshold
+
+
+def log(message, level=INFO, *args):
     """
+    Log a message, the arguments are merged into the message (message % args) only if the level is enabled : give
+    them as arguments instead of formatting the message on the hot paths.
 
-    :param message:
-    :param level:
+    :param message: message, or format of the message if args are given
+    :param level: level of the message
+    :param args: arguments of the format
     """
-    if None != logger:
-        logger.log(level, message)
\ No newline at end of file
+    if logger is None or level < threshold:
+        return
+    logger.log(level, message, *args)
\ No newline at end of file
@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+__author__ = 'mlefebvre'
+
+# EADP load generator : many concurrent sessions sending a mix of RE / SE / WE commands at a given rate.
+#
+# usage : python loadgen.py [options]
+#
+# Each session waits for the answer of its command before sending the next one (one command in flight), the latency
+# is the delay between the command and its last expected answer (a dE line per group address). All the sessions are
+# multiplexed on one poller so the generator itself doesn't need one thread per client.
+#
+# With --eibd-port an eibd stand-in answering the reads of the group addresses is started, konext has to be started
+# with eibd_address=ip:127.0.0.1:<eibd-port>. Several client counts (--clients 10,50,200) are run one after the other
+# to find the point where the server collapses.
+
+import errno
+import optparse
+import random
+import socket
+import time
+import libkonext
+from address import format_group_address
+from reactor import Poller, READ_EVENTS, ERROR_EVENTS
+
+
+DEFAULT_MIX = 'RE:5,SE:3,WE:2'
+CONNECT_TIMEOUT = 5.0           # delay (in sec.) to connect and log in
+POLL_TIMEOUT = 0.005
+
+# states of a session
+CONNECTING = 0                  # waiting for the banner
+LOGGING_IN = 1                  # helo sent, waiting for its acknowledgment
+READY = 2                       # waiting for the time of the next command
+WAITING = 3                     # command sent, waiting for its answers
+CLOSED = 4
+QUITTING = 5                    # end of the run, waiting for the server to close the session
+QUIT_TIMEOUT = 2.0              # delay (in sec.) given to the server to close the sessions
+
+
+def percentile(values, ratio):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * ratio))]
+
+
+def parse_mix(mix):
+    """
+    :param mix: weights of the commands : RE:5,SE:3,WE:2
+    :return: list of the command headers, each one repeated according to its weight
+    """
+    headers = []
+    for item in mix.split(','):
+        header, weight = item.split(':')
+        if header not in (libkonext.READ, libkonext.SEND, libkonext.WATCH):
+            raise ValueError("unsupported command %s" % header)
+        headers += [header] * int(weight)
+    return headers
+
+
+class CommandStats:
+    """
+    Outcome of the commands of one kind.
+    """
+
+    def __init__(self):
+        self.sent = 0
+        self.answered = 0
+        self.errors = 0             # nE answers
+        self.dropped = 0            # not answered in time, or session closed while waiting
+        self.latencies = []         # delay (in sec.) of the answered commands
+
+    def line(self, name, duration):
+        latencies = sorted(self.latencies)
+        return "%-6s sent %7d  ok %7d  err %6d  drop %6d  %8.1f/s  " \
+               "p50 %8.2fms  p90 %8.2fms  p99 %8.2fms  max %8.2fms" % (
+                   name, self.sent, self.answered, self.errors, self.dropped, self.answered / duration,
+                   percentile(latencies, 0.50) * 1e3, percentile(latencies, 0.90) * 1e3,
+                   percentile(latencies, 0.99) * 1e3, latencies[-1] * 1e3 if latencies else 0.0)
+
+
+class LoadSession:
+    """
+    One EADP client of the load generator, driven by the LoadGenerator poll loop.
+    """
+
+    def __init__(self, generator, name):
+        self.generator = generator
+        self.name = name
+        self.socket = socket.create_connection(generator.server, CONNECT_TIMEOUT)
+        self.socket.setblocking(0)
+        self.fd = self.socket.fileno()
+        self.data = ''
+        self.state = CONNECTING
+        self.started_at = time.time()
+        self.next_at = 0.0          # time of the next command
+        self.header = None          # header of the command in flight
+        self.expected = set()       # group addresses still expected for the command in flight
+        self.sent_at = 0.0
+
+    def send(self, line):
+        try:
+            self.socket.sendall(line + "\n")
+        except socket.error, e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self.generator.disconnects += 1
+                self.close()
+                return
+            # the server doesn't keep up, the command waits in the generator
+            self.socket.setblocking(1)
+            self.socket.sendall(line + "\n")
+            self.socket.setblocking(0)
+
+    def send_command(self, now):
+        generator = self.generator
+        self.header = random.choice(generator.mix)
+        indexes = random.sample(generator.addresses, generator.batch)
+        addresses = [format_group_address(i) for i in indexes]
+        if self.header == libkonext.SEND:
+            body = ','.join("%s=%02X" % (a, random.randint(0, 255)) for a in addresses)
+        else:
+            body = ','.join(addresses)
+        self.expected = set(addresses)
+        self.sent_at = now
+        self.state = WAITING
+        generator.stats[self.header].sent += 1
+        self.send("%s %s" % (self.header, body))
+
+    def complete(self, now, error=False):
+        stats = self.generator.stats[self.header]
+        if error:
+            stats.errors += 1
+        else:
+            stats.answered += 1
+            stats.latencies.append(now - self.sent_at)
+        self.state = READY
+        self.next_at = max(self.next_at + self.generator.period, now) if self.generator.period else now
+
+    def handle_line(self, line, now):
+        if self.state == QUITTING:
+            return
+        if self.state == CONNECTING:
+            if line.startswith(libkonext.TEST_ACK):
+                self.state = LOGGING_IN
+                self.send("%s %s, %s" % (libkonext.HELO_PREFIX, self.name, libkonext.HELO_PROTO))
+        elif self.state == LOGGING_IN:
+            if line.startswith(libkonext.HELO_ACK):
+                self.generator.logins.append(now - self.started_at)
+                self.state = READY
+                self.next_at = now + random.random() * self.generator.period
+        elif line.startswith("nE "):
+            if self.state == WAITING:
+                self.complete(now, error=True)
+            else:
+                self.generator.unexpected += 1
+        elif line.startswith(libkonext.READ_ACK + " ") and '=' in line:
+            address = line[3:].split('=', 1)[0]
+            if self.state == WAITING and address in self.expected:
+                self.expected.discard(address)
+                if not self.expected:
+                    self.complete(now)
+            else:
+                # value of a watched group address, or late answer
+                self.generator.unsolicited += 1
+        elif line != libkonext.END_ACK:
+            self.generator.unexpected += 1
+
+    def receive(self, now):
+        try:
+            received = self.socket.recv(65536)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            received = ''
+        if not received:
+            if self.state != QUITTING:
+                self.generator.disconnects += 1
+            self.close()
+            return
+        lines = (self.data + received).split("\n")
+        self.data = lines.pop()
+        for line in lines:
+            self.handle_line(line, now)
+
+    def tick(self, now):
+        if self.state == READY and now >= self.next_at:
+            self.send_command(now)
+        elif self.state == WAITING and now - self.sent_at > self.generator.timeout:
+            self.generator.stats[self.header].dropped += 1
+            self.state = READY
+            self.next_at = now
+        elif self.state in (CONNECTING, LOGGING_IN) and now - self.started_at > CONNECT_TIMEOUT:
+            self.generator.login_failures += 1
+            self.close()
+
+    def quit(self):
+        # closing the socket with answers not read yet would reset the connection, the server closes it instead
+        if self.state == WAITING:
+            # cut by the end of the run, not counted
+            self.generator.stats[self.header].sent -= 1
+        self.state = QUITTING
+        self.send("quit")
+
+    def close(self):
+        if self.state == CLOSED:
+            return
+        if self.state == WAITING:
+            self.generator.stats[self.header].dropped += 1
+        self.state = CLOSED
+        self.generator.disconnected(self)
+        self.socket.close()
+
+
+class LoadGenerator:
+    """
+    Run a number of sessions during a given time and collect the outcome of their commands.
+    """
+
+    def __init__(self, server, mix, rate, addresses, batch=1, timeout=5.0):
+        self.server = server                # (host, port) of konext
+        self.mix = mix                      # command headers to pick from (see parse_mix)
+        self.period = 1.0 / rate if rate > 0 else 0.0   # delay (in sec.) between the commands of a session
+        self.addresses = addresses          # raw group addresses used by the commands
+        self.batch = batch                  # group addresses per command
+        self.timeout = timeout              # delay (in sec.) after which a command is dropped
+        self.poller = None
+        self.sessions = {}                  # fd => LoadSession
+        self.reset()
+
+    def reset(self):
+        self.stats = dict((header, CommandStats()) for header in set(self.mix))
+        self.logins = []                    # login delay (in sec.) of each session
+        self.connect_failures = 0
+        self.login_failures = 0
+        self.disconnects = 0                # sessions closed by the server
+        self.unsolicited = 0                # dE lines not answering the command in flight (watches, late answers)
+        self.unexpected = 0                 # other lines
+
+    def disconnected(self, session):
+        if self.sessions.pop(session.fd, None) is not None:
+            self.poller.unregister(session.fd)
+
+    def run(self, clients, duration):
+        """
+        :param clients: number of sessions
+        :param duration: time (in sec.) of the run, logins included
+        :return: actual duration of the run
+        """
+        self.reset()
+        self.poller = Poller()
+        for i in xrange(clients):
+            try:
+                session = LoadSession(self, "load%d" % i)
+            except socket.error:
+                self.connect_failures += 1
+                continue
+            self.sessions[session.fd] = session
+            self.poller.register(session.fd, READ_EVENTS | ERROR_EVENTS)
+
+        started_at = time.time()
+        end = started_at + duration
+        while self.sessions and time.time() < end:
+            for fd, events in self.poller.poll(POLL_TIMEOUT):
+                session = self.sessions.get(fd)
+                if session is not None:
+                    session.receive(time.time())
+            now = time.time()
+            for session in self.sessions.values():
+                session.tick(now)
+
+        duration = time.time() - started_at
+
+        for session in self.sessions.values():
+            session.quit()
+        end = time.time() + QUIT_TIMEOUT
+        while self.sessions and time.time() < end:
+            for fd, events in self.poller.poll(POLL_TIMEOUT):
+                session = self.sessions.get(fd)
+                if session is not None:
+                    session.receive(time.time())
+        for session in self.sessions.values():
+            session.socket.close()
+        self.sessions = {}
+        return duration
+
+    def report(self, clients, duration):
+        logins = sorted(self.logins)
+        print "%d clients : %d logged in (p99 %.1fms), %d refused, %d login failures, %d disconnected, " \
+              "%d unsolicited / %d unexpected lines" % (
+                  clients, len(logins), percentile(logins, 0.99) * 1e3, self.connect_failures, self.login_failures,
+                  self.disconnects, self.unsolicited, self.unexpected)
+        for header in sorted(self.stats):
+            print "  " + self.stats[header].line(header, duration)
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option('--server', default='127.0.0.1:1100', help="address of konext (host:port)")
+    parser.add_option('--clients', default='10,50,100', help="numbers of concurrent sessions, run one after the other")
+    parser.add_option('--duration', type='float', default=10.0, help="duration (in sec.) of each run")
+    parser.add_option('--rate', type='float', default=2.0, help="commands per second per session, 0 => no pause")
+    parser.add_option('--mix', default=DEFAULT_MIX, help="weights of the commands (default %s)" % DEFAULT_MIX)
+    parser.add_option('--addresses', type='int', default=200, help="number of group addresses used")
+    parser.add_option('--batch', type='int', default=1, help="group addresses per command")
+    parser.add_option('--timeout', type='float', default=5.0, help="delay (in sec.) after which a command is dropped")
+    parser.add_option('--eibd-port', type='int', help="start an eibd stand-in answering the reads on this port")
+    parser.add_option('--wait', type='float', default=5.0, help="delay (in sec.) given to konext to connect to it")
+    options, args = parser.parse_args()
+
+    addresses = range(0x0801, 0x0801 + options.addresses)
+    if options.eibd_port is not None:
+        from fake_eibd import FakeEibd
+        eibd = FakeEibd(port=options.eibd_port)
+        for address in addresses:
+            eibd.values[address] = chr(address & 0xff)
+        eibd.setDaemon(True)
+        eibd.start()
+        print "eibd stand-in listening on %s, waiting for konext" % eibd.url()
+        time.sleep(options.wait)
+
+    host, port = options.server.rsplit(':', 1)
+    generator = LoadGenerator((host, int(port)), parse_mix(options.mix), options.rate, addresses,
+                              min(options.batch, len(addresses)), options.timeout)
+    for clients in [int(count) for count in options.clients.split(',')]:
+        duration = generator.run(clients, options.duration)
+        generator.report(clients, duration)
@@ -0,0 +1,247 @@
+__author__ = 'mlefebvre'
+
+import bisect
+import threading
+import BaseHTTPServer
+import liblogging
+
+
+DEFAULT_METRICS_ADDRESS = '127.0.0.1'
+DEFAULT_METRICS_PORT = 0        # port of the HTTP endpoint, 0 disables it
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# bounds (in sec.) of the latency buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                             for name, value in zip(names, values))
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+
+class Counter:
+    """
+    Monotonic count. The increments are not locked to keep them cheap on the hot paths : two threads incrementing
+    the same counter at the very same time may rarely lose one increment, which is fine for monitoring.
+    """
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=(), callback=None):
+        self.name = name
+        self.help = help
+        self.labels = labels            # label names, the values are given to child()
+        self.callback = callback        # callable returning the value (or a dict label values => value), it is
+                                        # called when the metrics are collected : no cost at all on the hot paths
+        self.value = 0
+        self.children = {}              # label values => Counter
+
+    def inc(self, count=1):
+        self.value += count
+
+    def child(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            child = self.children.setdefault(values, Counter(self.name, self.help))
+        return child
+
+    def samples(self):
+        if self.callback is not None:
+            value = self.callback()
+            if not self.labels:
+                return [(self.name, '', value)]
+            return [(self.name, format_labels(self.labels, values), v) for values, v in sorted(value.items())]
+        if not self.labels:
+            return [(self.name, '', self.value)]
+        return [(self.name, format_labels(self.labels, values), child.value)
+                for values, child in sorted(self.children.items())]
+
+
+class Gauge(Counter):
+    """
+    Value which goes up and down.
+    """
+
+    kind = 'gauge'
+
+    def dec(self, count=1):
+        self.value -= count
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram:
+    """
+    Distribution of observed values in cumulative buckets (Prometheus histogram).
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.bounds = list(buckets)
+        self.counts = [0] * (len(self.bounds) + 1)     # per bucket (not cumulative), the last one is +Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def samples(self):
+        samples = []
+        total = 0
+        for bound, count in zip(self.bounds + [float('inf')], self.counts):
+            total += count
+            samples.append((self.name + '_bucket', '{le="%s"}' % format_value(float(bound)), total))
+        samples.append((self.name + '_sum', '', self.sum))
+        samples.append((self.name + '_count', '', total))
+        return samples
+
+
+class Registry:
+    """
+    Named metrics of the process, rendered in the Prometheus text format.
+    """
+
+    def __init__(self):
+        self.metrics = {}               # name => metric
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        """
+        Register a metric, it replaces a metric of the same name (the gateway registers its gauges each time it is
+        created).
+        """
+        self.lock.acquire()
+        self.metrics[metric.name] = metric
+        self.lock.release()
+        return metric
+
+    def counter(self, name, help, labels=(), callback=None):
+        return self.register(Counter(name, help, labels, callback))
+
+    def gauge(self, name, help, labels=(), callback=None):
+        return self.register(Gauge(name, help, labels, callback))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, buckets))
+
+    def render(self):
+        self.lock.acquire()
+        metrics = sorted(self.metrics.items())
+        self.lock.release()
+        lines = []
+        for name, metric in metrics:
+            try:
+                samples = metric.samples()
+            except Exception, e:
+                liblogging.log("Unable to collect the metric %s : %s", liblogging.WARNING, name, e)
+                continue
+            lines.append("# HELP %s %s" % (name, metric.help))
+            lines.append("# TYPE %s %s" % (name, metric.kind))
+            for sample, labels, value in samples:
+                lines.append("%s%s %s" % (sample, labels, format_value(value)))
+        return "\n".join(lines) + "\n"
+
+
+class EchoLatency:
+    """
+    Delay between a write sent to eibd and the first write / response of the same group address seen back on the bus
+    (the answer to the read following each SE, or the device confirming the value).
+    """
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.sent_at = {}               # raw group address => time the last write has been sent (monotonic clock)
+
+    def sent(self, dest, timestamp):
+        self.sent_at[dest] = timestamp
+
+    def observed(self, dest, timestamp):
+        if self.sent_at:
+            sent_at = self.sent_at.pop(dest, None)
+            if sent_at is not None:
+                self.histogram.observe(timestamp - sent_at)
+
+
+################################################################################################
+#                                     Process wide metrics                                     #
+################################################################################################
+
+REGISTRY = Registry()
+
+CONNECTED_CLIENTS = REGISTRY.gauge('konext_connected_clients', "Client connections currently open")
+TELEGRAMS_RECEIVED = REGISTRY.counter('konext_telegrams_received_total', "Group telegrams read on the bus")
+TELEGRAMS_SENT = REGISTRY.counter('konext_telegrams_sent_total', "Group telegrams sent on the bus")
+EIBD_RECONNECTS = REGISTRY.counter('konext_eibd_reconnects_total', "Connections to eibd opened again after a loss",
+                                   ('connection',))
+PARSE_FAILURES = REGISTRY.counter('konext_parse_failures_total', "Client commands or bus packets rejected",
+                                  ('source',))
+SLOW_CLIENTS_CLOSED = REGISTRY.counter('konext_slow_clients_closed_total',
+                                      "Client connections closed because their pending output exceeded its limit")
+WRITE_ECHO_LATENCY = REGISTRY.histogram('konext_write_echo_latency_seconds',
+                                        "Delay between a write sent to eibd and its group address seen on the bus")
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.registry.render()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        liblogging.log("Metrics endpoint : " + format, liblogging.DEBUG, *args)
+
+
+class MetricsServer(threading.Thread):
+    """
+    HTTP endpoint serving the metrics of the registry (GET /metrics).
+    """
+
+    def __init__(self, address=DEFAULT_METRICS_ADDRESS, port=DEFAULT_METRICS_PORT, registry=REGISTRY):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.server = BaseHTTPServer.HTTPServer((address, port), MetricsHandler)
+        self.server.registry = registry
+        self.address, self.port = self.server.server_address
+
+    def stop(self):
+        self.server.shutdown()
+
+    def run(self):
+        liblogging.log("Metrics endpoint listening on [%s:%d]", liblogging.INFO, self.address, self.port)
+        self.server.serve_forever()
+
+
+def configure(config):
+    """
+    Start the metrics endpoint if a port is configured.
+
+    :param config: Configuration read from file
+    :return: the metrics server, None if disabled
+    """
+    port = int(config.get('metrics_port') or DEFAULT_METRICS_PORT)
+    if port <= 0:
+        return None
+    server = MetricsServer(config.get('metrics_address') or DEFAULT_METRICS_ADDRESS, port)
+    server.start()
+    return server
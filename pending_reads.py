@@ -0,0 +1,97 @@
+__author__ = 'mlefebvre'
+
+import threading
+from clock import monotonic
+from subscriptions import NO_SUBSCRIBER
+
+
+DEFAULT_READ_TIMEOUT = 5.0  # delay (in sec.) given to the bus to answer a read before the client gets an error
+
+
+class PendingReadTable:
+    """
+    Process wide table of the reads sent on the bus and still waiting for an answer : raw group address => sessions
+    which asked for it, with the deadline of each one.
+
+    A response telegram is routed only to the sessions waiting for the value of its group address (all of them,
+    the reads of the same address are coalesced on the bus). The sessions whose deadline is over are reported by
+    expire so they can be told that their read has timed out, except the quiet ones (the read confirming a write :
+    a write only group address never answers it, which is not an error).
+    """
+
+    def __init__(self, timeout=DEFAULT_READ_TIMEOUT):
+        self.timeout = timeout          # delay (in sec.) before a pending read expires
+        self.pending = {}               # raw group address => {session: (deadline, quiet)}
+        self.lock = threading.Lock()    # serialize the accesses from the sessions, the bus reader and the reaper
+
+    def add(self, session, group_address, quiet=False):
+        """
+        :param session: session waiting for the value
+        :param group_address: raw group address read on the bus
+        :param quiet: True if the session is not told when the read times out
+        """
+        deadline = monotonic() + self.timeout
+        self.lock.acquire()
+        try:
+            waiting = self.pending.setdefault(group_address, {})
+            entry = waiting.get(session)
+            if entry is None:
+                waiting[session] = (deadline, quiet)
+            elif entry[1] and not quiet:
+                # a session already waiting keeps its first deadline, a single response answers both reads
+                waiting[session] = (entry[0], False)
+        finally:
+            self.lock.release()
+
+    def resolve(self, group_address):
+        """
+        :param group_address: raw group address of a response telegram
+        :return: the sessions which were waiting for the response
+        """
+        self.lock.acquire()
+        try:
+            waiting = self.pending.pop(group_address, None)
+        finally:
+            self.lock.release()
+        if not waiting:
+            return NO_SUBSCRIBER
+        return frozenset(waiting)
+
+    def expire(self, now=None):
+        """
+        Remove the pending reads whose deadline is over.
+
+        :return: dict raw group address => sessions whose read has timed out (the quiet reads are only removed)
+        """
+        if now is None:
+            now = monotonic()
+        expired = {}
+        self.lock.acquire()
+        try:
+            for group_address, waiting in self.pending.items():
+                sessions = [session for session, (deadline, quiet) in waiting.iteritems() if deadline <= now]
+                if not sessions:
+                    continue
+                timed_out = [session for session in sessions if not waiting.pop(session)[1]]
+                if not waiting:
+                    del self.pending[group_address]
+                if timed_out:
+                    expired[group_address] = frozenset(timed_out)
+        finally:
+            self.lock.release()
+        return expired
+
+    def discard(self, session):
+        """
+        Forget the pending reads of a session (session closing).
+        """
+        self.lock.acquire()
+        try:
+            for group_address, waiting in self.pending.items():
+                if waiting.pop(session, None) is not None and not waiting:
+                    del self.pending[group_address]
+        finally:
+            self.lock.release()
+
+    def __len__(self):
+        return len(self.pending)
@@ -13,7 +13,9 @@ import time
 import parser
 import EIBConnection
 import Dpt_Types
+from address import format_group_address, format_physical_address, parse_group_address
 from liblogging import log, DEBUG, INFO, ERROR, CRITICAL, FATAL, WARNING
+from cmd_parser import read_payload
 
 
 class Processor:
@@ -93,19 +95,19 @@ class Processor:
         }[header]
 
     def send_command(self, header, body):
-        log("Trying to send a command from the processor [header:%s, body:%s]" % (header, body), DEBUG)
+        log("Trying to send a command from the processor [header:%s, body:%s]", DEBUG, header, body)
         code = self.__get_code(header)
-        log("Code is [%s]" % code, DEBUG)
+        log("Code is [%s]", DEBUG, code)
         if code == self.READ_COMMAND_CODE:
             log("Return a read command with value FF", DEBUG)
             return "%s=FF" % body
-        log("Unsupported code [%s] for now" % code, WARNING)
+        log("Unsupported code [%s] for now", WARNING, code)
         return None
 
     def read(self, address, flag=0x0):
         self.eibd_connection.EIBOpen_GroupSocket(0)
 
-        _address = self.parser.read_group_address(address)
+        _address = parse_group_address(address)
 
         # Arrange the APDU according to the protocol
         apdu = [flag] * 2
@@ -164,9 +166,9 @@ class Processor:
                     log("Response datagram handled", INFO)
 
                 # do response processing ...
-                physical_address = self.parser._decode_physical_addr(self.src.data)
+                physical_address = format_physical_address(self.src.data)
                 print "addr phy %s" % physical_address
-                group_address = self.parser._decode_group_addr(self.dest.data)
+                group_address = format_group_address(self.dest.data)
                 print "addr group %s" % group_address
                 #response_val = None
                 resp_str = self.parser.format_result(resp)
@@ -178,19 +180,11 @@ class Processor:
 
     def write(self, address, value, flag=0x80):
         self.eibd_connection.EIBOpen_GroupSocket(0)
-        _address = parser.read_group_address(address)
-        _value = parser.read_hex(value)
-        if _value == 0x0:
-            buff_size = 1
-        else:
-            buff_size = 2
-        apdu = [0, flag]
-        if type(_value) == int:
-            apdu.append(_value)
-        elif type(value) == list:
-            apdu = apdu + _value
-        else:
+        _address = parse_group_address(address)
+        payload = read_payload(value)
+        if payload is None:
             raise Exception("invalid Message  %r to %r" % (value, address))
+        apdu = [0, flag] + payload
 
         print "Sending write order ..."
         resp = self.eibd_connection.EIBSendGroup(_address, apdu)
@@ -1,15 +1,16 @@
-from unicodedata import category
 from tasker import Task
-from cmd_parser import Parser
+from address import parse_group_address
+from cmd_parser import Parser, read_payload
 import Dpt_Types
-import re
 import time
 import threading
 import Queue
 import libkonext
 import liblogging
+import metrics
 import EIBConnection
-import warnings
+from bus_queue import is_read_task
+from clock import monotonic
 
 class EibdWriter(threading.Thread):
 
@@ -27,23 +28,25 @@ class EibdWriter(threading.Thread):
     KNX_RESPONSE_FLAG = 0x40
     KNX_WRITE_FLAG = 0x80
 
-    def __init__(self, queue, watch_stack_lock, eibd_addr='ip:127.0.0.1', parser=None):
+    BATCH_SIZE = 64     # maximum number of telegrams sent to eibd with one system call
+
+    def __init__(self, queue, eibd_addr='ip:127.0.0.1', parser=None, bucket=None, wait_stats=None, echoes=None):
         threading.Thread.__init__(self)
         self.queue = queue
-        self.watch_stack_lock = watch_stack_lock
+        self.bucket = bucket                # telegram budget of the bus line (shared by the writers), None => unlimited
+        self.wait_stats = wait_stats        # time spent by the tasks before reaching the bus
+        self.echoes = echoes                # writes sent, waiting to be seen back on the bus (metrics.EchoLatency)
 
         self.queue_wait_time = 0.0
         self.dpt = Dpt_Types.dpt_type(self)
 
-        # may be use for parsing, but normally, the parser should do the job
-        self.AddrRegex = re.compile(r"(?:|(\d+)[\x2F|\x2E])(\d+)[\x2F|\x2E](\d+)$", re.MULTILINE)
-
         #self.eibmutex = threading.RLock()  # no longer use due to queue management implementation
 
         self.eibd_address = eibd_addr
         self.command = None
         self.eibd_connection = None
         self.connected = False
+        self.connections = 0                # number of connections opened
         self.is_running = False
         if parser is None:
             self.parser = Parser()
@@ -57,58 +60,73 @@ class EibdWriter(threading.Thread):
     # --------------------------------------------------------- #
 
     # TODO refactor the logging methods to use a more common / convenient way
-    def log(self, message, level=liblogging.INFO):
-        liblogging.log(message, level)
+    def log(self, message, level=liblogging.INFO, *args):
+        liblogging.log(message, level, *args)
 
-    def debug(self, message):
-        self.log(message, liblogging.DEBUG)
+    def debug(self, message, *args):
+        liblogging.log(message, liblogging.DEBUG, *args)
 
-    def info(self, message):
-        self.log(message)
+    def info(self, message, *args):
+        liblogging.log(message, liblogging.INFO, *args)
 
-    def warn(self, message):
-        self.log(message, liblogging.WARNING)
+    def warn(self, message, *args):
+        liblogging.log(message, liblogging.WARNING, *args)
 
-    def error(self, message):
-        self.log(message, liblogging.ERROR)
+    def error(self, message, *args):
+        liblogging.log(message, liblogging.ERROR, *args)
 
-    def critical(self, message):
-        self.log(message, liblogging.CRITICAL)
+    def critical(self, message, *args):
+        liblogging.log(message, liblogging.CRITICAL, *args)
 
-    def fatal(self, message):
-        self.log(message, liblogging.FATAL)
+    def fatal(self, message, *args):
+        liblogging.log(message, liblogging.FATAL, *args)
 
     # --------------------------------------------------------- #
 
-    def connect(self, eibd_address='ip:127.0.0.1'):
+    def connect(self):
         self.eibd_connection = EIBConnection.EIBConnection()
-        self.remote_socket = self.eibd_connection.EIBSocketURL(eibd_address)
+        self.remote_socket = self.eibd_connection.EIBSocketURL(self.eibd_address)
+        self.eibd_connection.EIBOpen_GroupSocket(0)     # open the group socket once for the connection lifetime
         self.connected = True
+        self.connections += 1
+        if self.connections > 1:
+            metrics.EIBD_RECONNECTS.child('writer').inc()
 
     def disconnect(self):
-        self.eibd_connection.EIBClose()
+        if self.eibd_connection is not None:
+            self.eibd_connection.EIBClose()
         self.remote_socket = None
         self.eibd_connection = None
         self.connected = False
 
+    def build_write(self, address, value, flag=0x80, dest=None):
+        """
+        :param dest: raw group address if already known, the address is read otherwise
+        :return: the (destination, apdu) telegram to write the value on the group address
+        """
+        _address = parse_group_address(address) if dest is None else dest
+        payload = read_payload(value)
+        if _address is None or payload is None:
+            raise ValueError("invalid Message %r to %r" % (value, address))
+        return _address, [0, flag] + payload
+
+    def build_read(self, address, flag=0x00, dest=None):
+        """
+        :param dest: raw group address if already known, the address is read otherwise
+        :return: the (destination, apdu) telegram to read the group address
+        """
+        return parse_group_address(address) if dest is None else dest, [flag] * 2
+
+    def build_telegram(self, task):
+        if is_read_task(task):
+            return self.build_read(task.group_address, dest=task.dest)
+        return self.build_write(task.group_address, task.value, dest=task.dest)
+
     def send_write(self, address, value, flag=0x80):
         if not self.connected:
             self.connect()
 
-        self.eibd_connection.EIBOpen_GroupSocket(0)
-        _address = self.parser.read_group_address(address)
-        _value = self.parser.read_hex(value)
-
-        apdu = [0, flag]
-
-        if type(_value) == int:
-            apdu.append(_value)
-        elif type(value) == list:
-            apdu = apdu + _value
-        else:
-            msg = "invalid Message  %r to %r" % (value, address)
-            self.error(msg)
-            raise Exception(msg)
+        _address, apdu = self.build_write(address, value, flag)
 
         self.debug("Sending write order ...")
         resp = self.eibd_connection.EIBSendGroup(_address, apdu)
@@ -119,96 +137,138 @@ class EibdWriter(threading.Thread):
     def send_read(self, address, flag=0x00):
         if not self.connected:
             self.connect()
-        self.eibd_connection.EIBOpen_GroupSocket(0)
-        _address = self.parser.read_group_address(address)
-        apdu = [flag] * 2
+        _address, apdu = self.build_read(address, flag)
         self.debug("Sending read order ...")
         resp = self.eibd_connection.EIBSendGroup(_address, apdu)
         self.debug("Read order sent !")
 
         self.last_data = self.eibd_connection.data
-        self.debug("data %s" % self.last_data)
+        self.debug("data %s", self.last_data)
         return resp
 
+    def send_batch(self, telegrams):
+        """
+        Send a list of (destination, apdu) telegrams to eibd with a single system call.
+        """
+        if not self.connected:
+            self.connect()
+        return self.eibd_connection.EIBSendGroup_Batch(telegrams)
+
+    def next_tasks(self):
+        """
+        Wait for a task, then take the tasks already queued behind it so they are sent together.
+
+        A token of the bus line budget is taken for each task actually sent, once the task is out of the queue : an
+        idle writer doesn't hold a token and the wake up signal (None) doesn't use one, so the bursts never exceed
+        the configured one whatever the number of writers.
+
+        :return: list of tasks (at most BATCH_SIZE, and no more than the budget of the bus line allows)
+        """
+        task = self.queue.get()
+        if task is None:
+            return [task]
+        if self.bucket is not None:
+            self.bucket.acquire()
+        tasks = [task]
+        while len(tasks) < self.BATCH_SIZE and self.queue.qsize():
+            if self.bucket is not None and not self.bucket.try_acquire():
+                break
+            try:
+                task = self.queue.get_nowait()
+            except Queue.Empty:
+                if self.bucket is not None:
+                    self.bucket.refund()
+                break
+            if task is None and self.bucket is not None:
+                # wake up signal, nothing to send
+                self.bucket.refund()
+            tasks.append(task)
+        return tasks
+
+    def record_waits(self, tasks):
+        if self.wait_stats is None:
+            return
+        now = monotonic()
+        for task in tasks:
+            if task is not None:
+                self.wait_stats.record(now - task.created_at)
+
+    def record_echoes(self, telegrams):
+        if self.echoes is None:
+            return
+        now = monotonic()
+        for dest, apdu in telegrams:
+            if apdu[1] & 0xC0 == self.KNX_WRITE_FLAG:
+                self.echoes.sent(dest, now)
+
     def stop(self):
         self.is_running = False
 
     def run(self):
-        self.info("Running the watcher")
+        self.info("Running the writer")
         self.is_running = True
         while self.is_running:
             try:
                 self.debug("Trying to extract something from the queue")
-                task = self.queue.get()
-            except Queue.Empty, qe:
-                self.debug("Attempt to fetch something from the queue failed due to empty queue, sleeping for 1 sec. [%s]" % qe.message)
-                time.sleep(1)
-                pass
+                tasks = self.next_tasks()
             except BaseException:
                 self.info("Generic error occurred in the request queue processor, but ignoring it ")
-                pass
-            else:
-                self.debug("Starting a new task for the task [%s]" % task.uuid)
-                # do the task.
-                # TODO : if the task is too old, skip it and log information about the case
-                if task.kind in [Task.READ_TASK, libkonext.KNX_READ_FLAG, libkonext.WATCH, libkonext.KNX_RESPONSE_FLAG]:
-                    self.send_read(task.group_address)
-                else:
-                    self.send_write(task.group_address, task.value)
-
+                continue
+
+            # do the tasks.
+            # TODO : if the task is too old, skip it and log information about the case
+            telegrams = []
+            for task in tasks:
+                if task is None:
+                    # wake up signal, nothing to send
+                    continue
+                try:
+                    telegrams.append(self.build_telegram(task))
+                except Exception, e:
+                    self.error("Invalid task [%s] dropped [%s]", task.id, e)
+
+            if telegrams:
+                try:
+                    if self.send_batch(telegrams) == -1:
+                        self.error("eibd refused %d telegram(s) [errno %d]", len(telegrams), self.eibd_connection.errno)
+                    else:
+                        metrics.TELEGRAMS_SENT.inc(len(telegrams))
+                        self.record_waits(tasks)
+                        self.record_echoes(telegrams)
+                        self.debug("%d telegram(s) sent to eibd", len(telegrams))
+                except Exception, e:
+                    # the writer is shared by all the clients, drop the tasks and reconnect on the next ones
+                    self.error("Unable to send %d telegram(s) to eibd, dropping them [%s]", len(telegrams), e)
+                    try:
+                        self.disconnect()
+                    except Exception:
+                        self.connected = False
+                        self.eibd_connection = None
+
+            for task in tasks:
                 self.queue.task_done()
-                self.debug("Task [%s] sent to eibd" % task.uuid)
 
         self.debug("Write thread ended, closing connection")
-        self.disconnect()
+        if self.connected:
+            self.disconnect()
         self.debug("Write thread is now disposed")
 
 
 class EibdWatcher(threading.Thread):
     """
-    Watch the eibd queue and send back response to the client
+    Watch the telegrams handed over by the bus gateway and forward them to the client session
     """
 
-    READ_COMMAND_HEADER = "RE"
-    SEND_COMMAND_HEADER = "SE"
-    WATCH_COMMAND_HEADER = "WE"
-    UNWATCH_COMMAND_HEADER = "UE"
-
-    READ_COMMAND_CODE = 0x1
-    SEND_COMMAND_CODE = 0x2
-    WATCH_COMMAND_CODE = 0x3
-    UNWATCH_COMMAND_CODE = 0x4
-    KNX_READ_FLAG = 0x00
-    KNX_RESPONSE_FLAG = 0x40
-    KNX_WRITE_FLAG = 0x80
-
-    def __init__(self, watch_stack, watch_stack_lock, watch_queue, response_queue, client_address, client_socket):
+    def __init__(self, session, watch_queue):
         """
-        Watching process to handle response from the bus and forward these on the client socket stream
-
-        :param watch_stack: List of address watched
-        :param watch_stack_lock: Lock on the address watched
-        :param watch_queue: Queue of address watched to send back to the client (deprecated)
-        :param response_queue:queue of response to send back to the client (deprecated)
-        :param client_address: client socket address reference
-        :param client_socket: client socket reference
+        Watching process to handle telegrams from the bus and forward these on the client socket stream
+
+        :param session: client session the telegrams are forwarded to
+        :param watch_queue: Queue of telegrams handed over by the bus gateway
         """
         threading.Thread.__init__(self)
-        self.parser = Parser()
-        self.watch_stack = watch_stack              # list of address watched
-        self.watch_stack_lock = watch_stack_lock    # lock on the watch address list to share this between threads
-        self.watch_queue = watch_queue              # queue of watching response to send back to the client socket
-        self.response_queue = response_queue        # queue of response to send back to the client socket
-        self.client_address = client_address        # client address for socket communication
-        self.client_socket = client_socket          # client socket reference
-        self.cache_ok = False                       # Flag to indicate cache status (activated or not) - deprecated
-        self.eibd_connection = None                 # Eibd connection reference
-        self.remote_socket = None                   # Eibd socket connection reference
-        self.connected = False                      # Flag to indicate EIBD connection status
-        self.buff = None                            # Buffer to deal with eibd data
-        self.src = None                             # Source address for eibd transaction (data exchange)
-        self.dest = None                            # Destination address for eibd transaction (data exchange)
-        self.parser = Parser()                      # Reference to the parser to use to parse information (translation)
+        self.session = session                      # client session (protocol state and client socket)
+        self.watch_queue = watch_queue              # queue of telegrams (dest, telegram, watched, requested) read on the bus
         self.is_running = False                     # Flag to indicate if the thread is running or if it has to be stop
 
     # --------------------------------------------------------- #
@@ -218,177 +278,63 @@ class EibdWatcher(threading.Thread):
     # --------------------------------------------------------- #
 
     # TODO refactor the logging methods to use a more common / convenient way
-    def log(self, message, level=liblogging.INFO):
-        liblogging.log(message, level)
+    def log(self, message, level=liblogging.INFO, *args):
+        liblogging.log(message, level, *args)
 
-    def debug(self, message):
-        self.log(message, liblogging.DEBUG)
+    def debug(self, message, *args):
+        liblogging.log(message, liblogging.DEBUG, *args)
 
-    def info(self, message):
-        self.log(message)
+    def info(self, message, *args):
+        liblogging.log(message, liblogging.INFO, *args)
 
-    def warn(self, message):
-        self.log(message, liblogging.WARNING)
+    def warn(self, message, *args):
+        liblogging.log(message, liblogging.WARNING, *args)
 
-    def error(self, message):
-        self.log(message, liblogging.ERROR)
+    def error(self, message, *args):
+        liblogging.log(message, liblogging.ERROR, *args)
 
-    def critical(self, message):
-        self.log(message, liblogging.CRITICAL)
+    def critical(self, message, *args):
+        liblogging.log(message, liblogging.CRITICAL, *args)
 
-    def fatal(self, message):
-        self.log(message, liblogging.FATAL)
+    def fatal(self, message, *args):
+        liblogging.log(message, liblogging.FATAL, *args)
 
     # --------------------------------------------------------- #
 
-    def connect(self, eibd_address='ip:127.0.0.1'):
-        self.eibd_connection = EIBConnection.EIBConnection()
-        self.remote_socket = self.eibd_connection.EIBSocketURL(eibd_address)
-        self.connected = True
-
-    def disconnect(self):
-        self.eibd_connection.EIBClose()
-        self.remote_socket = None
-        self.eibd_connection = None
-        self.connected = False
-
-    def init_cache(self):
+    def push_telegram(self, session, telegram, watched, requested):
         """
-        Initialize cache reading options
+        Called by the bus gateway (reader thread) for each telegram read on the bus the session is concerned by.
+
+        :param session: the session of the listener
+        :param telegram: the telegram (Telegram)
+        :param watched: True if the session watches the destination of the telegram
+        :param requested: True if the session waits for the telegram as the answer of a read
         """
-        warnings.warn("Cache is now deprecated in init_cache", category=DeprecationWarning)
-        self.debug("Eibd listener trying to intialize")
-        if not self.cache_ok:
-            self.debug("Cache opening is required")
-            self.eibd_connection.EIB_Cache_Enable()
-            self.cache_ok = True
-            self.debug("Cache successfully opened")
-        else:
-            self.debug("Cache already opened, skip process")
+        self.watch_queue.put((telegram.dest, telegram, watched, requested))
 
-    def init_data(self):
+    def push_read_timeout(self, session, dest):
         """
-        Initialize data to use with the connection
+        Called by the bus gateway when the read of a group address by the session has not been answered in time.
         """
-        self.debug("Eibd listener intializing data (buffer, source and destination) to handle information published on the eibd connection")
-        self.buff = EIBConnection.EIBBuffer()
-        self.src = EIBConnection.EIBAddr()
-        self.dest = EIBConnection.EIBAddr()
-        self.debug("Eibd listener successfully initialized data (buffer, source and destination)")
-
-    def open_connection(self):
-        self.debug("Eibd listener opening connection")
-        if self.eibd_connection is None:
-            self.connect()
-        self.eibd_connection.EIBOpen_GroupSocket_async(0)
-        self.debug("Eibd listener successfully opened connection")
-
-    def send_back(self, message):
-        self.client_socket.send(message)
-
-    def is_watched_address(self, addr):
-        self.watch_stack_lock.acquire()
-        if addr in self.watch_stack:
-            result = True
-        else:
-            result = False
-        self.watch_stack_lock.release()
-        return result
-
-    def try_to_sendback_to_watchers(self, resp_kind, physical_address, group_address, resp_val_str):
-        if not self.is_watched_address(group_address):
-            return True
-        try:
-            header_ack = libkonext.get_ack(libkonext.READ)
-            response_body = "%s=%s" % (group_address, resp_val_str)
-            message = "%s %s\n" % (header_ack, response_body)
-            self.send_back(message)
-            return True
-        except BaseException:
-            self.error("Eibd listener genreic exception.")
-            return False
-
-    def send_back_response(self, resp_kind, physical_address, group_address, resp_val_str):
-        try:
-            header_ack = libkonext.get_ack(libkonext.READ)
-            response_body = "%s=%s" % (group_address, resp_val_str)
-            end_of_command = libkonext.END_ACK
-            message = "%s %s\n%s\n" % (header_ack, response_body, end_of_command)
-            self.send_back(message)
-            return True
-        except BaseException:
-            self.error("Eibd listener genreic exception.")
-            return False
-
-    def prepare_and_send_response(self, resp_kind, raw_response):
-        try:
-            self.debug("Eibd listener process to dispatch command (response or write handled).")
-            # do response processing ...
-            physical_address = self.parser._decode_physical_addr(self.src.data)
-            self.debug("Eibd listener : source (physical address) of the packet is %s." % physical_address)
-            group_address = self.parser._decode_group_addr(self.dest.data)
-            self.debug("Eibd listener : destination (group address) of the packet is %s." % group_address)
-            resp_val_str = self.parser.format_result(raw_response)
-            self.debug("Eibd listener : response value associate to the packet is %s." % resp_val_str)
-            r = self.send_back_response(resp_kind, physical_address, group_address, resp_val_str)
-            if not r:
-                self.error("Error occurred during sending back the response to the client socket")
-                return False
-            r = self.try_to_sendback_to_watchers(resp_kind, physical_address, group_address, resp_val_str)
-            if not r:
-                self.error("Error occurred during sending back the watching response to the client socket")
-                return False
-            self.debug("Response successfully managed by the process")
-            return True
-        except BaseException:
-            self.error("Eibd listener genreic exception.")
-            return False
+        # no telegram : the read of the destination has timed out
+        self.watch_queue.put((dest, None, False, True))
 
     def stop(self):
         self.is_running = False
+        self.watch_queue.put(None)      # wake up the thread so it can exit
 
     def run(self):
         self.info("Eibd listener starting ...")
-        self.open_connection()
-        self.init_cache()
-        self.init_data()
-        self.info("Eibd listener configuration process sucessfully made")
         self.is_running = True
 
         while self.is_running:
-            self.info("Eibd listener waiting for information")
-            resp_len = self.eibd_connection.EIBGetGroup_Src(self.buff, self.src, self.dest)
-            resp = self.buff.buffer
-            self.info("Eibd listener handling incoming information")
-
-            if resp_len == -1:
-                self.critical("Eibd listener failed to read incoming data")
-            elif resp_len < 2:
-                self.error("Eibd listener handling an invalid packet")
-            elif resp[0] & 0x3 or (resp[1] & 0xC0) == 0xC0:
-                self.error("Eibd listener handling an unknown APDU")
+            telegram = self.watch_queue.get()
+            if telegram is None:
+                continue
+            dest, telegram, watched, requested = telegram
+            if telegram is None:
+                self.session.handle_read_timeout(dest)
             else:
-                self.debug("Eibd listener handling a valid packet, dispatching it.")
-                # manage response type
-                resp_kind = resp[1] & 0xC0
-                if resp_kind == self.KNX_READ_FLAG:
-                    # read is ignored by the process since it doesn't require an action...
-                    self.debug("Eibd listener handling a read datagram, ignoring it.")
-                elif resp_kind == self.KNX_RESPONSE_FLAG or resp_kind == self.KNX_WRITE_FLAG:
-                    if resp_kind == self.KNX_WRITE_FLAG:
-                        self.debug("Eibd listener handling a write datagram.")
-                    else:
-                        self.debug("Eibd listener handling a response datagram.")
-
-                    proc_result = self.prepare_and_send_response(resp_kind, resp)
-                    if not proc_result:
-                        self.debug("Eibd listener handling an error during sending back information to the client socket")
-                    else:
-                        self.debug("Eibd listener successgfully handling and manage request.")
-                else:
-                    self.warn("Eibd listener : Unknown datagram handled")
+                self.session.handle_telegram(telegram, watched, requested)
 
         self.info("Eibd listener Exit from the listening thread")
-        self.disconnect()
-        # TODO : dispose all resources from the current object to be able to reinit it later without redundant call
-        self.info("Eibd listener disconnected from the KNX Bus")
\ No newline at end of file
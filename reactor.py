@@ -0,0 +1,321 @@
+__author__ = 'mlefebvre'
+
+import collections
+import errno
+import os
+import select
+import fcntl
+import socket
+import liblogging
+import metrics
+import gateway
+from framing import LineFramer
+from session import ClientSession
+
+
+# poll flags, select.epoll and select.poll share the same values
+READ_EVENTS = select.POLLIN | select.POLLPRI
+WRITE_EVENTS = select.POLLOUT
+ERROR_EVENTS = select.POLLERR | select.POLLHUP
+
+WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+
+class Poller:
+    """
+    Thin wrapper to use select.epoll when available and fallback on select.poll otherwise.
+    """
+
+    def __init__(self):
+        if hasattr(select, 'epoll'):
+            self._poller = select.epoll()
+            self._timeout_factor = 1        # epoll timeout is expressed in seconds
+        else:
+            self._poller = select.poll()
+            self._timeout_factor = 1000     # poll timeout is expressed in milliseconds
+
+    def register(self, fd, events):
+        self._poller.register(fd, events)
+
+    def modify(self, fd, events):
+        self._poller.modify(fd, events)
+
+    def unregister(self, fd):
+        self._poller.unregister(fd)
+
+    def poll(self, timeout):
+        try:
+            return self._poller.poll(timeout * self._timeout_factor)
+        except (IOError, OSError, select.error), e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+
+
+class ReactorSession(ClientSession):
+    """
+    Client session driven by the reactor. All the I/O on the client socket are non blocking, the data which can't be
+    written immediately are kept in an output buffer flushed when the socket becomes writable.
+
+    A client which doesn't read its socket (while watching busy group addresses) would make the output buffer grow
+    without bound : the session is closed once more than MAX_OUTPUT_SIZE bytes are pending.
+    """
+
+    MAX_OUTPUT_SIZE = 1048576
+
+    def __init__(self, reactor, client_socket, client_address, buffer_size, options=None):
+        ClientSession.__init__(self, client_address, options)
+        self.reactor = reactor                      # reactor driving the session
+        self.transport = reactor                    # the telegrams of the session are handed over to the reactor
+        self.client_socket = client_socket          # client socket information (non blocking)
+        self.fd = client_socket.fileno()            # file descriptor registered in the poller
+        self.framer = LineFramer(buffer_size)       # commands of the client stream (buffer_size : longest command)
+        self.output = collections.deque()           # pending data to write on the client socket
+        self.output_size = 0                        # bytes in the output buffer
+        self.closed = False
+
+    def send_back(self, message):
+        if self.closed:
+            return
+        if self.output:
+            # keep the ordering, the socket is already waiting to be writable
+            self.buffer(message)
+            return
+        try:
+            sent = self.client_socket.send(message)
+        except socket.error, e:
+            if e.args[0] not in WOULD_BLOCK:
+                raise
+            sent = 0
+        if sent < len(message):
+            self.buffer(message[sent:])
+            self.reactor.want_write(self, True)
+
+    def buffer(self, data):
+        if self.output_size + len(data) > self.MAX_OUTPUT_SIZE:
+            metrics.SLOW_CLIENTS_CLOSED.inc()
+            self.warn("Client (%s,%s) doesn't read its data, more than %d bytes pending",
+                      *(self.client_address + (self.MAX_OUTPUT_SIZE,)))
+            self.reactor.close(self)
+            return
+        self.output.append(data)
+        self.output_size += len(data)
+
+    def flush(self):
+        """
+        Write as much pending data as possible on the client socket.
+
+        :return: True if the whole output buffer has been written
+        """
+        while self.output:
+            message = self.output[0]
+            try:
+                sent = self.client_socket.send(message)
+            except socket.error, e:
+                if e.args[0] in WOULD_BLOCK:
+                    return False
+                raise
+            self.output_size -= sent
+            if sent < len(message):
+                self.output[0] = message[sent:]
+                return False
+            self.output.popleft()
+        return True
+
+    def handle_command(self, command):
+        if self.closed:
+            # closed by a previous command of the same receive (see buffer), the following ones are ignored
+            return False
+        return ClientSession.handle_command(self, command)
+
+    def read(self):
+        """
+        :return: the complete commands read from the client socket (empty if nothing is available or the command is
+                 partial), None when the client hang up.
+        """
+        try:
+            return self.framer.receive(self.client_socket)
+        except socket.error, e:
+            if e.args[0] in WOULD_BLOCK:
+                return []
+            raise
+
+
+class Reactor:
+    """
+    Single threaded, event driven transport of the client sessions.
+
+    All the client sockets are multiplexed on one poller (epoll when available) and run the protocol state machine
+    without a thread per connection. The telegrams handed over by the bus gateway are queued by the gateway reader
+    thread and fanned out to the sessions by the reactor thread, which is woken up through a pipe.
+    """
+
+    POLL_TIMEOUT = 1.0
+
+    def __init__(self, server_socket, config, options=None):
+        self.server_socket = server_socket                  # listening socket
+        self.banner = config['msg_banner']                  # message sent on connection
+        self.buffer_size = int(config['buffer_size'])       # sizing the buffer for reading from socket (longest command)
+        self.options = options                              # optional configuration option
+        self.poller = Poller()
+        self.sessions = {}                                  # sessions indexed by file descriptor
+        self.inbox = collections.deque()                    # telegrams handed over by the gateway
+        self.wakeup_pending = False                         # avoid writing on the pipe for each telegram
+        self.wakeup_read, self.wakeup_write = os.pipe()
+        for fd in (self.wakeup_read, self.wakeup_write):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.is_running = False
+        self.gateway = None
+
+    def log(self, message, level=liblogging.INFO, *args):
+        liblogging.log(message, level, *args)
+
+    # --------------------------------------------------------- #
+
+                        #### gateway side ####
+
+    # --------------------------------------------------------- #
+
+    def push_telegram(self, session, telegram, watched, requested):
+        """
+        Called by the bus gateway (reader thread) for each telegram read on the bus a session is concerned by.
+
+        :param session: the session of the reactor
+        :param telegram: the telegram (Telegram)
+        :param watched: True if the session watches the destination of the telegram
+        :param requested: True if the session waits for the telegram as the answer of a read
+        """
+        self.inbox.append((session, telegram.dest, telegram, watched, requested))
+        self.wakeup()
+
+    def push_read_timeout(self, session, dest):
+        """
+        Called by the bus gateway (reaper thread) when the read of a group address by a session has not been
+        answered in time.
+        """
+        self.inbox.append((session, dest, None, False, True))
+        self.wakeup()
+
+    def wakeup(self):
+        if not self.wakeup_pending:
+            self.wakeup_pending = True
+            os.write(self.wakeup_write, 'x')
+
+    def process_inbox(self):
+        try:
+            os.read(self.wakeup_read, 4096)
+        except OSError, e:
+            if e.errno not in WOULD_BLOCK:
+                raise
+        self.wakeup_pending = False
+        while self.inbox:
+            session, dest, telegram, watched, requested = self.inbox.popleft()
+            if session.closed:
+                continue
+            if telegram is None:
+                # no telegram : the read of the destination has timed out
+                session.handle_read_timeout(dest)
+            else:
+                session.handle_telegram(telegram, watched, requested)
+
+    # --------------------------------------------------------- #
+
+                        #### client side ####
+
+    # --------------------------------------------------------- #
+
+    def want_write(self, session, enabled):
+        if session.closed:
+            return
+        events = READ_EVENTS | ERROR_EVENTS
+        if enabled:
+            events |= WRITE_EVENTS
+        self.poller.modify(session.fd, events)
+
+    def accept(self):
+        try:
+            client_socket, client_address = self.server_socket.accept()
+        except socket.error, e:
+            if e.args[0] in WOULD_BLOCK:
+                return
+            raise
+        self.log("Got connection from (%s, %s)", liblogging.INFO, *client_address)
+        client_socket.setblocking(0)
+        session = ReactorSession(self, client_socket, client_address, self.buffer_size, self.options)
+        self.sessions[session.fd] = session
+        self.poller.register(session.fd, READ_EVENTS | ERROR_EVENTS)
+        metrics.CONNECTED_CLIENTS.inc()
+        session.send_back("cE %s\n" % self.banner)
+
+    def close(self, session):
+        if session.closed:
+            return
+        session.closed = True
+        del self.sessions[session.fd]
+        metrics.CONNECTED_CLIENTS.dec()
+        session.dispose_watch_stack()
+        session.dispose_pending_reads()
+        try:
+            self.poller.unregister(session.fd)
+        except (IOError, OSError, KeyError):
+            pass
+        try:
+            session.client_socket.close()
+        except socket.error:
+            pass
+        self.log("Connection closed from (%s,%s).", liblogging.INFO, *session.client_address)
+
+    def handle_readable(self, session):
+        commands = session.read()
+        if commands is None:
+            self.close(session)
+            return
+        if not session.handle_commands(commands):
+            self.close(session)
+
+    def handle_writable(self, session):
+        if session.flush():
+            self.want_write(session, False)
+
+    # --------------------------------------------------------- #
+
+    def stop(self):
+        self.is_running = False
+
+    def run(self):
+        self.server_socket.setblocking(0)
+        self.poller.register(self.server_socket.fileno(), READ_EVENTS)
+        self.poller.register(self.wakeup_read, READ_EVENTS)
+
+        self.gateway = gateway.get_gateway()
+        self.gateway.register(self)
+
+        self.log("Server is now waiting for connection (reactor mode)", liblogging.INFO)
+        server_fd = self.server_socket.fileno()
+        self.is_running = True
+        while self.is_running:
+            for fd, events in self.poller.poll(self.POLL_TIMEOUT):
+                if fd == server_fd:
+                    self.accept()
+                    continue
+                if fd == self.wakeup_read:
+                    self.process_inbox()
+                    continue
+                session = self.sessions.get(fd)
+                if session is None:
+                    continue
+                try:
+                    if events & ERROR_EVENTS and not events & READ_EVENTS:
+                        self.close(session)
+                        continue
+                    if events & WRITE_EVENTS:
+                        self.handle_writable(session)
+                    if events & READ_EVENTS:
+                        self.handle_readable(session)
+                except (socket.error, IOError), e:
+                    self.log("Client (%s,%s) hang up : %s", liblogging.WARNING, *(session.client_address + (e,)))
+                    self.close(session)
+
+        self.gateway.unregister(self)
+        for session in self.sessions.values():
+            self.close(session)
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+__author__ = 'mlefebvre'
+
+# Replay captured bus traffic into the eibd stand-in and measure how far konext falls behind.
+#
+# usage : python replay.py [options] capture.kcap [capture.kcap ...]
+#
+# The stand-in listens on --eibd-port, konext has to be started with eibd_address=ip:127.0.0.1:<eibd-port>.
+# --clients EADP clients connect to konext, watch all the replayed group addresses and measure the delay between
+# the injection of each write / response telegram and its reception.
+
+import collections
+import optparse
+import socket
+import threading
+import time
+from address import format_group_address
+from capture import CaptureReader
+from fake_eibd import FakeEibd, DEFAULT_PORT
+from telegram import GROUP_RESPONSE, GROUP_WRITE
+
+
+MAX_SPEED = 0               # no pacing, the telegrams are injected as fast as possible
+BATCH_SIZE = 256            # telegrams injected at once
+WATCH_CHUNK = 40            # group addresses per watch command
+DRAIN_TIMEOUT = 10.0        # delay (in sec.) given to konext to deliver the last telegrams
+
+
+def percentile(values, ratio):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * ratio))]
+
+
+class FanoutProbe(threading.Thread):
+    """
+    EADP client watching group addresses and measuring the delay between the injection of a value on the bus and its
+    reception.
+    """
+
+    def __init__(self, host, port, name):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.name = name
+        self.client_socket = socket.create_connection((host, port))
+        self.expected = {}                          # group address => deque of (value, injection time)
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.lock.acquire()
+        self.expected.clear()
+        self.pending = 0                            # values injected and not received yet
+        self.lags = []                              # delay (in sec.) of each value received
+        self.lost = 0                               # values never received (a newer value of the address arrived)
+        self.lock.release()
+
+    def login(self, group_addresses):
+        self.client_socket.sendall("CH %s, EADP/0.1\n" % self.name)
+        time.sleep(0.05)
+        group_addresses = list(group_addresses)
+        for i in xrange(0, len(group_addresses), WATCH_CHUNK):
+            self.client_socket.sendall("WE %s\n" % ','.join(group_addresses[i:i + WATCH_CHUNK]))
+            time.sleep(0.05)
+
+    def expect(self, group_address, value, injected_at):
+        self.lock.acquire()
+        self.expected.setdefault(group_address, collections.deque()).append((value, injected_at))
+        self.pending += 1
+        self.lock.release()
+
+    def received(self, group_address, value, received_at):
+        self.lock.acquire()
+        try:
+            expected = self.expected.get(group_address)
+            while expected:
+                expected_value, injected_at = expected.popleft()
+                self.pending -= 1
+                if expected_value == value:
+                    self.lags.append(received_at - injected_at)
+                    return
+                self.lost += 1
+        finally:
+            self.lock.release()
+
+    def run(self):
+        data = ''
+        while True:
+            try:
+                received = self.client_socket.recv(65536)
+            except socket.error:
+                return
+            if not received:
+                return
+            now = time.time()
+            data += received
+            lines = data.split('\n')
+            data = lines.pop()
+            for line in lines:
+                # watched values : dE 1/2/3=0C1A
+                if line.startswith('dE ') and '=' in line:
+                    group_address, value = line[3:].split('=', 1)
+                    self.received(group_address, value, now)
+
+
+class Replayer:
+    """
+    Inject the captured telegrams into the eibd stand-in at a given speed and collect the delays measured by the
+    probes.
+    """
+
+    def __init__(self, eibd, probes, paths, start=None, end=None):
+        self.eibd = eibd
+        self.probes = probes
+        self.paths = paths
+        self.start = start
+        self.end = end
+
+    def telegrams(self):
+        for path in self.paths:
+            reader = CaptureReader(path)
+            try:
+                for telegram in reader.telegrams(self.start, self.end):
+                    yield telegram
+            finally:
+                reader.close()
+
+    def group_addresses(self):
+        return sorted(set(format_group_address(t.dest) for t in self.telegrams()))
+
+    def inject(self, batch):
+        now = time.time()
+        for telegram in batch:
+            if telegram.kind == GROUP_WRITE or telegram.kind == GROUP_RESPONSE:
+                group_address = format_group_address(telegram.dest)
+                value = telegram.format_value()
+                for probe in self.probes:
+                    probe.expect(group_address, value, now)
+        self.eibd.inject(batch)
+
+    def run(self, speed):
+        """
+        :param speed: replay speed factor (1 => real time), MAX_SPEED to inject as fast as possible
+        :return: dict of the measures
+        """
+        for probe in self.probes:
+            probe.reset()
+        count = 0
+        origin = None
+        started_at = time.time()
+        batch = []
+        for telegram in self.telegrams():
+            if origin is None:
+                origin = telegram.timestamp
+            if speed != MAX_SPEED:
+                delay = started_at + (telegram.timestamp - origin) / speed - time.time()
+                if delay > 0:
+                    if batch:
+                        self.inject(batch)
+                        batch = []
+                    time.sleep(delay)
+            batch.append(telegram)
+            count += 1
+            if len(batch) >= BATCH_SIZE:
+                self.inject(batch)
+                batch = []
+        if batch:
+            self.inject(batch)
+        injected_at = time.time()
+
+        deadline = injected_at + DRAIN_TIMEOUT
+        while time.time() < deadline and any(probe.pending for probe in self.probes):
+            time.sleep(0.01)
+
+        lags = sorted(lag for probe in self.probes for lag in probe.lags)
+        return {
+            'speed': speed,
+            'telegrams': count,
+            'injection': injected_at - started_at,
+            'delivered': len(lags),
+            'lost': sum(probe.lost for probe in self.probes),
+            'pending': sum(probe.pending for probe in self.probes),
+            'lag_p50': percentile(lags, 0.50),
+            'lag_p95': percentile(lags, 0.95),
+            'lag_p99': percentile(lags, 0.99),
+            'lag_max': lags[-1] if lags else 0.0,
+        }
+
+
+def report(result):
+    speed = 'max' if result['speed'] == MAX_SPEED else "%gx" % result['speed']
+    print "%-5s %8d telegrams in %7.2fs  delivered %8d  lost %6d  pending %6d  " \
+          "lag p50 %8.1fms  p95 %8.1fms  p99 %8.1fms  max %8.1fms" % (
+              speed, result['telegrams'], result['injection'], result['delivered'], result['lost'], result['pending'],
+              result['lag_p50'] * 1e3, result['lag_p95'] * 1e3, result['lag_p99'] * 1e3, result['lag_max'] * 1e3)
+
+
+def parse_speed(value):
+    if value == 'max':
+        return MAX_SPEED
+    return float(value.rstrip('x'))
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage="%prog [options] capture.kcap [capture.kcap ...]")
+    parser.add_option('--eibd-port', type='int', default=DEFAULT_PORT, help="port of the eibd stand-in")
+    parser.add_option('--server', default='127.0.0.1:1100', help="address of konext (host:port)")
+    parser.add_option('--clients', type='int', default=1, help="number of watching clients")
+    parser.add_option('--speeds', default='1,10,max', help="replay speeds (1, 10, max ...)")
+    parser.add_option('--start', type='float', help="first capture time replayed")
+    parser.add_option('--end', type='float', help="last capture time replayed")
+    parser.add_option('--wait', type='float', default=5.0, help="delay (in sec.) given to konext to connect")
+    options, paths = parser.parse_args()
+    if not paths:
+        parser.error("no capture file")
+
+    eibd = FakeEibd(port=options.eibd_port)
+    eibd.setDaemon(True)
+    eibd.start()
+    print "eibd stand-in listening on %s, waiting for konext" % eibd.url()
+    time.sleep(options.wait)
+
+    host, port = options.server.rsplit(':', 1)
+    probes = [FanoutProbe(host, int(port), "replay%d" % i) for i in range(options.clients)]
+    replayer = Replayer(eibd, probes, paths, options.start, options.end)
+    for probe in probes:
+        probe.start()
+        probe.login(replayer.group_addresses())
+
+    for speed in options.speeds.split(','):
+        report(replayer.run(parse_speed(speed)))
@@ -25,7 +25,8 @@ if __name__ == '__main__':
                                     app_name,
                                     config['log_file'],
                                     config['max_logfile_size'],
-                                    config['nb_logfile'])
+                                    config['nb_logfile'],
+                                    liblogging.get_level(config.get('log_level') or 'DEBUG'))
 
     # checking availability ...
     if not socket_engine.check_server(address, port):
@@ -33,5 +34,5 @@ if __name__ == '__main__':
         sys.exit(1)     # exiting due to error ...
 
     mark_pid_on_fs()
-    liblogging.log("Server starting with pid [%d]" % os.getpid())
+    liblogging.log("Server starting with pid [%d]", liblogging.INFO, os.getpid())
     socket_engine.configure_and_start_server(config)
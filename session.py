@@ -0,0 +1,447 @@
+__author__ = 'mlefebvre'
+
+import threading
+import time
+import Queue
+from tasker import Task
+from address import format_group_address, format_physical_address
+import libkonext
+import liblogging
+import metrics
+from cmd_parser import Parser
+import gateway
+
+
+CLIENT_PARSE_FAILURES = metrics.PARSE_FAILURES.child('client')
+
+
+class ClientSession:
+    """
+    EADP protocol state machine of a client connection (HELO, RE/SE/WE/UE/TE/QE).
+
+    The session doesn't know how the bytes reach the client socket, the transport (thread per connection dispatcher
+    or event driven reactor) is responsible to feed the commands (framed by a LineFramer) with handle_commands, to
+    feed the telegrams handed over by the bus gateway with handle_telegram and to provide send_back.
+    """
+
+    KNX_READ_FLAG = 0x00
+    KNX_RESPONSE_FLAG = 0x40
+    KNX_WRITE_FLAG = 0x80
+
+    BUS_COMMANDS = (libkonext.READ, libkonext.SEND, libkonext.WATCH, libkonext.UNWATCH)
+
+    def __init__(self, client_address, options=None):
+        self.client_address = client_address        # client address information
+        self.parser = Parser()                      # define the parser for the session
+        self.name = "anonymous"                     # define the name of the client
+        self.logged_in = False                      # tag user as not logged in (according to the protocol
+        self.failed_attempt = 0                     # current number of failed response handling attempt
+        self.max_failed_attempt = 10                # maximum number of failed response handling attempt
+        self.options = options                      # optional configuration option
+
+        self.watch_stack = set()                    # raw group addresses watched by the session
+        self.watch_stack_lock = threading.RLock()   # lock on the watch_stack
+        self.gateway = gateway.get_gateway()        # process wide bridge to eibd shared by all the clients
+        self.subscriptions = self.gateway.subscriptions     # process wide index of the watched addresses
+        self.write_queue = self.gateway.write_queue # queue for write to eibd socket (shared by all the clients)
+        self.value_cache = self.gateway.value_cache # last known value of the group addresses
+        self.history = self.gateway.history         # last values of the group addresses
+        self.pending_reads = self.gateway.pending_reads     # reads waiting for an answer from the bus
+        self.transport = None                       # receives the telegrams of the session from the gateway
+                                                    # (push_telegram / push_read_timeout), set by the transport
+
+    def send_back(self, message):
+        """
+        Write a message to the client, hook of the transport : the dispatcher writes it on the client socket at once,
+        the reactor keeps what can't be written immediately until the socket is writable.
+
+        :param message: the message, line terminators included
+        """
+
+    def send_back_cors(self):
+        with open('/var/www/crossdomain.xml', 'r') as content_file:
+            cors_resp = content_file.read()
+        self.send_back(cors_resp.strip())
+
+    # --------------------------------------------------------- #
+
+                        #### logging commands ####
+
+    # --------------------------------------------------------- #
+
+    def log(self, message, level=liblogging.INFO, *args):
+        liblogging.log(message, level, *args)
+
+    def debug(self, message, *args):
+        liblogging.log(message, liblogging.DEBUG, *args)
+
+    def info(self, message, *args):
+        liblogging.log(message, liblogging.INFO, *args)
+
+    def warn(self, message, *args):
+        liblogging.log(message, liblogging.WARNING, *args)
+
+    def error(self, message, *args):
+        liblogging.log(message, liblogging.ERROR, *args)
+
+    def critical(self, message, *args):
+        liblogging.log(message, liblogging.CRITICAL, *args)
+
+    def fatal(self, message, *args):
+        liblogging.log(message, liblogging.FATAL, *args)
+
+    # --------------------------------------------------------- #
+
+                        #### client commands ####
+
+    # --------------------------------------------------------- #
+
+    def manage_watch_stack(self, task):
+        """
+        Add or remove a watched address / list of addresses from the stack of watched address and from the process
+        wide subscription index used to deliver the telegrams.
+
+        :param task: the task which define the command => addresses concerned by the current job
+        """
+        self.watch_stack_lock.acquire()
+
+        for text, group_address, value in task.entries():
+            if group_address in self.watch_stack and task.command == libkonext.UNWATCH:
+                liblogging.log("Removing address [%s] into the watch stack", liblogging.DEBUG, text)
+                self.watch_stack.discard(group_address)
+                self.subscriptions.unsubscribe(self, group_address)
+            elif group_address not in self.watch_stack and task.command == libkonext.WATCH:
+                liblogging.log("Adding address [%s] into the watch stack", liblogging.DEBUG, text)
+                self.watch_stack.add(group_address)
+                self.subscriptions.subscribe(self, group_address)
+            else:
+                liblogging.log("Nothing to do with the val [%s] into the watch stack", liblogging.DEBUG, text)
+
+        self.watch_stack_lock.release()
+
+    def dispose_watch_stack(self):
+        """
+        Remove all the addresses watched by the session from the subscription index (session closing).
+        """
+        self.watch_stack_lock.acquire()
+        self.subscriptions.unsubscribe_all(self, self.watch_stack)
+        self.watch_stack.clear()
+        self.watch_stack_lock.release()
+
+    def dispose_pending_reads(self):
+        """
+        Forget the reads of the session still waiting for an answer (session closing).
+        """
+        self.pending_reads.discard(self)
+
+    def submit(self, task, quiet=False):
+        """
+        Push a task in the write queue, a read is registered in the pending reads so its answer is routed back to
+        the session. The reads of a WE are not, their answers reach the session as a watcher.
+
+        :param quiet: True for the read confirming a write, the client is not told if it is never answered
+        """
+        if task.command == libkonext.READ:
+            for dest in task.destinations():
+                self.pending_reads.add(self, dest, quiet)
+        self.write_queue.put(task)
+
+    def dispatch_command(self, command):
+        """
+        dispatching the tasks of a command depending on its nature ...
+
+        :param command: valid RE, SE, WE or UE command to dispatch (Command)
+        :return: dispatching process result (0 => OK, > 1 => KO)
+        """
+        process_result = 0
+        task = Task.create_task_from_command(command)
+
+        if command.header in [libkonext.WATCH, libkonext.UNWATCH]:
+            self.manage_watch_stack(task)
+
+        if command.header == libkonext.UNWATCH:
+            self.send_back("%s\n" % libkonext.END_ACK)
+            return process_result
+
+        if command.header == libkonext.READ:
+            task = self.read_from_cache(task)
+
+        if task is not None:
+            max_attempt = 10
+            # in all cases, send task to the write queue ...
+            while 1:
+                try:
+                    self.submit(task)
+                    # write tasks should respond with a read, so a write tasks emmit two tasks in the request queue
+                    # 1 => Write,
+                    # 2 => Read
+                    if task.command == libkonext.SEND:
+                        self.submit(task.as_read(), quiet=True)
+                    break
+                except Queue.Full:
+                    max_attempt -= 1
+                    if not max_attempt:
+                        self.error("A task will be ignored cause too many attempt to push it into the request queue")
+                        break
+                    # let a chance to other thread to stack out task from the queue
+                    time.sleep(1)
+                except Exception, e:
+                    self.error("Unexpected error occurred on the thread responsible to enqueue tasks. The task has been dropped out %s", e.message)
+                    process_result = 1
+                    break
+
+        return process_result
+
+    def read_from_cache(self, task):
+        """
+        Answer the group addresses of a read task whose value is known and fresh enough from the value cache.
+
+        :param task: read task
+        :return: the task of the group addresses which have to be read on the bus (cache miss), None if all of them
+        have been answered
+        """
+        missed_texts = []
+        missed = []
+        for text, group_address, unused in task.entries():
+            value = self.value_cache.get(group_address)
+            if value is None:
+                missed_texts.append(text)
+                missed.append(group_address)
+            else:
+                self.send_back_response(libkonext.KNX_RESPONSE_FLAG, None, text, value)
+        if len(missed) == task.size():
+            return task
+        return task.select(missed_texts, missed)
+
+    def send_history(self, command):
+        """
+        Send back the recorded values of the group addresses of a history command, one line per value, oldest
+        first : hE 1/2/3=0C1A@1420070400.123
+
+        :param command: valid history command (HE 1/2/3,1/2/4:50,1/2/5@1420070400)
+        """
+        header_ack = libkonext.get_ack(libkonext.HISTORY)
+        lines = []
+        for group_address, raw_address, last, since in zip(command.group_addresses, command.addresses, command.lasts,
+                                                           command.sinces):
+            for timestamp, value in self.history.values(raw_address, last, since):
+                lines.append("%s %s=%s@%.3f\n" % (header_ack, group_address, value.encode('hex').upper(), timestamp))
+        lines.append("%s\n" % libkonext.END_ACK)
+        self.send_back(''.join(lines))
+
+    def handle_commands(self, commands):
+        """
+        Run the commands of a receive in order, a client may send several commands without waiting for their answers.
+
+        :param commands: the commands extracted by the framer, None for a command too long
+        :return: False if the client asked to end the session (the following commands are ignored), True otherwise
+        """
+        for command in commands:
+            if command is None:
+                CLIENT_PARSE_FAILURES.inc()
+                self.warn("Command too long received from[ %s]", self.client_address)
+                self.send_back("nE E7, \"Argument list too long\"\n")
+            elif not self.handle_command(command):
+                return False
+        return True
+
+    def handle_command(self, command):
+        """
+        Run the protocol state machine for a command received from the client.
+
+        :param command: the command, without the line terminator
+        :return: False if the client asked to end the session, True otherwise
+        """
+        if command == 'quit':     # hang off in this case
+            return False
+
+        self.debug("Receive command [%s] from %s", command, self.client_address)
+
+        #
+        # try to manage cors issue created by the flash socket implementation.
+        #
+        if self.parser.detect_cors(command):
+            self.send_back_cors()
+            return True
+
+        #
+        # read the command in a single pass (syntaxic validation, the semantic one is given by the valid flag).
+        #
+        parsed = self.parser.parse_command(command)
+        if parsed is None:
+            msg = "nE E22, \"%s: Invalid argument\"\n" % command
+            CLIENT_PARSE_FAILURES.inc()
+            self.warn("Invalid command [%s] received from[ %s]", command, self.client_address)
+            self.send_back(msg)
+            return True
+
+        header = parsed.header
+        self.debug("Receive header [%s] from %s", header, self.client_address)
+
+        # first, check if the login command has been sent
+        if not self.logged_in and header != libkonext.HELO_PREFIX:
+            self.debug("Receive a command [%s] from %s but client not logged in and command is not an helo", command, self.client_address)
+            msg = "nE E13, \"%s: Permission denied\"\n" % command
+            self.warn("Permission denied for %s, client not connected", self.client_address)
+            self.send_back(msg)
+            return True
+
+        #
+        #  check if the command is a valid helo command (semantic validation)
+        #
+        if not self.logged_in and header == libkonext.HELO_PREFIX and not parsed.valid:
+            self.debug("Receive a command [%s] from %s but client not logged in and command is not a valid helo", command, self.client_address)
+            msg = "nE E22, \"%s: Invalid argument\"\n" % command
+            CLIENT_PARSE_FAILURES.inc()
+            self.warn("Invalid helo command [%s] received from[ %s]", command, self.client_address)
+            self.send_back(msg)
+            return True
+
+        self.debug("Process start for command [%s] from %s", command, self.client_address)
+
+        # log in client
+        if header == libkonext.HELO_PREFIX and not self.logged_in:
+            self.debug("Connecting process is invoking for command [%s] from %s", command, self.client_address)
+            self.name = parsed.name
+            self.info("The client %s is now connected with %s", self.client_address, self.name)
+            msg = "%s\n" % (libkonext.get_ack(header) % self.name)
+            self.send_back(msg)
+            self.logged_in = True
+        elif header == libkonext.HISTORY:
+            self.debug("Receive a history command [%s] from %s", command, self.client_address)
+            if not parsed.valid:
+                msg = "nE E22, \"%s: Invalid argument\"\n" % command
+                CLIENT_PARSE_FAILURES.inc()
+                self.warn("Invalid history command [%s] received from[ %s]", command, self.client_address)
+                self.send_back(msg)
+            else:
+                self.send_history(parsed)
+        elif header == libkonext.TEST:
+            self.debug("Receive a test command [%s] from %s", command, self.client_address)
+            msg = "%s\n" % libkonext.get_ack(libkonext.TEST)
+            self.send_back(msg)
+            self.debug("Processing complete for command [%s] (TEST) from %s", command, self.client_address)
+        else:
+            try:
+                if not parsed.valid or header not in self.BUS_COMMANDS:
+                    raise ValueError("invalid %s command" % header)
+                self.debug("Process send the command [%s] from %s", command, self.client_address)
+
+                # manage command case ...
+                self.dispatch_command(parsed)
+            except Exception, e:
+                self.debug("Process leave an exception [%s] for command [%s] from %s", e, command, self.client_address)
+                msg = "nE E22, \"%s: Invalid argument\"\n" % command
+                CLIENT_PARSE_FAILURES.inc()
+                self.warn("Invalid command [%s] received from[ %s] is sending back to the client socket", command, self.client_address)
+                self.send_back(msg)
+
+        return True
+
+    # --------------------------------------------------------- #
+
+                        #### bus telegrams ####
+
+    # --------------------------------------------------------- #
+
+    def try_to_sendback_to_requesters(self, resp_kind, physical_address, group_address, resp_val_str, requested):
+        if not requested or resp_kind != self.KNX_RESPONSE_FLAG:
+            return True
+        return self.send_back_response(resp_kind, physical_address, group_address, resp_val_str)
+
+    def try_to_sendback_to_watchers(self, resp_kind, physical_address, group_address, resp_val_str, watched):
+        if not watched:
+            return True
+        try:
+            header_ack = libkonext.get_ack(libkonext.READ)
+            response_body = "%s=%s" % (group_address, resp_val_str)
+            message = "%s %s\n" % (header_ack, response_body)
+            self.send_back(message)
+            return True
+        except BaseException:
+            self.error("Eibd listener genreic exception.")
+            return False
+
+    def send_back_response(self, resp_kind, physical_address, group_address, resp_val_str):
+        try:
+            header_ack = libkonext.get_ack(libkonext.READ)
+            response_body = "%s=%s" % (group_address, resp_val_str)
+            end_of_command = libkonext.END_ACK
+            message = "%s %s\n%s\n" % (header_ack, response_body, end_of_command)
+            self.send_back(message)
+            return True
+        except BaseException:
+            self.error("Eibd listener genreic exception.")
+            return False
+
+    def prepare_and_send_response(self, resp_kind, telegram, watched=False, requested=False):
+        try:
+            self.debug("Eibd listener process to dispatch command (response or write handled).")
+            # do response processing ...
+            physical_address = format_physical_address(telegram.src)
+            self.debug("Eibd listener : source (physical address) of the packet is %s.", physical_address)
+            group_address = format_group_address(telegram.dest)
+            self.debug("Eibd listener : destination (group address) of the packet is %s.", group_address)
+            resp_val_str = telegram.format_value()
+            self.debug("Eibd listener : response value associate to the packet is %s.", resp_val_str)
+            r = self.try_to_sendback_to_requesters(resp_kind, physical_address, group_address, resp_val_str, requested)
+            if not r:
+                self.error("Error occurred during sending back the response to the client socket")
+                return False
+            # the answer of a read already tells a watcher the value
+            watched = watched and not (requested and resp_kind == self.KNX_RESPONSE_FLAG)
+            r = self.try_to_sendback_to_watchers(resp_kind, physical_address, group_address, resp_val_str, watched)
+            if not r:
+                self.error("Error occurred during sending back the watching response to the client socket")
+                return False
+            self.debug("Response successfully managed by the process")
+            return True
+        except BaseException:
+            self.error("Eibd listener genreic exception.")
+            return False
+
+    def handle_read_timeout(self, dest):
+        """
+        Tell the client that the bus didn't answer its read in time.
+
+        :param dest: group address read (raw)
+        """
+        group_address = format_group_address(dest)
+        self.warn("Read of [%s] requested by %s has timed out", group_address, self.client_address)
+        try:
+            self.send_back("nE E62, \"%s: Timer expired\"\n" % group_address)
+        except BaseException:
+            self.error("Eibd listener genreic exception.")
+
+    def handle_telegram(self, telegram, watched=False, requested=False):
+        """
+        Forward a telegram read on the bus to the client.
+
+        :param telegram: the telegram (Telegram)
+        :param watched: True if the session watches the group address (resolved by the subscription index)
+        :param requested: True if the session waits for the telegram as the answer of a read (pending reads)
+        """
+        self.debug("Eibd listener handling incoming information")
+
+        resp_kind = telegram.kind
+        if resp_kind & 0x300 or resp_kind == 0xC0:
+            self.error("Eibd listener handling an unknown APDU")
+        else:
+            self.debug("Eibd listener handling a valid packet, dispatching it.")
+            # manage response type
+            if resp_kind == self.KNX_READ_FLAG:
+                # read is ignored by the process since it doesn't require an action...
+                self.debug("Eibd listener handling a read datagram, ignoring it.")
+            elif resp_kind == self.KNX_RESPONSE_FLAG or resp_kind == self.KNX_WRITE_FLAG:
+                if resp_kind == self.KNX_WRITE_FLAG:
+                    self.debug("Eibd listener handling a write datagram.")
+                else:
+                    self.debug("Eibd listener handling a response datagram.")
+
+                proc_result = self.prepare_and_send_response(resp_kind, telegram, watched, requested)
+                if not proc_result:
+                    self.debug("Eibd listener handling an error during sending back information to the client socket")
+                else:
+                    self.debug("Eibd listener successgfully handling and manage request.")
+            else:
+                self.warn("Eibd listener : Unknown datagram handled")
@@ -7,6 +7,13 @@ import thread
 from cmd_parser import Parser
 from process_sender import Processor
 import dispatcher
+import gateway
+import metrics
+import reactor
+
+
+THREADED_MODE = 'threaded'
+REACTOR_MODE = 'reactor'
 
 
 ################################################################################################
@@ -22,7 +29,7 @@ def check_server(address, port):
     :return: true if address is ready to use false otherwise
     """
     s = socket()
-    liblogging.log("Checking local on port [%s:%d]" % (address, port), liblogging.INFO)
+    liblogging.log("Checking local on port [%s:%d]", liblogging.INFO, address, port)
     try:
         s.connect((address, port))
         # we are able to connect on this port, it means that a server already listening on it ... cannot start the server
@@ -30,7 +37,7 @@ def check_server(address, port):
             "Failure port [%s:%d] is not ready [error : %s]" % (address, port, 'Already listen on the requested port'), liblogging.WARNING)
         return False
     except error, e:
-        liblogging.log("OK local port [%s:%d] is ready to use" % (address, port), liblogging.INFO)
+        liblogging.log("OK local port [%s:%d] is ready to use", liblogging.INFO, address, port)
         return True
 
 
@@ -64,28 +71,28 @@ def handler(client_socket, client_address, buffer_size=1024):
 
         #### command validation ... ####
         command = data.rstrip()
-        liblogging.log("Receive command [%s] from %s" % (command, client_address), liblogging.DEBUG)
+        liblogging.log("Receive command [%s] from %s", liblogging.DEBUG, command, client_address)
         if not parser.is_valid_command(command):
             msg = "nE E22, \"%s: Invalid argument\"\n" % command
-            liblogging.log("Invalid command [%s] received from[ %s]" % (command, client_address), liblogging.WARNING)
+            liblogging.log("Invalid command [%s] received from[ %s]", liblogging.WARNING, command, client_address)
             client_socket.send(msg)
             continue
 
         # command parsing process
         header = libkonext.get_header(command)
-        liblogging.log("Receive header [%s] from %s" % (header, client_address), liblogging.DEBUG)
+        liblogging.log("Receive header [%s] from %s", liblogging.DEBUG, header, client_address)
 
         # first, check if the login command has been sent
         if not logged_in and header != libkonext.HELO_PREFIX:
             msg = "nE E13, \"%s: Permission denied\"\n" % command
-            liblogging.log("Permission denied for %s, client not connected" % client_address, liblogging.WARNING)
+            liblogging.log("Permission denied for %s, client not connected", liblogging.WARNING, client_address)
             client_socket.send(msg)
             continue
 
         # check if the command is a valid helo command
         if not logged_in and header == libkonext.HELO_PREFIX and not parser.is_valid_helo_command(command):
             msg = "nE E22, \"%s: Invalid argument\"\n" % command
-            liblogging.log("Invalid helo command [%s] received from[ %s]" % (command, client_address), liblogging.WARNING)
+            liblogging.log("Invalid helo command [%s] received from[ %s]", liblogging.WARNING, command, client_address)
             client_socket.send(msg)
             continue
 
@@ -96,7 +103,7 @@ def handler(client_socket, client_address, buffer_size=1024):
         # log in client
         if header == libkonext.HELO_PREFIX:
             name = libkonext.get_client_name(command)
-            liblogging.log("The client %s is now connected with %s" % (client_address, name), liblogging.INFO)
+            liblogging.log("The client %s is now connected with %s", liblogging.INFO, client_address, name)
             msg = "%s\n" % (libkonext.get_ack(header) % name)
             client_socket.send(msg)
             logged_in = True
@@ -108,7 +115,7 @@ def handler(client_socket, client_address, buffer_size=1024):
                 continue
             except Exception:
                 msg = "nE E22, \"%s: Invalid argument\"\n" % command
-                liblogging.log("Invalid command [%s] received from[ %s]" % (command, client_address), liblogging.WARNING)
+                liblogging.log("Invalid command [%s] received from[ %s]", liblogging.WARNING, command, client_address)
                 client_socket.send(msg)
 
         # try:
@@ -124,7 +131,7 @@ def handler(client_socket, client_address, buffer_size=1024):
     msg = "%s %s\n" %(header, name)
     client_socket.send(msg)
     client_socket.close()
-    liblogging.log("Connection closed from (%s,%s)." % client_address)
+    liblogging.log("Connection closed from (%s,%s).", liblogging.INFO, *client_address)
     #### End of connection closing ####
 
 
@@ -146,18 +153,28 @@ def configure_and_start_server(config, options=None):
     host = gethostbyname(config['server_address'])
     #s.bind((host, int(config['port'])))             # Bind to the port
     s.bind((host, int(config['port'])))
-    buffer_size = int(config['buffer_size'])        # sizing the buffer for reading from socket
+    buffer_size = int(config['buffer_size'])        # sizing the buffer for reading from socket (longest command)
     max_connection = int(config['max_connection'])  # define the max concurrent connection supported by the server
 
     s.listen(max_connection)      # Now wait for client connection.
+
+    gateway.configure(config)     # open the eibd connections shared by all the clients
+    metrics.configure(config)     # metrics endpoint, if a port is configured
     liblogging.log("Server is now waiting for connection", liblogging.INFO)
 
     ################################################################################################
     #                                           socket start                                       #
     ################################################################################################
+    if config.get('server_mode', THREADED_MODE) == REACTOR_MODE:
+        # single threaded, event driven transport
+        reactor.Reactor(s, config, options).run()
+        return
+
+    # thread per connection transport (fallback)
     while True:
         c, addr = s.accept()     # Establish connection with client.
-        liblogging.log("Got connection from (%s, %s)" % addr)
+        liblogging.log("Got connection from (%s, %s)", liblogging.INFO, *addr)
+        metrics.CONNECTED_CLIENTS.inc()
         c.send("cE %s\n" % config['msg_banner'])
         client_thread = dispatcher.Dispatcher(c, addr, buffer_size, options)
         client_thread.setDaemon(True)
@@ -0,0 +1,51 @@
+__author__ = 'mlefebvre'
+
+import threading
+
+
+NO_SUBSCRIBER = frozenset()
+
+
+class SubscriptionIndex:
+    """
+    Process wide index of the watched group addresses (WE / UE) : raw group address => sessions watching it.
+
+    The sets of subscribers are immutable and replaced on each change, so the bus reader gets a consistent snapshot
+    of the subscribers of a telegram with a single dict lookup and without taking the lock.
+    """
+
+    def __init__(self):
+        self.index = {}                 # raw group address => frozenset of sessions
+        self.lock = threading.Lock()    # serialize the changes of the index
+
+    def subscribe(self, session, group_address):
+        self.lock.acquire()
+        try:
+            self.index[group_address] = self.index.get(group_address, NO_SUBSCRIBER) | frozenset((session,))
+        finally:
+            self.lock.release()
+
+    def unsubscribe(self, session, group_address):
+        self.lock.acquire()
+        try:
+            subscribers = self.index.get(group_address, NO_SUBSCRIBER) - frozenset((session,))
+            if subscribers:
+                self.index[group_address] = subscribers
+            else:
+                self.index.pop(group_address, None)
+        finally:
+            self.lock.release()
+
+    def unsubscribe_all(self, session, group_addresses):
+        for group_address in list(group_addresses):
+            self.unsubscribe(session, group_address)
+
+    def subscribers(self, group_address):
+        """
+        :param group_address: raw group address
+        :return: the sessions watching the group address
+        """
+        return self.index.get(group_address, NO_SUBSCRIBER)
+
+    def __len__(self):
+        return len(self.index)
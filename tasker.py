@@ -1,11 +1,15 @@
 __author__ = 'mehdi'
 
-from uuid import uuid1
+import itertools
 import libkonext
-import time
+from address import parse_group_address
+from clock import monotonic
 
 
-class Task:
+_ids = itertools.count(1)          # task ids, next() is atomic (GIL) so the ids are unique between the threads
+
+
+class Task(object):
     """
     Define a task to be processed in the queue (eibd side and client side)
 
@@ -24,15 +28,105 @@ class Task:
     READ_TASK = 1
     WRITE_TASK = 2
 
-    def __init__(self, raw_command, command, value, kind, group_address=None, response=None):
-        self.uuid = uuid1()
-        self.created_at = time.time()
+    __slots__ = ('id', 'created_at', 'raw_command', 'command', 'group_address', 'value', 'kind', 'response', 'dest',
+                 'group_addresses', 'addresses', 'values')
+
+    def __init__(self, raw_command, command, value, kind, group_address=None, response=None, dest=None,
+                 created_at=None):
+        self.id = next(_ids)
+        self.created_at = monotonic() if created_at is None else created_at
         self.raw_command = raw_command
         self.command = command
         self.group_address = group_address
         self.value = value
         self.kind = kind
         self.response = response
+        self.dest = dest                # raw group address
+        self.group_addresses = None     # batch : group addresses as written, None for a single address task
+        self.addresses = None           # batch : raw group addresses
+        self.values = None              # batch : value written to each group address, None if nothing is written
+
+    @staticmethod
+    def create_batch(raw_command, command, kind, group_addresses, addresses, values=None, created_at=None):
+        """
+        Create a task standing for several group addresses, its per address tasks are only created when they are
+        consumed (see items). The lists are kept as given, they must not be modified afterwards.
+        """
+        task = Task(raw_command, command, None, kind, created_at=created_at)
+        task.group_addresses = group_addresses
+        task.addresses = addresses
+        task.values = values
+        return task
+
+    def is_batch(self):
+        return self.addresses is not None
+
+    def size(self):
+        """
+        :return: number of group addresses of the task
+        """
+        return 1 if self.addresses is None else len(self.addresses)
+
+    def destinations(self):
+        """
+        :return: the raw group addresses of the task
+        """
+        return (self.dest,) if self.addresses is None else self.addresses
+
+    def entries(self):
+        """
+        Iterate over the (group address, raw group address, value) of the task without creating any task.
+        """
+        if self.addresses is None:
+            return iter(((self.group_address, self.dest, self.value),))
+        return itertools.izip(self.group_addresses, self.addresses, self.values or itertools.repeat(None))
+
+    def items(self):
+        """
+        Iterate over the single address tasks of the task, lazily : the task itself if it is not a batch. The items
+        share the id and the creation time of the batch.
+        """
+        if self.addresses is None:
+            yield self
+            return
+        for group_address, dest, value in self.entries():
+            # built without __init__, the items don't draw an id of their own
+            item = Task.__new__(Task)
+            item.id = self.id
+            item.created_at = self.created_at
+            item.raw_command = self.raw_command
+            item.command = self.command
+            item.group_address = group_address
+            item.value = value
+            item.kind = self.kind
+            item.response = self.response
+            item.dest = dest
+            item.group_addresses = None
+            item.addresses = None
+            item.values = None
+            yield item
+
+    def select(self, group_addresses, addresses):
+        """
+        :return: a task of the same command on a part of the group addresses (no values), None if there are none
+        """
+        if not addresses:
+            return None
+        if len(addresses) == 1:
+            return Task(self.raw_command, self.command, None, self.kind, group_addresses[0], self.response,
+                        addresses[0], self.created_at)
+        return Task.create_batch(self.raw_command, self.command, self.kind, group_addresses, addresses,
+                                 created_at=self.created_at)
+
+    def as_read(self):
+        """
+        :return: a read task of the same group addresses (the read following a write)
+        """
+        task = Task(self.raw_command, libkonext.READ, None, libkonext.KNX_READ_FLAG, self.group_address,
+                    self.response, self.dest, self.created_at)
+        task.group_addresses = self.group_addresses
+        task.addresses = self.addresses
+        return task
 
     def set_response(self, response):
         self.response = response
@@ -61,16 +155,42 @@ class Task:
         :param task: the task to clone
         :return: the cloned task
         """
-        _task = Task(task.raw_command, task.command, task.value, task.kind, task.group_address, task.response)
+        _task = Task(task.raw_command, task.command, task.value, task.kind, task.group_address, task.response,
+                     task.dest)
+        _task.group_addresses = task.group_addresses
+        _task.addresses = task.addresses
+        _task.values = task.values
         return _task
 
+    @staticmethod
+    def create_task_from_command(command):
+        """
+        Create the task of a command read by Parser.parse_command : a single address task, or a batch task sharing
+        the lists of the command for several group addresses (nothing is allocated per address).
+
+        :param command: a valid RE, SE, WE or UE command (Command)
+        :return: the task to do on the eibd queue
+        """
+        kind = libkonext.get_command_kind(command.header)
+        if len(command.addresses) == 1:
+            value = command.values[0] if command.values else None
+            return Task(command.raw, command.header, value, kind, command.group_addresses[0], None,
+                        command.addresses[0])
+        return Task.create_batch(command.raw, command.header, kind, command.group_addresses, command.addresses,
+                                 command.values or None)
+
     @staticmethod
     def stringify(task):
         result = ''
+        result += "Id : %d\n" % task.id
         result += "Raw command : %s\n" % task.raw_command
         result += "Command : %s\n" % task.command
-        result += "Group address : %s\n" % task.group_address
-        result += "Value : %s\n" % task.value
+        if task.is_batch():
+            result += "Group addresses : %s\n" % ','.join(task.group_addresses)
+            result += "Values : %s\n" % task.values
+        else:
+            result += "Group address : %s\n" % task.group_address
+            result += "Value : %s\n" % task.value
         result += "Kind : %s\n" % task.kind
         result += "Response : %s\n" % task.response
         return result
@@ -108,15 +228,12 @@ class Task:
         tasks = []
         orders = task.value.split(',')
         for order in orders:
-            _t = Task.clone_task(task)
             if task.kind == libkonext.KNX_WRITE_FLAG:
                 (group_address, val) = order.split('=')
-                _t.group_address = group_address
-                _t.value = val
             else:
-                _t.group_address = order
-                _t.value = None
-            tasks.append(_t)
+                group_address, val = order, None
+            tasks.append(Task(task.raw_command, task.command, val, task.kind, group_address, task.response,
+                              parse_group_address(group_address), task.created_at))
         return tasks
 
 
@@ -0,0 +1,74 @@
+__author__ = 'mlefebvre'
+
+from clock import monotonic
+
+
+# application layer services of the group telegrams (APCI & 0x3C0)
+GROUP_READ = 0x000
+GROUP_RESPONSE = 0x040
+GROUP_WRITE = 0x080
+
+
+class Telegram(object):
+    """
+    Group telegram as it flows through konext (bus reader, gateway, sessions, bus monitor).
+
+    src and dest are raw addresses, apci holds the 10 bits of the APCI including the 6 bit value of the short
+    telegrams, payload holds the bytes following the APCI (str, empty for short telegrams), timestamp is read on the
+    monotonic clock when the telegram is received.
+    """
+
+    __slots__ = ('src', 'dest', 'apci', 'payload', 'timestamp')
+
+    def __init__(self, src, dest, apci, payload='', timestamp=None):
+        self.src = src
+        self.dest = dest
+        self.apci = apci
+        self.payload = payload
+        if timestamp is None:
+            timestamp = monotonic()
+        self.timestamp = timestamp
+
+    @staticmethod
+    def from_apdu(src, dest, apdu, timestamp=None):
+        """
+        :param apdu: raw apdu (TPCI / APCI bytes followed by the data) of at least 2 bytes : str, memoryview,
+                     bytearray or list of int
+        """
+        if isinstance(apdu, memoryview):
+            apdu = apdu.tobytes()
+        elif not isinstance(apdu, str):
+            apdu = str(bytearray(apdu))
+        return Telegram(src, dest, ((ord(apdu[0]) & 0x03) << 8) | ord(apdu[1]), apdu[2:], timestamp)
+
+    @property
+    def kind(self):
+        """
+        Group service of the telegram (GROUP_READ, GROUP_RESPONSE, GROUP_WRITE), other values for the non group
+        services.
+        """
+        return self.apci & 0x3C0
+
+    def data(self):
+        """
+        :return: the value carried by the telegram (str), the 6 bit value for the short telegrams
+        """
+        if self.payload:
+            return self.payload
+        return chr(self.apci & 0x3F)
+
+    def apdu(self):
+        """
+        :return: the raw apdu of the telegram (str)
+        """
+        return chr(self.apci >> 8) + chr(self.apci & 0xFF) + self.payload
+
+    def format_value(self):
+        """
+        :return: the value as sent back to the clients, upper case hexadecimal (same as Parser.format_result)
+        """
+        return self.data().encode('hex').upper()
+
+    def __repr__(self):
+        return "Telegram(%04X > %04X, apci=%03X, payload=%r, timestamp=%.6f)" % (
+            self.src, self.dest, self.apci, self.payload, self.timestamp)
@@ -0,0 +1,55 @@
+__author__ = 'mlefebvre'
+
+from clock import monotonic
+
+
+DEFAULT_MAX_AGE = 30.0      # age (in sec.) after which a cached value has to be read again on the bus
+
+
+class GroupValueCache:
+    """
+    Process wide last known value of each group address.
+
+    The cache is fed by the bus reader with every write / response telegram observed on the bus, so a read (RE) can
+    be answered from memory while the value is younger than max_age instead of sending a read telegram on the bus.
+
+    Values are stored already formatted as sent back to the clients. Single dict operations are atomic, the cache
+    doesn't need a lock to be shared between the reader thread and the sessions.
+    """
+
+    def __init__(self, max_age=DEFAULT_MAX_AGE):
+        self.max_age = max_age      # maximum age of a value served from the cache, 0 disables the cache
+        self.values = {}            # raw group address => (formatted value, timestamp)
+        self.hits = 0
+        self.misses = 0
+
+    def update(self, group_address, value, timestamp=None):
+        """
+        :param group_address: raw group address
+        :param value: formatted value
+        :param timestamp: time (clock.monotonic) the value has been observed on the bus, now by default
+        """
+        if timestamp is None:
+            timestamp = monotonic()
+        self.values[group_address] = (value, timestamp)
+
+    def get(self, group_address, max_age=None):
+        """
+        :param group_address: raw group address
+        :param max_age: override the default maximum age of the value
+        :return: the formatted value if known and fresh enough, None otherwise
+        """
+        if max_age is None:
+            max_age = self.max_age
+        entry = self.values.get(group_address)
+        if entry is None or max_age <= 0 or monotonic() - entry[1] > max_age:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[0]
+
+    def invalidate(self, group_address):
+        self.values.pop(group_address, None)
+
+    def clear(self):
+        self.values.clear()